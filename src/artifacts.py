@@ -0,0 +1,183 @@
+import os
+import json
+import pickle
+import logging
+import importlib
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import xgboost
+
+import geometry
+import utils
+
+logger = logging.getLogger(__name__)
+
+"""
+Versioned artifact directories for trained predictors.
+
+An artifact consists of a manifest (manifest.json) describing the predictor and listing the files of its parts,
+e.g. the booster in UBJSON, frames in Parquet, metrics in JSON and arrays like SHAP values as .npy files, which
+can be memory-mapped. Each part can therefore be read independently and only once needed.
+"""
+
+ARTIFACT_FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+FILE_EXTENSIONS = {
+    'frame': 'parquet',
+    'array': 'npy',
+    'json': 'json',
+    'xgboost': 'ubj',
+    'pickle': 'pkl',
+}
+
+
+def is_artifact(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def write_artifact(path, manifest, parts):
+    # parts map names to (kind, value)
+    utils.write_atomically(path, lambda tmp_path: _write_artifact(tmp_path, manifest, parts))
+
+
+def _write_artifact(path, manifest, parts):
+    os.makedirs(path)
+
+    files = {}
+    for name, (kind, value) in parts.items():
+        if value is not None:
+            file_name = f'{name}.{FILE_EXTENSIONS[kind]}'
+            metadata = WRITERS[kind](value, os.path.join(path, file_name))
+            files[name] = {'kind': kind, 'file': file_name, **(metadata or {})}
+
+    manifest = {**manifest, 'format_version': ARTIFACT_FORMAT_VERSION, 'files': {**manifest.get('files', {}), **files}}
+    write_json(manifest, os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(path):
+    manifest = read_json(os.path.join(path, MANIFEST_FILE))
+
+    if manifest.get('format_version', 0) > ARTIFACT_FORMAT_VERSION:
+        raise Exception(f'The artifact {path} has format version {manifest["format_version"]}, but only versions up to {ARTIFACT_FORMAT_VERSION} are supported. Please update the code.')
+
+    return manifest
+
+
+def read_part(path, manifest, name):
+    part = manifest['files'][name]
+
+    if part['kind'] == 'xgboost':
+        return read_xgboost(os.path.join(path, part['file']), part['class'], part['params'])
+
+    return READERS[part['kind']](os.path.join(path, part['file']))
+
+
+def load_booster(path):
+    # only the booster and the manifest of an artifact, e.g. for inference
+    manifest = read_manifest(path)
+    booster = xgboost.Booster()
+    booster.load_model(os.path.join(path, manifest['files']['model']['file']))
+    return booster, manifest
+
+
+def write_frame(df, path):
+    df = df.copy()
+
+    if 'geometry' in df.columns and isinstance(df['geometry'].dtype, gpd.array.GeometryDtype):
+        df['geometry'] = geometry.to_wkb(df['geometry'])
+
+    # parquet requires string column names
+    df.columns = df.columns.astype(str)
+    df.to_parquet(path)
+
+
+def read_frame(path):
+    df = pd.read_parquet(path)
+
+    # geometries are stored as WKB, while other geometry columns, e.g. WKT strings, are kept as they are
+    if 'geometry' in df.columns and isinstance(next(iter(df['geometry'].dropna()), None), bytes):
+        df['geometry'] = geometry.from_wkb(df['geometry']).values
+
+    return df
+
+
+def write_array(array, path):
+    np.save(path, np.asarray(array), allow_pickle=False)
+
+
+def read_array(path):
+    return np.load(path, mmap_mode='r')
+
+
+def write_xgboost(model, path):
+    # the sklearn wrapper is restored from its class and parameters, the booster from UBJSON
+    model.save_model(path)
+    params = {k: v for k, v in model.get_params().items() if json_serializable(v)}
+    return {'class': f'{type(model).__module__}.{type(model).__qualname__}', 'params': params}
+
+
+def read_xgboost(path, model_class, params):
+    module_name, _, class_name = model_class.rpartition('.')
+    model = getattr(importlib.import_module(module_name), class_name)(**params)
+    model.load_model(path)
+    return model
+
+
+def write_pickle(value, path):
+    with open(path, 'wb') as f:
+        pickle.dump(value, f)
+
+
+def read_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def write_json(value, path):
+    with open(path, 'w') as f:
+        json.dump(value, f, indent=4, default=_to_json)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def json_serializable(value):
+    try:
+        json.dumps(value, default=_to_json)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+
+    if isinstance(value, pd.DataFrame):
+        return json.loads(value.to_json(orient='split', double_precision=15))
+
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+WRITERS = {
+    'frame': write_frame,
+    'array': write_array,
+    'json': write_json,
+    'xgboost': write_xgboost,
+    'pickle': write_pickle,
+}
+
+READERS = {
+    'frame': read_frame,
+    'array': read_array,
+    'json': read_json,
+    'pickle': read_pickle,
+}
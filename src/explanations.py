@@ -0,0 +1,114 @@
+import os
+import logging
+import tempfile
+import itertools
+
+import numpy as np
+import pandas as pd
+import shap
+import xgboost
+
+import utils
+import inference
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SHAP_CHUNK_SIZE = 10_000
+SHAP_STRATA_BINS = 10
+
+
+def stratified_sample(strata, size, seed=None):
+    """
+    Positions of a random sample of the given size, which contains every stratum in proportion to its frequency.
+    """
+    codes, _ = pd.factorize(np.asarray(strata), use_na_sentinel=False)
+    if size >= len(codes):
+        return np.arange(len(codes))
+
+    # proportional allocation, the remaining buildings go to the strata with the largest rounding remainders
+    counts = np.bincount(codes)
+    quotas = counts * size / len(codes)
+    allocation = np.floor(quotas).astype(int)
+    allocation[np.argsort(allocation - quotas, kind='stable')[:size - allocation.sum()]] += 1
+
+    rng = np.random.default_rng(seed)
+    order = np.argsort(codes, kind='stable')
+    strata_positions = np.split(order, np.cumsum(counts)[:-1])
+    sample = [rng.choice(positions, n, replace=False) for positions, n in zip(strata_positions, allocation)]
+    return np.sort(np.concatenate(sample))
+
+
+def shap_values(model, X, native=False, n_jobs=None, chunk_size=SHAP_CHUNK_SIZE, path=None):
+    """
+    Calculates the TreeSHAP values of the features X as float32 array memory-mapped from a .npy file.
+
+    The rows are explained in chunks, which are distributed across forked worker processes that write directly into the file.
+    With native, xgboost's pred_contribs is used instead of the shap package, which yields the same values without converting the trees.
+    Multiclass values are stored class-first with shape (classes, rows, features).
+    Without a path, the file is temporary and removed once the values are no longer referenced.
+    """
+    if native and not hasattr(model, 'get_booster'):
+        raise Exception(f'Native SHAP values are only available for xgboost models, but got {type(model).__name__}.')
+
+    chunks = [(start, min(start + chunk_size, len(X))) for start in range(0, len(X), chunk_size)] or [(0, 0)]
+    n_workers = min(len(chunks) - 1, n_jobs or os.cpu_count())
+
+    # the trees are converted only once and shared with the workers, the first chunk determines the shape of the values
+    explainer = None if native else shap.TreeExplainer(model)
+    first_values = _chunk_values(model, explainer, X.iloc[slice(*chunks[0])])
+    shape = (*first_values.shape[:-2], len(X), first_values.shape[-1])
+
+    temporary = path is None
+    if temporary:
+        fd, path = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+
+    try:
+        values = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+        values[..., slice(*chunks[0]), :] = first_values
+        values.flush()
+        del values
+
+        if n_workers > 1:
+            logger.info(f'Calculating SHAP values of {len(X)} buildings in {len(chunks)} chunks using {n_workers} worker processes...')
+
+        with utils.fork_pool(n_workers, explained=(model, explainer, X)) as executor:
+            list(executor.map(_explain_chunk, itertools.repeat(path), chunks[1:], itertools.repeat(n_workers)))
+
+        # the memory map keeps the data of a removed temporary file accessible
+        return np.load(path, mmap_mode='r')
+    finally:
+        if temporary:
+            os.remove(path)
+
+
+def _explain_chunk(path, chunk, n_workers):
+    model, explainer, X = utils.worker_state('explained')
+    if explainer is None and n_workers > 1:
+        model.get_booster().set_param({'nthread': utils.worker_threads(n_workers)})
+
+    _write_chunk(path, chunk, _chunk_values(model, explainer, X.iloc[slice(*chunk)]))
+
+
+def _write_chunk(path, chunk, chunk_values):
+    values = np.load(path, mmap_mode='r+')
+    values[..., slice(*chunk), :] = chunk_values
+    values.flush()
+
+
+def _chunk_values(model, explainer, X):
+    if explainer is None:
+        booster = model.get_booster()
+        dmatrix = xgboost.DMatrix(X, missing=model.missing)
+        contributions = booster.predict(dmatrix, pred_contribs=True, iteration_range=inference.iteration_range(booster))
+        # the last column is the bias, multiclass contributions have shape (rows, classes, features + 1)
+        return np.moveaxis(contributions[..., :-1], -2, 0) if contributions.ndim == 3 else contributions[:, :-1]
+
+    values = explainer.shap_values(X)
+
+    # older shap versions return a list of arrays per class, newer ones an array of shape (rows, features, classes)
+    if isinstance(values, list):
+        return np.stack(values)
+    return np.moveaxis(values, -1, 0) if values.ndim == 3 else values
+
@@ -1,20 +1,29 @@
 import os
 import glob
 import logging
+import itertools
+import collections
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from scipy.sparse import csgraph
+from scipy.sparse import csgraph, csr_matrix, coo_matrix
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import pdist, cdist, squareform
+from sklearn.neighbors import BallTree
 import pyproj
-from shapely import wkt
+import shapely
 from haversine import haversine
 
 import dataset
+import utils
 
 logger = logging.getLogger(__name__)
 
+# mean earth radius as used by the haversine package, so that distances in EPSG:4326 are in km like in distance_matrix()
+EARTH_RADIUS_KM = 6371.0088
+
 
 def to_gdf(df, crs=3035):
     if isinstance(df, gpd.GeoDataFrame):
@@ -24,10 +33,21 @@ def to_gdf(df, crs=3035):
     if type(df['geometry'].dtype) == gpd.array.GeometryDtype:
         return gpd.GeoDataFrame(df)
 
-    geo_wkt = df['geometry'].apply(wkt.loads)
+    geo_wkt = gpd.GeoSeries.from_wkt(df['geometry'], index=df.index)
     return gpd.GeoDataFrame(df, geometry=geo_wkt, crs=crs)
 
 
+def to_wkb(geometry):
+    if not isinstance(geometry.dtype, gpd.array.GeometryDtype):
+        geometry = gpd.GeoSeries(shapely.from_wkt(geometry.where(geometry.notna(), None).values), index=geometry.index)
+
+    return pd.Series(shapely.to_wkb(geometry.values), index=geometry.index)
+
+
+def from_wkb(geometry, crs=3035):
+    return gpd.GeoSeries(shapely.from_wkb(geometry.values), index=geometry.index, crs=crs)
+
+
 def lat_lon_to_gdf(df, crs=3035):
     return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['lon'], df['lat']), crs=4326).to_crs(crs)
 
@@ -43,55 +63,135 @@ def add_geometry_column(df, crs=3035, countries=[]):
     return df_w_geometry.set_index('id')
 
 
-def nearest_neighbors(df, distance_threshold, identifier='id'):
-    neighbors = {}
-    ids = list(df[identifier].values)
-    matrix = distance_matrix(df['geometry'].centroid)
+def nearest_neighbors(df, distance_threshold, identifier='id', sparse=False):
+    index = SpatialIndex(df['geometry'].centroid)
+    graph = index.radius_graph(distance_threshold)
 
-    for building_idx, building_neighbors in enumerate(matrix):
-        neighbors[ids[building_idx]] = [ids[idx] for idx, dis in enumerate(building_neighbors) if dis < distance_threshold and idx != building_idx]
+    if sparse:
+        return graph
 
-    return neighbors
+    return _graph_to_neighbors(graph, df[identifier].values)
 
 
-def knn(df, k, identifier='id'):
-    neighbors = {}
-    ids = list(df[identifier].values)
-    matrix = distance_matrix(df['geometry'].centroid)
+def knn(df, k, identifier='id', sparse=False):
+    index = SpatialIndex(df['geometry'].centroid)
+    graph = index.knn_graph(k)
 
-    for building_idx, building_neighbors in enumerate(matrix):
-        knn_indices = np.argsort(building_neighbors)[1:k+1]
-        neighbors[ids[building_idx]] = [ids[idx] for idx in knn_indices]
+    if sparse:
+        return graph
 
-    return neighbors
+    return _graph_to_neighbors(graph, df[identifier].values)
 
 
-def spatial_buffer_around_block(df, block_type, buffer_size_meters, block_ids=None):
-    if isinstance(df, gpd.GeoDataFrame):
-        gdf = df.copy().to_crs(4326)
-    else:
-        logger.info('Using lat lon coordinates of building instead of full geometry to determine street block centroids. The result may vary slightly.')
-        gdf = gpd.GeoDataFrame(df[['id', block_type]], geometry=gpd.points_from_xy(df['lon'], df['lat']), crs=4326)
+class SpatialIndex:
+    """
+    Spatial index over point geometries to query neighbors in O(n log n) instead of computing a full distance matrix.
+
+    A KD-tree is used for projected coordinates and a ball tree with haversine metric for EPSG:4326. Distances are
+    expressed in CRS units for projected coordinates and in km for EPSG:4326, consistent with distance_matrix().
+    Neighbor graphs are returned as CSR matrices with distances as values and rows / columns in positional order.
+    """
+
+    def __init__(self, geometry):
+        self.geographic = geometry.crs == pyproj.CRS(4326)
+        self.coords = self.coordinates(geometry)
+        self.n = len(self.coords)
+
+        if self.geographic:
+            self.tree = BallTree(self.coords, metric='haversine')
+        else:
+            self.tree = cKDTree(self.coords)
+
+
+    def coordinates(self, geometry):
+        if self.geographic:
+            return np.radians(np.column_stack([geometry.y, geometry.x]))
+
+        return np.column_stack([geometry.x, geometry.y])
+
+
+    def knn_graph(self, k):
+        k = min(k, self.n - 1)
+
+        if k < 1:
+            return csr_matrix((self.n, self.n))
+
+        dis, idx = self.tree.query(self.coords, k=k + 1)
+
+        if self.geographic:
+            dis = dis * EARTH_RADIUS_KM
+
+        # exclude the point itself or, if another point shares its location, the furthest of the k + 1 candidates
+        is_self = idx == np.arange(self.n)[:, None]
+        is_self[~is_self.any(axis=1), -1] = True
+        idx = idx[~is_self].reshape(self.n, k)
+        dis = dis[~is_self].reshape(self.n, k)
+
+        indptr = np.arange(0, self.n * k + 1, k)
+        return csr_matrix((dis.ravel(), idx.ravel(), indptr), shape=(self.n, self.n))
+
+
+    def radius_graph(self, radius, positions=None, inclusive=False):
+        query_coords = self.coords if positions is None else self.coords[positions]
+
+        if self.geographic:
+            idx, dis = self.tree.query_radius(query_coords, r=radius / EARTH_RADIUS_KM, return_distance=True)
+            rows = np.repeat(np.arange(len(query_coords)), [len(i) for i in idx])
+            cols = np.concatenate([*idx, np.empty(0, dtype=int)])
+            dis = np.concatenate([*dis, np.empty(0)]) * EARTH_RADIUS_KM
+        else:
+            query_tree = self.tree if positions is None else cKDTree(query_coords)
+            pairs = query_tree.sparse_distance_matrix(self.tree, radius, output_type='ndarray')
+            rows, cols, dis = pairs['i'], pairs['j'], pairs['v']
+
+        mask = dis <= radius if inclusive else dis < radius
+        mask &= cols != (rows if positions is None else np.asarray(positions)[rows])
+
+        graph = csr_matrix((dis[mask], (rows[mask], cols[mask])), shape=(len(query_coords), self.n))
+        graph.sort_indices()
+        return graph
+
+
+    def within_radius(self, positions, radius, chunk_size=1000):
+        # query in chunks to bound the memory of the intermediate neighbor graph for large blocks such as whole cities
+        neighbors = [
+            self.radius_graph(radius, positions=positions[start:start + chunk_size]).indices
+            for start in range(0, len(positions), chunk_size)
+        ]
+        return np.unique(np.concatenate([*neighbors, np.empty(0, dtype=int)]))
 
-    # improve runtime by considering only buildings from k nearest blocks when determining neighbors instead of all available buildings
-    block_centroids = gdf.dissolve(by=block_type).reset_index()
-    k_nearest_blocks = knn(block_centroids, k=8, identifier=block_type)
 
-    buildings_in_buffer = []
-    for block, nearest_blocks in k_nearest_blocks.items():
-        if block_ids is None or block in block_ids:
-            nearest_blocks_gdf = gdf[gdf[block_type].isin(nearest_blocks)]
-            block_gdf = gdf[gdf[block_type] == block]
-            building_ids = list(nearest_blocks_gdf['id'].values)
+def _graph_to_neighbors(graph, ids):
+    neighbor_ids = np.split(ids[graph.indices], graph.indptr[1:-1])
+    return {id: list(neighbors) for id, neighbors in zip(ids, neighbor_ids)}
 
-            nearest_blocks_geom = nearest_blocks_gdf['geometry'].centroid
-            block_geom = block_gdf['geometry'].centroid
-            matrix = pairwise_distance_matrix(block_geom, nearest_blocks_geom)
 
-            for building_neighbors in matrix:
-                buildings_in_buffer.extend([building_ids[idx] for idx, dis in enumerate(building_neighbors) if dis < buffer_size_meters / 1000])
+def spatial_buffer_around_block(df, block_type, buffer_size_meters, block_ids=None, index=None):
+    # pass a SpatialIndex over building_centroids(df) to reuse it across cross-validation folds
+    index = index or SpatialIndex(building_centroids(df))
 
-    return buildings_in_buffer
+    if index.n != len(df):
+        raise Exception(f'Spatial index covers {index.n} buildings, but the dataset has {len(df)}. Please build the index for the same dataset.')
+
+    radius = buffer_size_meters / 1000 if index.geographic else buffer_size_meters
+    block_positions = df.groupby(block_type, sort=False).indices
+    block_ids = block_positions.keys() if block_ids is None else block_ids
+
+    buffer_mask = np.zeros(len(df), dtype=bool)
+    for block in block_ids:
+        if (positions := block_positions.get(block)) is not None:
+            buffer_mask[positions] = True
+            buffer_mask[index.within_radius(positions, radius)] = True
+
+    return buffer_mask
+
+
+def building_centroids(df):
+    if isinstance(df, gpd.GeoDataFrame):
+        return df['geometry'].centroid
+
+    logger.info('Using lat lon coordinates of building instead of full geometry to determine street block centroids. The result may vary slightly.')
+    return gpd.GeoSeries(gpd.points_from_xy(df['lon'], df['lat']), crs=4326)
 
 
 def distance_matrix(geometry):
@@ -107,8 +207,8 @@ def pairwise_distance_matrix(geometry_1, geometry_2):
     return cdist(coords_1, coords_2, metric)
 
 
-def load_building_geometry(crs=3035, countries=[], cities=[]):
-    gdf = _load_geometry('geom', crs, countries, cities)
+def load_building_geometry(crs=3035, countries=[], cities=[], n_jobs=None):
+    gdf = _load_geometry('geom', crs, countries, cities, n_jobs)
     gdf.drop_duplicates(subset=['id'], inplace=True)
     return gdf
 
@@ -131,16 +231,34 @@ def ensure_same_crs(gdf_1, gdf_2):
     gdf_2 = gdf_2.to_crs(gdf_1.crs)
 
 
-def prepare_street_polygons(crs=3035, countries=[]):
-    gdf_sbb = _load_geometry('sbb', crs, countries)
+def prepare_street_polygons(crs=3035, countries=[], cities=[]):
+    gdf_sbb = _load_geometry('sbb', crs, countries, cities)
     gdf_sbb = gdf_sbb.drop_duplicates(subset=['geometry'])
     gdf_sbb = _merge_intersecting_geometries(gdf_sbb)
     return gdf_sbb.reset_index(drop=True)
 
 
-def _merge_intersecting_geometries(gdf, aggfunc='first'):
-    overlap_matrix = gdf.geometry.apply(lambda x: gdf.intersects(x)).values.astype(int)
-    _, distinct_groups = csgraph.connected_components(overlap_matrix)
+def _merge_intersecting_geometries(gdf, aggfunc='first', tile_size=10000):
+    geoms = np.asarray(gdf.geometry.values)
+    tree = shapely.STRtree(geoms)
+
+    # query intersection candidates tile by tile to bound the memory of the intermediate results
+    tiles = np.floor(np.nan_to_num(shapely.bounds(geoms)[:, :2]) / tile_size)
+    _, tile_idx = np.unique(tiles, axis=0, return_inverse=True)
+    tile_idx = tile_idx.ravel()
+    tile_positions = np.split(np.argsort(tile_idx, kind='stable'), np.cumsum(np.bincount(tile_idx))[:-1])
+
+    rows, cols = [], []
+    for positions in tile_positions:
+        input_idx, tree_idx = tree.query(geoms[positions], predicate='intersects')
+        rows.append(positions[input_idx])
+        cols.append(tree_idx)
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    adjacency = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(len(geoms), len(geoms)))
+    _, distinct_groups = csgraph.connected_components(adjacency, directed=False)
+
     gdf['group'] = distinct_groups
     return gdf.dissolve(by='group', aggfunc=aggfunc)
 
@@ -157,34 +275,72 @@ def _determine_crs(country):
     return int(crs_code)
 
 
-def _load_geometry(type, crs=3035, countries=[], cities=[]):
-    country_dirs = list(os.walk(dataset.DATA_DIR))[0][1]
+def _load_geometry(type, crs=3035, countries=[], cities=[], n_jobs=None):
+    country_dirs = next(os.walk(dataset.DATA_DIR))[1]
     selected_countries = set(countries).intersection(country_dirs) if countries else country_dirs
     gdfs = []
 
     for country in selected_countries:
         if not (country_crs := _determine_crs(country)):
-            logger.warning('CRS for country directory "{country}" not found. Skipping directory.')
+            logger.warning(f'CRS for country directory "{country}" not found. Skipping directory.')
             continue
 
-        files_geom = glob.glob(os.path.join(dataset.DATA_DIR, country, '**', f'*_{type}.csv'), recursive=True)
+        city_files = _city_files(country, type)
 
         if cities:
-            files_geom = [f for f in files_geom if any(city in f for city in cities)]
+            files_geom = [f for city in set(cities) for f in city_files.get(city, [])]
+        else:
+            files_geom = [f for files in city_files.values() for f in files]
 
         if not files_geom:
             continue
 
-        dfs = []
-        for f in files_geom:
-            df = pd.read_csv(f)
-            df['city'] = f.rsplit('/')[-2]
-            dfs.append(df)
-
-        df = pd.concat(dfs, ignore_index=True)
-        df = df.drop_duplicates(subset=['geometry'])
-        country_gdf = to_gdf(df, crs=country_crs).to_crs(crs)
+        cache_files = _cache_city_geometry(files_geom, country_crs, n_jobs)
+        gdf = pd.concat([gpd.read_parquet(f) for f in cache_files], ignore_index=True)
+        gdf = gdf.drop_duplicates(subset=['geometry'])
+        country_gdf = gpd.GeoDataFrame(gdf, crs=country_crs).to_crs(crs)
         country_gdf = country_gdf[country_gdf['geometry'].is_valid]
         gdfs.append(country_gdf)
 
     return pd.concat(gdfs, ignore_index=True).reset_index(drop=True)
+
+
+def _city_files(country, type):
+    city_files = collections.defaultdict(list)
+
+    for f in glob.glob(os.path.join(dataset.DATA_DIR, country, '**', f'*_{type}.csv'), recursive=True):
+        city_files[os.path.basename(os.path.dirname(f))].append(f)
+
+    return city_files
+
+
+def _cache_city_geometry(files, crs, n_jobs=None):
+    # only parse the csv files whose GeoParquet cache is missing or older than the csv file itself
+    outdated_files = [f for f in files if not _city_geometry_cache_valid(f)]
+
+    if outdated_files:
+        logger.info(f'Parsing {len(outdated_files)} of {len(files)} geometry files not yet cached...')
+
+        if n_jobs == 1:
+            list(map(_parse_city_geometry, outdated_files, itertools.repeat(crs)))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(_parse_city_geometry, outdated_files, itertools.repeat(crs), chunksize=16))
+
+    return [_city_geometry_cache_path(f) for f in files]
+
+
+def _city_geometry_cache_path(file):
+    return f'{os.path.splitext(file)[0]}.parquet'
+
+
+def _city_geometry_cache_valid(file):
+    cache_file = _city_geometry_cache_path(file)
+    return os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(file)
+
+
+def _parse_city_geometry(file, crs):
+    df = pd.read_csv(file)
+    df['city'] = os.path.basename(os.path.dirname(file))
+    gdf = gpd.GeoDataFrame(df, geometry=gpd.GeoSeries.from_wkt(df['geometry']), crs=crs)
+    utils.write_atomically(_city_geometry_cache_path(file), gdf.to_parquet)
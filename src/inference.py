@@ -0,0 +1,141 @@
+import os
+import logging
+import pickle
+import collections
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xgboost
+
+import dataset
+import utils
+import artifacts
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+INFERENCE_BATCH_SIZE = 100_000
+
+
+def predict_country(model_path, data, output_path, labels=None, unlabelled_only=True, n_jobs=None, batch_size=INFERENCE_BATCH_SIZE):
+    """
+    Predicts the age of all (unlabelled) buildings of a country dataset and writes id, age and class probabilities to a parquet file.
+
+    The model can be a saved predictor (artifact directory or .pkl) or an xgboost model file, in which case the labels of a classifier have to be passed.
+    The dataset can be a country name, whose parquet cache is used, or a path to a parquet file or directory.
+    Feature batches are read lazily and predicted on a thread pool, so memory is bounded by a few batches regardless of the country size.
+    """
+    booster, labels = load_model(model_path, labels)
+    features = booster.feature_names
+
+    if features is None:
+        raise Exception(f'The model {model_path} does not contain feature names, which are required to select the features from the dataset.')
+
+    columns = ['id', dataset.AGE_ATTRIBUTE, *features] if unlabelled_only else ['id', *features]
+    batches = _feature_batches(data, columns, unlabelled_only, batch_size)
+    predict_batch = partial(_predict_batch, booster, features, labels, iteration_range(booster))
+
+    n_workers = n_jobs or os.cpu_count()
+    n_buildings = 0
+
+    # the file is written with the output schema even if no building is to be predicted
+    with pq.ParquetWriter(output_path, output_schema(labels)) as writer:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for table in _bounded_map(executor, predict_batch, batches, max_pending=2 * n_workers):
+                writer.write_table(table)
+                n_buildings += table.num_rows
+                logger.debug(f'Predicted the age of {n_buildings} buildings...')
+
+    if n_buildings == 0:
+        logger.warning(f'No {"unlabelled " if unlabelled_only else ""}buildings found in {data}. Saved an empty prediction file to {output_path}.')
+    else:
+        logger.info(f'Predicted the age of {n_buildings} buildings and saved them to {output_path}.')
+    return n_buildings
+
+
+def output_schema(labels=None):
+    if labels is None:
+        return pa.schema({'id': pa.string(), 'age': pa.float32()})
+
+    return pa.schema({
+        'id': pa.string(),
+        'age': pa.array(np.asarray(labels)).type,
+        'probabilities': pa.list_(pa.float32(), len(labels)),
+    })
+
+
+def load_model(path, labels=None):
+    if artifacts.is_artifact(path):
+        booster, manifest = artifacts.load_booster(path)
+        return booster, manifest['attributes'].get('labels', labels)
+
+    if path.endswith('.pkl'):
+        predictor = pickle.load(open(path, 'rb'))
+        return predictor.model.get_booster(), getattr(predictor, 'labels', labels)
+
+    booster = xgboost.Booster()
+    booster.load_model(path)
+    return booster, labels
+
+
+def iteration_range(booster):
+    # same trees as used by the sklearn wrapper when predicting with an early stopped model
+    best_iteration = booster.attr('best_iteration')
+    return (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+
+
+def dataset_batches(data, columns, batch_size=INFERENCE_BATCH_SIZE):
+    # data is either a country, whose parquet cache is used, or a path to a parquet file or directory
+    if data in utils.COUNTRY_FILES:
+        return utils.data_cache_batches(data, columns=columns, batch_size=batch_size)
+
+    return utils.parquet_batches(data, columns=columns, batch_size=batch_size)
+
+
+def class_probabilities(prediction):
+    # binary classifiers only predict the probability of the positive class
+    probabilities = np.column_stack([1 - prediction, prediction]) if prediction.ndim == 1 else prediction
+    return probabilities.astype(np.float32)
+
+
+def _feature_batches(data, columns, unlabelled_only, batch_size):
+    for df in dataset_batches(data, columns, batch_size):
+        if unlabelled_only:
+            df = df[df[dataset.AGE_ATTRIBUTE].isna()]
+
+        if len(df):
+            yield df
+
+
+def _bounded_map(executor, func, iterable, max_pending):
+    # like executor.map, but consumes the iterable lazily to bound the number of batches held in memory
+    pending = collections.deque()
+
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def _predict_batch(booster, features, labels, iteration_range, df):
+    prediction = booster.inplace_predict(df[features], iteration_range=iteration_range)
+    ids = pa.array(df['id'].astype(str).values)
+
+    if labels is None:
+        return pa.table({'id': ids, 'age': pa.array(prediction, type=pa.float32())}, schema=output_schema())
+
+    probabilities = class_probabilities(prediction)
+    classes = probabilities.argmax(axis=1)
+
+    return pa.table({
+        'id': ids,
+        'age': pa.array(np.asarray(labels)[classes]),
+        'probabilities': pa.FixedSizeListArray.from_arrays(pa.array(probabilities.ravel()), probabilities.shape[1]),
+    }, schema=output_schema(labels))
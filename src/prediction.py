@@ -1,13 +1,19 @@
 import os
 import sys
+import json
 import gc
 import logging
 import inspect
+import importlib
 import pickle
 import copy
 import time
+import itertools
 import collections
-from functools import wraps
+import tempfile
+import subprocess
+from functools import wraps, partial
+from concurrent.futures import as_completed
 
 import shap
 import pandas as pd
@@ -25,14 +31,456 @@ import utils
 import visualizations
 import preprocessing
 import spatial_autocorrelation
+import spatial_weights
 import geometry
+import energy_modeling
+import artifacts
+import explanations
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+FOLD_EXECUTORS = [None, 'process']
+
+HYPERPARAMETER_SEARCHES = [None, 'halving']
+HALVING_FACTOR = 3
+
+FEATURE_MATRIX_CACHE_SIZE = 8
+# private methods of the xgboost sklearn wrapper used to train with cached feature matrices (see _native_xgboost_supported)
+NATIVE_XGBOOST_HOOKS = ['_create_dmatrix', 'get_xgb_params', 'get_num_boosting_rounds']
+
+HYPERPARAMETER_WARM_START_SIZE = 3
+
+SPATIAL_WEIGHTS_CACHE_SIZE = 4
+
+EXTERNAL_MEMORY_BATCH_SIZE = 200_000
+
+SCHEDULERS = [None, 'local', 'slurm', 'seeds']
+SLURM_POLL_INTERVAL_SECONDS = 60
+SLURM_TIMEOUT_SECONDS = 7 * 24 * 60 * 60
+RUN_LEDGER_FILE = 'ledger.jsonl'
+
+
+class FoldResults:
+    """
+    Store for the test set results of all cross-validation folds, which avoids repeated concatenation of growing frames.
+
+    Target and prediction values are written into arrays preallocated for all buildings of the dataset at the position
+    of the building. The auxiliary variables of each fold are kept as they are and only concatenated once needed.
+    """
+
+    def __init__(self, keys):
+        self.keys = pd.Index(keys)
+        self.tested = np.zeros(len(self.keys), dtype=bool)
+        self.fold_positions = []
+        self.y_test = {}
+        self.y_predict = {}
+        self.aux_vars_test = []
+
+
+    def add(self, fold_idx, y_test, y_predict, aux_vars_test):
+        positions = self.keys.get_indexer(y_test.index)
+
+        if (positions < 0).any() or self.tested[positions].any():
+            raise Exception('Each building of the dataset must be part of at most one cross-validation test fold.')
+
+        self.tested[positions] = True
+        self.fold_positions.append(positions)
+        self._write(self.y_test, y_test, positions)
+
+        if y_predict is not None:
+            self._write(self.y_predict, y_predict, positions)
+
+        aux_vars_test['cv_fold_idx'] = fold_idx
+        self.aux_vars_test.append(aux_vars_test)
+
+
+    def _write(self, columns, df, positions):
+        for col in df.columns:
+            if col not in columns:
+                dtype = df[col].dtype if isinstance(df[col].dtype, np.dtype) else object
+                columns[col] = np.empty(len(self.keys), dtype=dtype)
+            columns[col][positions] = df[col].values
+
+
+    def assign(self, predictor):
+        order = np.concatenate([*self.fold_positions, np.empty(0, dtype=int)])
+        index = self.keys[order]
+
+        predictor.y_test = pd.DataFrame({col: values[order] for col, values in self.y_test.items()}, index=index)
+        predictor.y_predict = pd.DataFrame({col: values[order] for col, values in self.y_predict.items()}, index=index)
+        predictor._set_aux_vars_test_folds(self.aux_vars_test)
+
+
+class FoldMetrics:
+    """
+    Evaluation metrics of all cross-validation folds computed in a single grouped pass over aligned arrays.
+
+    Replaces re-slicing the test set results per fold and metric. Each metric returns a list with one value per fold,
+    ordered by fold index, like the metric called with across_folds=True did.
+    """
+
+    def __init__(self, predictor):
+        self.target_attribute = predictor.target_attribute
+        self.labels = getattr(predictor, 'labels', None)
+        self.y_test = predictor.y_test
+        self.y_predict = predictor.y_predict
+        self.aux_vars_test = predictor.aux_vars_test
+
+        if not self.y_predict.index.equals(self.y_test.index):
+            self.y_predict = self.y_predict.loc[self.y_test.index]
+
+        fold_idx = self.aux_vars_test['cv_fold_idx'].reindex(self.y_test.index).values
+        self.folds, self.codes = np.unique(fold_idx, return_inverse=True)
+        self.n_folds = len(self.folds)
+        self.counts = self._sum(np.ones(len(self.codes)))
+
+        self.true = self.y_test[self.target_attribute].values
+        self.predicted = self.y_predict[self.target_attribute].values
+        self.residuals = self.true.astype(float) - self.predicted.astype(float)
+
+
+    def _sum(self, values, codes=None):
+        codes = self.codes if codes is None else codes
+        return np.bincount(codes, weights=values, minlength=self.n_folds)
+
+
+    def _mean(self, values, codes=None):
+        codes = self.codes if codes is None else codes
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self._sum(values, codes) / np.bincount(codes, minlength=self.n_folds)
+
+
+    def _r2(self, true, predicted, codes=None):
+        codes = self.codes if codes is None else codes
+        counts = np.bincount(codes, minlength=self.n_folds)
+        ss_res = self._sum((true - predicted) ** 2, codes)
+        ss_tot = self._sum((true - self._mean(true, codes)[codes]) ** 2, codes)
+
+        # same handling of constant targets as metrics.r2_score
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r2 = np.where(ss_tot != 0, 1 - ss_res / ss_tot, np.where(ss_res == 0, 1.0, 0.0))
+        return list(np.where(counts < 2, np.nan, r2))
+
+
+    def _central_moments(self):
+        deviations = self.residuals - self._mean(self.residuals)[self.codes]
+        return self._mean(deviations ** 2), self._mean(deviations ** 3), self._mean(deviations ** 4)
+
+
+    def r2(self):
+        return self._r2(self.true.astype(float), self.predicted.astype(float))
+
+
+    def mae(self):
+        return list(self._mean(np.abs(self.residuals)))
+
+
+    def rmse(self):
+        return list(np.sqrt(self._mean(self.residuals ** 2)))
+
+
+    def skew(self):
+        m2, m3, _ = self._central_moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return list(m3 / m2 ** 1.5)
+
+
+    def kurtosis(self):
+        m2, _, m4 = self._central_moments()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return list(m4 / m2 ** 2 - 3)
+
+
+    def error_cum_hist(self, bins):
+        # bins are half-open except for the last one like in np.histogram
+        n_bins = len(bins) - 1
+        errors = np.abs(self.residuals)
+        bin_idx = np.searchsorted(bins, errors, side='right') - 1
+        bin_idx[errors == bins[-1]] = n_bins - 1
+        valid = (bin_idx >= 0) & (bin_idx < n_bins)
+
+        hist = np.bincount(self.codes[valid] * n_bins + bin_idx[valid], minlength=self.n_folds * n_bins)
+        hist = hist.reshape(self.n_folds, n_bins) / self.counts[:, np.newaxis]
+        return list(np.cumsum(hist, axis=1))
+
+
+    def mcc(self, bins=None):
+        if bins is None:
+            true, predicted = self.true, self.predicted
+        else:
+            # same categories as pd.cut(..., right=False) with -1 for values outside of the bins
+            true, predicted = [
+                np.where((idx >= 0) & (idx < len(bins) - 1), idx, -1)
+                for idx in [np.searchsorted(bins, values, side='right') - 1 for values in [self.true, self.predicted]]
+            ]
+
+        classes, encoded = np.unique(np.concatenate([true, predicted]), return_inverse=True)
+        n_classes = len(classes)
+        true, predicted = encoded[:len(true)], encoded[len(true):]
+
+        confusion = np.bincount((self.codes * n_classes + true) * n_classes + predicted, minlength=self.n_folds * n_classes ** 2)
+        confusion = confusion.reshape(self.n_folds, n_classes, n_classes).astype(float)
+
+        # multiclass formula of metrics.matthews_corrcoef
+        t_sum = confusion.sum(axis=2)
+        p_sum = confusion.sum(axis=1)
+        n_correct = np.trace(confusion, axis1=1, axis2=2)
+        n_samples = confusion.sum(axis=(1, 2))
+        cov_ytyp = n_correct * n_samples - (t_sum * p_sum).sum(axis=1)
+        cov_ypyp = n_samples ** 2 - (p_sum * p_sum).sum(axis=1)
+        cov_ytyt = n_samples ** 2 - (t_sum * t_sum).sum(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return list(np.where(cov_ypyp * cov_ytyt == 0, 0.0, cov_ytyp / np.sqrt(cov_ytyt * cov_ypyp)))
+
+
+    def energy_error(self):
+        try:
+            y_true = pd.concat([self.y_test, self.aux_vars_test], axis=1, join='inner')
+            y_pred = pd.concat([self.y_predict, self.aux_vars_test], axis=1, join='inner')
+            y_true = energy_modeling.assign_heating_energy_demand(y_true, self.labels)
+            y_pred = energy_modeling.assign_heating_energy_demand(y_pred, self.labels)
+        except Exception as e:
+            logger.error(f'Failed to calculate energy error: {e}')
+            return [(np.nan, np.nan)] * self.n_folds
+
+        ids = y_true.index.intersection(y_pred.index)
+        true = y_true.loc[ids, 'heating_demand'].values.astype(float)
+        predicted = y_pred.loc[ids, 'heating_demand'].values.astype(float)
+        codes = np.searchsorted(self.folds, y_true.loc[ids, 'cv_fold_idx'].values)
+
+        r2 = self._r2(true, predicted, codes)
+        mape = self._mean(np.abs(true - predicted) / np.maximum(np.abs(true), np.finfo(np.float64).eps), codes)
+        return list(zip(r2, mape))
+
+
+class FeatureMatrixCache:
+    """
+    Least recently used cache of the XGBoost feature matrices of a process.
+
+    The (quantile) DMatrix of a feature matrix is built once and reused by all predictors training on the same data,
+    e.g. across experiments, seeds and hyperparameter candidates, instead of being re-quantized for every fit.
+    Matrices are identified by their content including the row order and the matrix parameters of the model.
+    """
+
+    def __init__(self, max_size=FEATURE_MATRIX_CACHE_SIZE):
+        self.max_size = max_size
+        self.matrices = collections.OrderedDict()
+
+
+    def get(self, model, X, y=None, sample_weight=None, ref=None, fingerprint=None):
+        params = model.get_params()
+        ref_key = next((k for k, matrix in self.matrices.items() if matrix is ref), None)
+        key = (
+            fingerprint or utils.data_fingerprint(X, y, sample_weight),
+            tuple(params.get(p) for p in ['tree_method', 'max_bin', 'missing', 'enable_categorical', 'feature_types', 'booster']),
+            ref_key,
+        )
+
+        if key in self.matrices:
+            self.matrices.move_to_end(key)
+            return self.matrices[key]
+
+        # same matrix type and parameters as the sklearn wrapper uses for fitting
+        matrix = model._create_dmatrix(
+            data=X,
+            label=y,
+            weight=sample_weight,
+            missing=model.missing,
+            enable_categorical=model.enable_categorical,
+            feature_types=model.feature_types,
+            ref=ref,
+        )
+
+        # matrices quantized with a reference matrix which is no longer cached can not be identified reliably
+        if ref is None or ref_key is not None:
+            self.matrices[key] = matrix
+
+        while len(self.matrices) > self.max_size:
+            self.matrices.popitem(last=False)
+
+        return matrix
+
+
+    def clear(self):
+        self.matrices.clear()
+
+
+# feature matrices shared by all predictors of a process
+_feature_matrices = FeatureMatrixCache()
+
+
+class SpatialWeightsCache:
+    """
+    Least recently used cache of the spatial weights of test sets.
+
+    Weights are built once per test split and weight type and reused by all predictors evaluated on the same split,
+    e.g. across experiments and seeds, including the geometries of the test buildings, which are parsed only once.
+    Test splits are identified by the set of ids of their buildings, since their order depends on the seed. Weights are
+    kept in the order of the sorted ids and permuted to the order of the given test set.
+    """
+
+    def __init__(self, max_size=SPATIAL_WEIGHTS_CACHE_SIZE):
+        self.max_size = max_size
+        self.splits = collections.OrderedDict()
+
+
+    def get(self, df, type):
+        order = np.argsort(df['id'].values, kind='stable')
+        df = df.iloc[order]
+        key = utils.data_fingerprint(df['id'].reset_index(drop=True))
+
+        if key not in self.splits:
+            self.splits[key] = {}
+        self.splits.move_to_end(key)
+
+        while len(self.splits) > self.max_size:
+            self.splits.popitem(last=False)
+
+        split = self.splits[key]
+        if type not in split:
+            logger.info(f'Building {type} weights of {len(df)} test buildings...')
+            weights = spatial_autocorrelation.weights(self._geodataframe(split, df) if type != 'block' else self._blocks(df), type)
+            split[type] = spatial_weights.to_sparse(weights)
+
+        # position of each building of the given test set among the sorted ids
+        positions = np.empty(len(order), dtype=np.int64)
+        positions[order] = np.arange(len(order))
+        return spatial_weights.to_graph(split[type][positions][:, positions])
+
+
+    def _geodataframe(self, split, df):
+        if 'gdf' not in split:
+            split['gdf'] = geometry.to_gdf(df[['id', 'geometry']].reset_index(drop=True))
+        return split['gdf']
+
+
+    def _blocks(self, df):
+        # only the columns required to identify the blocks of buildings
+        return df[[c for c in ['id', 'block', 'block_bld_ids', 'city', 'TouchesIndexes'] if c in df.columns]].reset_index(drop=True)
+
+
+    def clear(self):
+        self.splits.clear()
+
+
+class HyperparameterTuningStore:
+    """
+    Persistent store of the hyperparameter candidates evaluated for a tuning configuration, i.e. the model, features,
+    preprocessing stages, split function and scoring, with one json file per configuration in the given directory.
+
+    Evaluations are kept per training data sample together with their time. Candidates already evaluated on the same
+    sample are not evaluated again and the best candidates found on the most recently evaluated other samples are
+    evaluated first.
+    """
+
+    def __init__(self, path, config, data_fingerprint):
+        self.path = os.path.join(path, f'hyperparameter-tuning-{utils.config_hash(config)}.json')
+        self.config = config
+        self.data_fingerprint = data_fingerprint
+
+
+    def evaluations(self):
+        return self._read()['evaluations'].get(self.data_fingerprint, [])
+
+
+    def warm_start(self, candidates):
+        evaluations = self._read()['evaluations']
+        evaluated = [evaluation['params'] for evaluation in evaluations.get(self.data_fingerprint, [])]
+        # samples ordered by their latest evaluation, most recent first
+        other_samples = sorted(
+            (sample_evaluations for fingerprint, sample_evaluations in evaluations.items() if fingerprint != self.data_fingerprint and sample_evaluations),
+            key=lambda sample_evaluations: max(evaluation.get('evaluated_at', 0) for evaluation in sample_evaluations), reverse=True)
+        prior_best = [
+            max(sample_evaluations, key=lambda evaluation: evaluation['mean_test_score'])['params']
+            for sample_evaluations in other_samples[:HYPERPARAMETER_WARM_START_SIZE]
+        ]
+
+        warm_start_candidates = []
+        for params in prior_best + candidates:
+            if params not in evaluated and params not in warm_start_candidates:
+                warm_start_candidates.append(params)
+
+        logger.info(f'Hyperparameter tuning store {self.path}: {len(evaluated)} candidates evaluated previously on the same sample, '
+                    f'{len(prior_best)} best candidates of other samples, {len(warm_start_candidates)} candidates to evaluate.')
+        return warm_start_candidates
+
+
+    def add(self, results):
+        # only evaluations with the full budget are comparable across searches
+        if 'n_resources' in results:
+            results = results[results['n_resources'] == 1]
+
+        split_columns = sorted(c for c in results.columns if c.startswith('split') and c.endswith('_test_score'))
+        store = self._read()
+        evaluated_at = time.time()
+        store['evaluations'].setdefault(self.data_fingerprint, []).extend({
+            'params': row['params'],
+            'evaluated_at': evaluated_at,
+            'mean_test_score': row['mean_test_score'],
+            'std_test_score': row['std_test_score'],
+            'mean_fit_time': row['mean_fit_time'],
+            'split_test_scores': [row[c] for c in split_columns],
+        } for _, row in results.iterrows())
+
+        utils.write_atomically(self.path, partial(artifacts.write_json, store))
+
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {'config': utils.config_repr(self.config), 'evaluations': {}}
+
+        return artifacts.read_json(self.path)
+
+
+    @staticmethod
+    def merge(results, evaluations):
+        # stored evaluations are added to the results of a search to select the best candidate among all of them
+        stored = pd.DataFrame([{
+            'params': evaluation['params'],
+            'mean_test_score': evaluation['mean_test_score'],
+            'std_test_score': evaluation['std_test_score'],
+            'mean_fit_time': evaluation['mean_fit_time'],
+            **{f'split{idx}_test_score': score for idx, score in enumerate(evaluation['split_test_scores'])},
+        } for evaluation in evaluations])
+
+        results = pd.concat([results.assign(stored=False), stored.assign(stored=True)], ignore_index=True)
+        for name in sorted(set().union(*results['params'])):
+            results[f'param_{name}'] = [params.get(name) for params in results['params']]
+        results['rank_test_score'] = stats.rankdata(-results['mean_test_score'], method='min').astype(np.int32)
+        return results
+
 
 class Predictor:
 
+    # training state not required to evaluate a trained predictor
+    TRAINING_ATTRIBUTES = ['df', 'df_test', 'df_train', 'X_train', 'y_train', 'sample_weights', 'aux_vars_train', 'test_set']
+
+    # fold state which remains on the predictor after the last cross-validation fold
+    FOLD_ATTRIBUTES = [
+        'df_train', 'df_test', 'X_train', 'y_train', 'X_test', 'y_test', 'y_predict', 'aux_vars_train', 'aux_vars_test',
+        'model', 'evals_result', 'sample_weights', 'hyperparameters', 'hyperparameter_tuning_results',
+    ]
+
+    # metrics which FoldMetrics computes for all cross-validation folds at once
+    FOLD_METRICS = []
+
+    # results saved as separate parts of an artifact directory (see artifacts.py), which are read on first access
+    ARTIFACT_PARTS = {
+        'X_test': 'frame',
+        'y_test': 'frame',
+        'y_predict': 'frame',
+        'aux_vars_test': 'frame',
+        'shap_values': 'array',
+        'shap_rows': 'array',
+        'evals_result': 'json',
+        'hyperparameter_tuning_results': 'json',
+    }
+
+    # parts of a results only artifact, e.g. the run records of a comparison, which contain neither model nor features
+    RESULT_PARTS = ['y_test', 'y_predict', 'aux_vars_test', 'shap_values', 'evals_result']
+
     def __init__(
             self,
             model,
@@ -49,9 +497,24 @@ class Predictor:
             hyperparameter_n_iter=20,
             hyperparameter_tuning_space=None,
             hyperparameter_tuning_only=False,
+            hyperparameter_search=None,
+            hyperparameter_tuning_store=None,
             hyperparameters=None,
+            n_jobs=None,
+            fold_executor=None,
+            cache_feature_matrices=False,
+            external_memory=False,
+            shap_sample_size=None,
+            shap_native=False,
+            output_dir='.',
             initialize_only=False) -> None:
 
+        if fold_executor not in FOLD_EXECUTORS:
+            raise Exception(f'Unknown fold_executor {fold_executor}. Please use one of {FOLD_EXECUTORS}.')
+
+        if hyperparameter_search not in HYPERPARAMETER_SEARCHES:
+            raise Exception(f'Unknown hyperparameter_search {hyperparameter_search}. Please use one of {HYPERPARAMETER_SEARCHES}.')
+
         self.model = model
         self.df = df
         self.frac = frac
@@ -66,7 +529,16 @@ class Predictor:
         self.hyperparameter_n_iter = hyperparameter_n_iter
         self.hyperparameter_tuning_space = hyperparameter_tuning_space
         self.hyperparameter_tuning_only = hyperparameter_tuning_only
+        self.hyperparameter_search = hyperparameter_search
+        self.hyperparameter_tuning_store = hyperparameter_tuning_store
         self.hyperparameters = hyperparameters
+        self.n_jobs = n_jobs
+        self.fold_executor = fold_executor
+        self.cache_feature_matrices = cache_feature_matrices
+        self.external_memory = external_memory
+        self.shap_sample_size = shap_sample_size
+        self.shap_native = shap_native
+        self.output_dir = output_dir
         self.uuid = utils.truncated_uuid4()
 
         self.X_train = None
@@ -75,8 +547,8 @@ class Predictor:
         self.y_test = None
         self.y_predict = None
         self.evals_result = None
-        self.shap_explainer = None
         self.shap_values = None
+        self.shap_rows = None
         self.sample_weights = None
         self.hyperparameter_tuning_results = None
 
@@ -99,6 +571,10 @@ class Predictor:
 
 
     def _load(self):
+        if self.external_memory:
+            self._load_external_memory()
+            return
+
         if isinstance(self.df, str):
             self.df = utils.load_df(self.df)
 
@@ -111,6 +587,37 @@ class Predictor:
         self.df.reset_index(drop=True, inplace=True)
 
 
+    def _load_external_memory(self):
+        if not self._xgboost_model() or not _native_xgboost_supported(self.model) or self.hyperparameter_tuning_space or self.test_set is not None:
+            raise Exception('External memory training requires an xgboost model without custom objective or metrics and supports neither hyperparameter tuning nor a separate test_set.')
+
+        self.countries = [self.df] if isinstance(self.df, str) else list(self.df)
+        unknown_countries = set(self.countries) - set(utils.COUNTRY_FILES)
+        if unknown_countries:
+            raise Exception(f'External memory training requires the df to be one or more of the countries {list(utils.COUNTRY_FILES)}, but got {unknown_countries}.')
+
+        # only the non-feature columns are kept in memory, the features are streamed from the parquet caches when needed
+        country_dfs = []
+        n_streamed = 0
+        for country in self.countries:
+            country_df = pd.concat(utils.data_cache_batches(country, exclude_columns=dataset.FEATURES, batch_size=EXTERNAL_MEMORY_BATCH_SIZE), ignore_index=True)
+            country_df['stream_row'] = n_streamed + np.arange(len(country_df))
+            n_streamed += len(country_df)
+            # rows in the order of the pickles, while their features are addressed by the position in the stream
+            country_dfs.append(country_df.sort_values(by=utils.CACHE_ROW_COLUMN, kind='stable').drop(columns=utils.CACHE_ROW_COLUMN))
+        self.df = pd.concat(country_dfs, ignore_index=True)
+
+        if self.frac or self.n_cities:
+            self.df = utils.sample_cities(self.df, frac=self.frac, n=self.n_cities)
+
+        self.df.reset_index(drop=True, inplace=True)
+
+
+    def _external_memory_feature_cols(self):
+        columns = [utils.data_cache_columns(country) for country in self.countries]
+        return [c for c in columns[0] if c in dataset.FEATURES and all(c in country_columns for country_columns in columns)]
+
+
     def _clean(self):
         self.df.dropna(subset=[self.target_attribute], inplace=True)
         self.df.drop_duplicates(subset=['PropertyKey_ID'], inplace=True)
@@ -157,6 +664,10 @@ class Predictor:
         self.df_train = self.df_train.set_index('PropertyKey_ID', drop=False)
         self.df_test = self.df_test.set_index('PropertyKey_ID', drop=False)
 
+        if self.external_memory:
+            self._preprocess_external_memory()
+            return
+
         feature_cols = list(self.df_test.columns.intersection(dataset.FEATURES))
 
         self.aux_vars_train = self.df_train.drop(columns=feature_cols + [self.target_attribute])
@@ -169,6 +680,23 @@ class Predictor:
         self.y_test = self.df_test[[self.target_attribute]]
 
 
+    def _preprocess_external_memory(self):
+        self.feature_cols = self._external_memory_feature_cols()
+
+        self.aux_vars_train = self.df_train.drop(columns=[self.target_attribute])
+        self.aux_vars_test = self.df_test.drop(columns=[self.target_attribute])
+
+        # the training features are streamed during training, only the features of the test set are loaded
+        self.X_train = None
+        self.y_train = self.df_train[[self.target_attribute]]
+
+        rows = self.df_test['stream_row'].values
+        order = np.argsort(rows)
+        X_test = pd.concat([X for _, _, X in _stream_rows(self.countries, self.feature_cols, rows[order])] or [pd.DataFrame(columns=self.feature_cols)])
+        self.X_test = X_test.iloc[np.argsort(order)].set_axis(self.df_test.index)
+        self.y_test = self.df_test[[self.target_attribute]]
+
+
 
     def _train(self):
         if self.mitigate_class_imbalance:
@@ -191,6 +719,10 @@ class Predictor:
             self._tune_hyperparameters(fit_params)
             return
 
+        if self.external_memory:
+            self._train_external_memory(model_params)
+            return
+
         if self.hyperparameters:
             model_params = {**model_params, **self.hyperparameters}
 
@@ -207,12 +739,44 @@ class Predictor:
             model_params['verbose'] = 2 if utils.verbose() else 0
 
         self.model.set_params(**model_params)
-        self.model.fit(**fit_params)
+
+        if self._native_xgboost_training():
+            dtrain, evals = _xgboost_matrices(self.model, **fit_params)
+            _fit_xgboost(self.model, dtrain, self.y_train, evals, fit_params.get('early_stopping_rounds'), fit_params['verbose'])
+        else:
+            self.model.fit(**fit_params)
 
         if self._xgboost_model():
             self.evals_result = self.model.evals_result()
 
 
+    def _train_external_memory(self, model_params):
+        if self.hyperparameters:
+            model_params = {**model_params, **self.hyperparameters}
+        self.model.set_params(**model_params)
+
+        # the iterator yields the training rows in the order of the parquet caches
+        rows = self.df_train['stream_row'].values
+        order = np.argsort(rows)
+        label = self.y_train[self.target_attribute].values[order]
+        weight = None if self.sample_weights is None else self.sample_weights[order]
+        early_stopping_rounds = max(50, self.model.n_estimators / 10) if self.early_stopping else None
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            iterator = FeatureStreamIter(self.countries, self.feature_cols, rows[order], label, weight, cache_prefix=os.path.join(cache_dir, 'cache'))
+            dtrain = xgboost.DMatrix(iterator, missing=self.model.missing, nthread=self.model.n_jobs)
+            dtest = xgboost.DMatrix(self.X_test, self.y_test, missing=self.model.missing, nthread=self.model.n_jobs)
+            evals = [(dtrain, 'validation_0'), (dtest, 'validation_1')]
+
+            _fit_xgboost(self.model, dtrain, self.y_train, evals, early_stopping_rounds, utils.verbose())
+
+            # release the external memory pages before their directory is removed
+            del dtrain, dtest, evals, iterator
+            gc.collect()
+
+        self.evals_result = self.model.evals_result()
+
+
     def _predict(self):
         if not self.hyperparameter_tuning_only:
             self.y_predict = pd.DataFrame(
@@ -230,39 +794,209 @@ class Predictor:
         else:
             inner_cv = preprocessing.N_CV_SPLITS
 
-        if grid:
-            clf = model_selection.GridSearchCV(
-                estimator=self.model,
-                param_grid=self.hyperparameter_tuning_space,
-                verbose=2,
-                cv=inner_cv,
-                return_train_score=True,
-                random_state=dataset.GLOBAL_REPRODUCIBILITY_SEED
-            )
+        candidates = self._hyperparameter_candidates(grid)
+        store = self._hyperparameter_tuning_store(fit_params, candidates, grid)
+        stored_evaluations = store.evaluations() if store else []
+
+        if store:
+            candidates = store.warm_start(candidates)
+
+        if not candidates:
+            results = {}
+        elif self.hyperparameter_search == 'halving':
+            results = self._halving_search(fit_params, inner_cv, grid, candidates)
+        elif self._native_xgboost_training():
+            results = self._search_hyperparameters(fit_params, inner_cv, grid, candidates)
         else:
             # TODO remove scoring='neg_root_mean_squared_error' to use estimator's score method
             # (however it uses R2 although reg:squarederror is default for xgboost regression)
-            clf = model_selection.RandomizedSearchCV(
+            clf = model_selection.GridSearchCV(
                 estimator=self.model,
-                n_iter=self.hyperparameter_n_iter,
-                param_distributions=self.hyperparameter_tuning_space,
-                scoring='neg_root_mean_squared_error',
-                verbose=3,
+                param_grid=[{name: [value] for name, value in params.items()} for params in candidates],
+                scoring=self._hyperparameter_scoring(grid),
+                verbose=2 if grid else 3,
                 cv=inner_cv,
                 return_train_score=True,
-                random_state=dataset.GLOBAL_REPRODUCIBILITY_SEED
+                refit=False,
             )
+            clf.fit(**fit_params)
+            results = clf.cv_results_
+
+        results = pd.DataFrame(results)
+        if store:
+            store.add(results)
+            results = HyperparameterTuningStore.merge(results, stored_evaluations)
+
+        # candidates of a successive halving search appear once per round, only their scores with the full budget are compared
+        full_budget = ~(results['n_resources'] < 1) if 'n_resources' in results else np.ones(len(results), dtype=bool)
+        best_idx = results['mean_test_score'].where(full_budget).idxmax()
+        self.hyperparameters = results['params'][best_idx]
+        self.hyperparameter_tuning_results = {name: values.tolist() if name == 'params' else values.values for name, values in results.items()}
+
+        self.model = sklearn.base.clone(self.model).set_params(**self.hyperparameters)
+        if self._native_xgboost_training():
+            _fit_xgboost(self.model, _feature_matrices.get(self.model, fit_params['X'], fit_params['y'], fit_params['sample_weight']), fit_params['y'])
+        else:
+            self.model.fit(**fit_params)
+
+        logger.info(f'Best hyperparameters: {self.hyperparameters}')
+        logger.info(f'Corresponding score: {results["mean_test_score"][best_idx]}')
+        results.to_csv(self._output_path('hyperparameter-tuning-results'), sep='\t')
+
+
+    def _hyperparameter_candidates(self, grid):
+        if grid:
+            return list(model_selection.ParameterGrid(self.hyperparameter_tuning_space))
 
-        clf.fit(**fit_params)
+        return list(model_selection.ParameterSampler(
+            self.hyperparameter_tuning_space, self.hyperparameter_n_iter, random_state=dataset.GLOBAL_REPRODUCIBILITY_SEED))
 
-        self.model = clf.best_estimator_
-        self.hyperparameter_tuning_results = clf.cv_results_
-        self.hyperparameters = clf.best_params_
 
-        logger.info(f'Best hyperparameters: {clf.best_params_}')
-        logger.info(f'Corresponding score: {clf.best_score_}')
-        timestr = time.strftime('%Y%m%d-%H-%M-%S')
-        pd.DataFrame(clf.cv_results_).to_csv(f'hyperparameter-tuning-results-{timestr}.csv', sep='\t')
+    def _hyperparameter_scoring(self, grid):
+        return None if grid else 'neg_root_mean_squared_error'
+
+
+    def _hyperparameter_tuning_store(self, fit_params, candidates, grid):
+        if not self.hyperparameter_tuning_store:
+            return None
+
+        tuned_params = set().union(*candidates)
+        config = {
+            'model': type(self.model).__name__,
+            'model_params': {k: v for k, v in self.model.get_params().items() if k not in tuned_params and k != 'n_jobs'},
+            'features': list(fit_params['X'].columns),
+            'target_attribute': self.target_attribute,
+            'preprocessing_stages': self.preprocessing_stages,
+            'cross_validation_split': self.cross_validation_split,
+            'mitigate_class_imbalance': self.mitigate_class_imbalance,
+            'scoring': self._hyperparameter_scoring(grid),
+        }
+        # the sample is identified by its buildings regardless of their (seed dependent) order
+        data_fingerprint = utils.data_fingerprint(fit_params['X'].sort_index(), fit_params['y'].sort_index())
+        return HyperparameterTuningStore(self.hyperparameter_tuning_store, config, data_fingerprint)
+
+
+    def _search_hyperparameters(self, fit_params, inner_cv, grid, candidates):
+        # same search as GridSearchCV, but the feature matrices of each inner split are only built once for all candidates
+        X, y, sample_weight = fit_params['X'], fit_params['y'], fit_params['sample_weight']
+        scorer = metrics.check_scoring(self.model, self._hyperparameter_scoring(grid))
+
+        cv = model_selection.check_cv(inner_cv, y, classifier=sklearn.base.is_classifier(self.model))
+        splits = list(cv.split(X, y))
+        test_scores = np.empty((len(candidates), len(splits)))
+        train_scores = np.empty((len(candidates), len(splits)))
+        fit_times = np.empty((len(candidates), len(splits)))
+
+        for split_idx, (train_idx, test_idx) in enumerate(splits):
+            X_train, y_train = X.iloc[train_idx], y.iloc[train_idx]
+            X_test, y_test = X.iloc[test_idx], y.iloc[test_idx]
+            weights = None if sample_weight is None else sample_weight[train_idx]
+            fingerprint = utils.data_fingerprint(X_train, y_train, weights)
+
+            for candidate_idx, params in enumerate(candidates):
+                model = sklearn.base.clone(self.model).set_params(**params)
+
+                time_start = time.time()
+                dtrain = _feature_matrices.get(model, X_train, y_train, weights, fingerprint=fingerprint)
+                _fit_xgboost(model, dtrain, y_train)
+                fit_times[candidate_idx, split_idx] = time.time() - time_start
+
+                test_scores[candidate_idx, split_idx] = scorer(model, X_test, y_test)
+                train_scores[candidate_idx, split_idx] = scorer(model, X_train, y_train)
+                logger.info(f'[CV {split_idx + 1}/{len(splits)}] {params}; score: (train={train_scores[candidate_idx, split_idx]:.3f}, test={test_scores[candidate_idx, split_idx]:.3f})')
+
+        results = {
+            'mean_fit_time': fit_times.mean(axis=1),
+            'std_fit_time': fit_times.std(axis=1),
+            **{f'param_{name}': [params.get(name) for params in candidates] for name in sorted(set().union(*candidates))},
+            'params': candidates,
+            **{f'split{idx}_test_score': test_scores[:, idx] for idx in range(len(splits))},
+            'mean_test_score': test_scores.mean(axis=1),
+            'std_test_score': test_scores.std(axis=1),
+            'rank_test_score': stats.rankdata(-test_scores.mean(axis=1), method='min').astype(np.int32),
+            **{f'split{idx}_train_score': train_scores[:, idx] for idx in range(len(splits))},
+            'mean_train_score': train_scores.mean(axis=1),
+            'std_train_score': train_scores.std(axis=1),
+        }
+        return results
+
+
+    def _halving_search(self, fit_params, inner_cv, grid, candidates):
+        """
+        Successive halving: all candidates are evaluated on the inner splits with a small budget and only the best
+        1 / HALVING_FACTOR advance to the next round, whose budget is HALVING_FACTOR times larger. The budget is the
+        fraction of both the training rows of each inner split and the boosting rounds, so that only the last round fits
+        the remaining candidates with their full n_estimators on all rows.
+
+        The fits of a round run in forked worker processes and their scores are logged and appended to a csv file as they complete.
+        """
+        X, y, sample_weight = fit_params['X'], fit_params['y'], fit_params['sample_weight']
+        scorer = metrics.check_scoring(self.model, self._hyperparameter_scoring(grid))
+
+        cv = model_selection.check_cv(inner_cv, y, classifier=sklearn.base.is_classifier(self.model))
+        splits = list(cv.split(X, y))
+
+        # nested training subsets of each inner split, so that a larger budget extends the rows of the previous round
+        rng = np.random.default_rng(dataset.GLOBAL_REPRODUCIBILITY_SEED)
+        splits = [(rng.permutation(train_idx), test_idx) for train_idx, test_idx in splits]
+
+        n_rounds = int(np.log(len(candidates)) / np.log(HALVING_FACTOR) + 1e-9) + 1
+        n_workers = self.n_jobs or os.cpu_count()
+        progress_path = self._output_path('hyperparameter-tuning-progress')
+        results = collections.defaultdict(list)
+        remaining = list(range(len(candidates)))
+
+        # the predictor and inner splits are shared with the forked tuning worker processes
+        with utils.shared_worker_state(halving_search_state=(self, X, y, sample_weight, splits, scorer, n_workers)):
+            for round_idx in range(n_rounds):
+                budget = float(HALVING_FACTOR) ** (round_idx - n_rounds + 1)
+                logger.info(f'Successive halving round {round_idx + 1}/{n_rounds}: {len(remaining)} candidates with a budget of {budget:.3f}...')
+
+                tasks = [(idx, split_idx) for idx in remaining for split_idx in range(len(splits))]
+                scores = {}
+                for (idx, split_idx), score in _halving_tasks(candidates, tasks, budget, n_workers):
+                    scores[idx, split_idx] = score
+                    self._log_halving_score(progress_path, round_idx, budget, candidates[idx], split_idx, *score)
+
+                round_test_scores = []
+                for idx in remaining:
+                    fit_times, train_scores, test_scores = np.array([scores[idx, split_idx] for split_idx in range(len(splits))]).T
+                    results['iter'].append(round_idx)
+                    results['n_resources'].append(budget)
+                    results['params'].append(candidates[idx])
+                    results['mean_fit_time'].append(fit_times.mean())
+                    results['std_fit_time'].append(fit_times.std())
+                    for split_idx in range(len(splits)):
+                        results[f'split{split_idx}_test_score'].append(test_scores[split_idx])
+                        results[f'split{split_idx}_train_score'].append(train_scores[split_idx])
+                    results['mean_test_score'].append(test_scores.mean())
+                    results['std_test_score'].append(test_scores.std())
+                    results['mean_train_score'].append(train_scores.mean())
+                    results['std_train_score'].append(train_scores.std())
+                    round_test_scores.append(test_scores.mean())
+
+                n_advancing = max(1, int(np.ceil(len(remaining) / HALVING_FACTOR)))
+                remaining = [remaining[idx] for idx in np.argsort(round_test_scores, kind='stable')[::-1][:n_advancing]]
+
+        for name in sorted(set().union(*candidates)):
+            results[f'param_{name}'] = [params.get(name) for params in results['params']]
+        results = {name: np.array(values) if name != 'params' else values for name, values in results.items()}
+        results['rank_test_score'] = stats.rankdata(-results['mean_test_score'], method='min').astype(np.int32)
+        return results
+
+
+    def _output_path(self, name):
+        # outputs like tuning results are written to the output directory, e.g. next to the runs of a comparison
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(self.output_dir, f'{name}-{time.strftime("%Y%m%d-%H-%M-%S")}-{self.uuid}.csv')
+
+
+    def _log_halving_score(self, path, round_idx, budget, params, split_idx, fit_time, train_score, test_score):
+        logger.info(f'[Round {round_idx + 1}, CV {split_idx + 1}] {params}; score: (train={train_score:.3f}, test={test_score:.3f})')
+
+        row = pd.DataFrame([{'iter': round_idx, 'n_resources': budget, 'params': params, 'split': split_idx,
+                             'fit_time': fit_time, 'train_score': train_score, 'test_score': test_score}])
+        row.to_csv(path, sep='\t', mode='a', header=not os.path.exists(path), index=False)
 
 
     def _cv_aware_split(self):
@@ -295,9 +1029,11 @@ class Predictor:
 
 
     def _cv(self):
-        y_predict_all_cv_folds = pd.DataFrame()
-        y_test_all_cf_folds = pd.DataFrame()
-        aux_vars_test_all_cf_folds = pd.DataFrame()
+        if self.fold_executor == 'process':
+            self._parallel_cv()
+            return
+
+        fold_results = FoldResults(self.df['PropertyKey_ID'])
 
         for fold_idx, (df_train, df_test) in enumerate(self.cross_validation_split(self.df)):
             self.df_train = df_train
@@ -305,18 +1041,72 @@ class Predictor:
 
             yield
 
-            self.aux_vars_test['cv_fold_idx'] = fold_idx
+            fold_results.add(fold_idx, self.y_test, self.y_predict, self.aux_vars_test)
+
+        fold_results.assign(self)
+
+
+    @property
+    def aux_vars_test(self):
+        # the auxiliary variables of all cross-validation folds are only concatenated on first access
+        if folds := self.__dict__.pop('_aux_vars_test_folds', None):
+            self.__dict__['aux_vars_test'] = pd.concat(folds, axis=0)
+
+        if 'aux_vars_test' not in self.__dict__ and 'aux_vars_test' in self._artifact_files():
+            self.__dict__['aux_vars_test'] = self._read_artifact_part('aux_vars_test')
+
+        return self.__dict__.get('aux_vars_test')
+
+
+    @aux_vars_test.setter
+    def aux_vars_test(self, aux_vars_test):
+        self.__dict__.pop('_aux_vars_test_folds', None)
+        self.__dict__['aux_vars_test'] = aux_vars_test
+
+
+    def _set_aux_vars_test_folds(self, folds):
+        self.__dict__['aux_vars_test'] = None
+        self.__dict__['_aux_vars_test_folds'] = folds
 
-            y_predict_all_cv_folds = pd.concat([y_predict_all_cv_folds, self.y_predict], axis=0)
-            y_test_all_cf_folds = pd.concat([y_test_all_cf_folds, self.y_test], axis=0)
-            aux_vars_test_all_cf_folds = pd.concat([aux_vars_test_all_cf_folds, self.aux_vars_test], axis=0)
 
-        self.y_test = y_test_all_cf_folds
-        self.y_predict = y_predict_all_cv_folds
-        self.aux_vars_test = aux_vars_test_all_cf_folds
+    def _parallel_cv(self):
+        self._abort_signal()
+        # the splits are determined once as positions into the dataset, which the forked workers share copy-on-write
+        splits = [
+            tuple(self._fold_split(fold_df) for fold_df in fold)
+            for fold in self.cross_validation_split(self.df)
+        ]
+        n_workers = min(len(splits), self.n_jobs or os.cpu_count())
+        logger.info(f'Training {len(splits)} cross-validation folds in {n_workers} worker processes...')
+
+        with utils.fork_pool(n_workers, fold_predictor=self, fold_splits=splits) as executor:
+            fold_results = list(executor.map(_train_fold, range(len(splits)), itertools.repeat(n_workers)))
+
+        for attr, value in fold_results[-1].items():
+            setattr(self, attr, value)
+
+        results = FoldResults(self.df['PropertyKey_ID'])
+        for fold_idx, fold_result in enumerate(fold_results):
+            results.add(fold_idx, fold_result['y_test'], fold_result['y_predict'], fold_result['aux_vars_test'])
+
+        results.assign(self)
+
+
+    def _fold_split(self, fold_df):
+        # columns which the split function adds to a copy of the dataset, e.g. neighborhoods, are kept with the positions
+        added_columns = [c for c in fold_df.columns if c not in self.df.columns]
+        return self.df.index.get_indexer(fold_df.index), fold_df[added_columns]
+
+
+    def _fold_df(self, positions, added_columns):
+        fold_df = self.df.iloc[positions]
+        return pd.concat([fold_df, added_columns], axis=1) if len(added_columns.columns) else fold_df
 
 
     def _do_across_folds(self, func, *args, **kwargs):
+        if func.__name__ in self.FOLD_METRICS:
+            return getattr(FoldMetrics(self), func.__name__)(*args, **kwargs)
+
         results = []
         y_test = self.y_test
         y_predict = self.y_predict
@@ -355,6 +1145,10 @@ class Predictor:
         gc.collect()
 
 
+    def _native_xgboost_training(self):
+        return self.cache_feature_matrices and self._xgboost_model() and _native_xgboost_supported(self.model)
+
+
     def _xgboost_model(self):
         return getattr(self.model, '__module__', None).split('.')[0] == xgboost.__name__
 
@@ -363,8 +1157,42 @@ class Predictor:
         return getattr(self.model, '__module__', None) == sklearn.ensemble.__name__
 
 
+    def _results_only_copy(self):
+        # the predictor as loaded from a results only artifact, i.e. without training state, model and functions
+        config = self._config_attributes()
+        predictor = type(self).__new__(type(self))
+        predictor.__dict__.update({name: None for name in self.ARTIFACT_PARTS})
+        predictor.__dict__.update(config['attributes'])
+        predictor.__dict__.update(config['descriptions'])
+        predictor.__dict__.update({name: value for name, (_, value) in self._result_parts().items()})
+        return predictor
+
+
+    def __getattr__(self, name):
+        # parts of a loaded artifact are only read on first access
+        if name not in self._artifact_files():
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        value = self._read_artifact_part(name)
+        setattr(self, name, value)
+        return value
+
+
+    def _artifact_files(self):
+        manifest = self.__dict__.get('_artifact_manifest')
+        return manifest['files'] if manifest else {}
+
+
+    def _read_artifact_part(self, name):
+        logger.debug(f'Reading {name} from artifact {self._artifact_path}...')
+        return artifacts.read_part(self._artifact_path, self._artifact_manifest, name)
+
+
     @staticmethod
     def load(path):
+        if artifacts.is_artifact(path):
+            return Predictor._load_artifact(path)
+
         predictor = pickle.load(open(path, 'rb'))
 
         if isinstance(predictor, Predictor):
@@ -373,13 +1201,78 @@ class Predictor:
         logger.error(f'The object loaded from {path} is not a Predictor instance.')
 
 
-    def save(self, path, results_only=False):
+    @staticmethod
+    def _load_artifact(path):
+        manifest = artifacts.read_manifest(path)
+        module_name, _, class_name = manifest['predictor_type'].rpartition('.')
+        predictor_type = getattr(importlib.import_module(module_name), class_name)
+
+        predictor = predictor_type.__new__(predictor_type)
+        predictor.__dict__.update(manifest['attributes'])
+        predictor.__dict__.update(manifest['descriptions'])
+        predictor.__dict__.update({name: None for name in Predictor.ARTIFACT_PARTS if name not in manifest['files']})
+        predictor.__dict__['_artifact_path'] = path
+        predictor.__dict__['_artifact_manifest'] = manifest
+        return predictor
+
+
+    def save(self, path, results_only=False, format='pickle'):
+        # pickles the whole predictor, or writes an artifact directory without training state for format='artifact'
+        if format == 'artifact':
+            self._save_artifact(path, results_only)
+            return
+
         if results_only:
             self._garbage_collect()
 
         pickle.dump(self, open(path, 'wb'))
 
 
+    def _save_artifact(self, path, results_only=False):
+        if results_only:
+            parts = self._result_parts()
+        else:
+            parts = {name: (kind, getattr(self, name, None)) for name, kind in self.ARTIFACT_PARTS.items()}
+            parts['model'] = ('xgboost' if self._xgboost_model() else 'pickle', self.model)
+            parts['metrics'] = ('json', self._eval_metrics_or_none())
+
+        manifest = {
+            'predictor_type': f'{type(self).__module__}.{type(self).__qualname__}',
+            **self._config_attributes(),
+        }
+        artifacts.write_artifact(path, manifest, parts)
+
+
+    def _config_attributes(self):
+        # configuration attributes are kept as they are, functions like preprocessing stages only as description
+        excluded = {*self.ARTIFACT_PARTS, *self.TRAINING_ATTRIBUTES, *self.FOLD_ATTRIBUTES, 'model'}
+        config = {k: v for k, v in self.__dict__.items() if k not in excluded and not k.startswith('_')}
+        attributes = {k: v for k, v in config.items() if artifacts.json_serializable(v) and not isinstance(v, pd.DataFrame)}
+        descriptions = {k: utils.config_repr(v) for k, v in config.items() if k not in attributes}
+        attributes['hyperparameters'] = self.hyperparameters
+        return {'attributes': attributes, 'descriptions': descriptions}
+
+
+    def _result_parts(self):
+        # only the feature names of the test set are kept, e.g. to relate the SHAP values to them
+        parts = {name: (self.ARTIFACT_PARTS[name], getattr(self, name, None)) for name in self.RESULT_PARTS}
+        if getattr(self, 'X_test', None) is not None:
+            parts['X_test'] = ('frame', self.X_test.iloc[:0])
+        return parts
+
+
+    def _eval_metrics_or_none(self):
+        try:
+            return self.eval_metrics()
+        except Exception as e:
+            logger.warning(f'Evaluation metrics could not be saved: {e}')
+
+
+    def saved_metrics(self):
+        metrics = self._read_artifact_part('metrics')
+        return pd.DataFrame(metrics['data'], index=metrics['index'], columns=metrics['columns'])
+
+
     def cv_aware(f):
         @wraps(f)
         def wrapped(self, *args, **kwargs):
@@ -395,24 +1288,43 @@ class Predictor:
         raise NotImplementedError('To be implemented.')
 
 
-    def calculate_SHAP_values(self):
+    def calculate_SHAP_values(self, sample_size=None, native=None, path=None):
+        # optionally only for a stratified sample of the test set, whose rows are kept to align the values with their features
         if self.shap_values is None:
-            self.shap_explainer = shap.TreeExplainer(self.model)
-            self.shap_values = self.shap_explainer.shap_values(self.X_test)
+            sample_size = sample_size or self.shap_sample_size
+            native = self.shap_native if native is None else native
+
+            if sample_size and sample_size < len(self.X_test):
+                self.shap_rows = explanations.stratified_sample(self._shap_strata(), sample_size, seed=dataset.GLOBAL_REPRODUCIBILITY_SEED)
+
+            self.shap_values = explanations.shap_values(self.model, self.shap_features(), native=native, n_jobs=self.n_jobs, path=path)
         return self.shap_values
 
 
+    def shap_features(self):
+        return self.X_test if self.shap_rows is None else self.X_test.iloc[self.shap_rows]
+
+
+    def _shap_strata(self):
+        return pd.qcut(self._shap_targets().rank(method='first'), explanations.SHAP_STRATA_BINS, labels=False)
+
+
+    def _shap_targets(self):
+        # under cross-validation y_test holds all folds, whereas X_test only holds the last one
+        return self.y_test.loc[self.X_test.index, self.target_attribute]
+
+
     def SHAP_analysis(self):
         self.calculate_SHAP_values()
-        shap.summary_plot(self.shap_values, self.X_test)
-        shap.summary_plot(self.shap_values, self.X_test, plot_type='bar')
+        shap.summary_plot(self.shap_values, self.shap_features())
+        shap.summary_plot(self.shap_values, self.shap_features(), plot_type='bar')
 
 
     def normalized_feature_importance(self):
         # Calculate feature importance based on SHAP values
         self.calculate_SHAP_values()
 
-        avg_shap_value = np.abs(self.shap_values).mean(0)
+        avg_shap_value = np.abs(self.shap_values).mean(0, dtype=np.float64)
         normalized_shap_value = avg_shap_value / sum(avg_shap_value)
         feature_names = self.X_test.columns
 
@@ -449,7 +1361,7 @@ class Predictor:
         shap.dependence_plot(
             feature1,
             self.shap_values,
-            self.X_test,
+            self.shap_features(),
             interaction_index=feature2,
             xmin=f"percentile({low_percentile})",
             xmax=f"percentile({high_percentile})",
@@ -474,8 +1386,213 @@ class Predictor:
         print(feature_importance.head(15))
 
 
+def _run_comparison_task(name, seed, comparison):
+    time_start = time.time()
+    predictor = comparison._train_predictor(name, seed)
+    result = predictor, time.time() - time_start
+    comparison._save_run(name, seed, result)
+    return result
+
+
+def _run_pool_task(name, seed, n_workers):
+    comparison = utils.worker_state('comparison')
+    model = comparison.experiments[name].get('model')
+
+    if n_workers > 1 and getattr(model, '__module__', '').split('.')[0] == xgboost.__name__ and model.get_params().get('n_jobs') is None:
+        model.set_params(n_jobs=utils.worker_threads(n_workers))
+
+    # only the results required for the evaluation are sent back to the parent
+    predictor, e2e_time = _run_comparison_task(name, seed, comparison)
+    return predictor._results_only_copy(), e2e_time
+
+
+def _train_fold(fold_idx, n_workers):
+    predictor = utils.worker_state('fold_predictor')
+    splits = utils.worker_state('fold_splits')
+    n_jobs = predictor.model.get_params().get('n_jobs')
+
+    if n_workers > 1 and predictor._xgboost_model() and n_jobs is None:
+        predictor.model.set_params(n_jobs=utils.worker_threads(n_workers))
+
+    predictor.df_train, predictor.df_test = (predictor._fold_df(*split) for split in splits[fold_idx])
+    predictor._pre_preprocess_analysis_hook()
+    predictor._preprocess()
+    predictor._post_preprocess_analysis_hook()
+    predictor._train()
+    predictor._predict()
+
+    # the model of the last fold is kept by the parent with its own number of threads
+    if predictor._xgboost_model():
+        predictor.model.set_params(n_jobs=n_jobs)
+
+    attributes = Predictor.FOLD_ATTRIBUTES if fold_idx == len(splits) - 1 else ['y_predict', 'y_test', 'aux_vars_test']
+    return {attr: getattr(predictor, attr, None) for attr in attributes}
+
+
+def _halving_tasks(candidates, tasks, budget, n_workers):
+    # yields the (candidate, split) tasks with their (fit time, train score, test score) as soon as they are completed
+    if n_workers == 1 or len(tasks) == 1:
+        for idx, split_idx in tasks:
+            yield (idx, split_idx), _fit_halving_candidate(candidates[idx], split_idx, budget)
+        return
+
+    with utils.fork_pool(min(n_workers, len(tasks))) as executor:
+        futures = {executor.submit(_fit_halving_candidate, candidates[idx], split_idx, budget): (idx, split_idx) for idx, split_idx in tasks}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def _fit_halving_candidate(params, split_idx, budget):
+    predictor, X, y, sample_weight, splits, scorer, n_workers = utils.worker_state('halving_search_state')
+    train_idx, test_idx = splits[split_idx]
+    train_idx = np.sort(train_idx[:max(1, int(np.ceil(budget * len(train_idx))))])
+
+    model = sklearn.base.clone(predictor.model).set_params(**params)
+    model.set_params(n_estimators=max(1, int(round(model.get_params()['n_estimators'] * budget))))
+    if n_workers > 1 and 'n_jobs' in model.get_params() and model.get_params()['n_jobs'] is None:
+        model.set_params(n_jobs=utils.worker_threads(n_workers))
+
+    X_train, y_train = X.iloc[train_idx], y.iloc[train_idx]
+    X_test, y_test = X.iloc[test_idx], y.iloc[test_idx]
+    weights = None if sample_weight is None else sample_weight[train_idx]
+
+    time_start = time.time()
+    if predictor._native_xgboost_training():
+        _fit_xgboost(model, _feature_matrices.get(model, X_train, y_train, weights), y_train)
+    else:
+        model.fit(X_train, y_train, sample_weight=weights)
+    fit_time = time.time() - time_start
+
+    return fit_time, scorer(model, X_train, y_train), scorer(model, X_test, y_test)
+
+
+def _stream_rows(countries, columns, rows):
+    # yields the given columns of the sorted rows (positions in the concatenated parquet caches of the countries) in batches
+    offset = 0
+    for country in countries:
+        for batch in utils.data_cache_batches(country, columns=columns, batch_size=EXTERNAL_MEMORY_BATCH_SIZE):
+            start, end = np.searchsorted(rows, [offset, offset + len(batch)])
+            if end > start:
+                yield start, end, batch.iloc[rows[start:end] - offset][columns]
+            offset += len(batch)
+
+
+class FeatureStreamIter(xgboost.DataIter):
+    """
+    XGBoost data iterator streaming the features of the selected rows from the parquet caches of countries in batches.
+
+    Used for external memory training on datasets which do not fit into memory.
+    """
+
+    def __init__(self, countries, feature_cols, rows, label, weight=None, cache_prefix=None):
+        self.countries = countries
+        self.feature_cols = feature_cols
+        self.rows = rows
+        self.label = label
+        self.weight = weight
+        self.batches = None
+        super().__init__(cache_prefix=cache_prefix)
+
+
+    def next(self, input_data):
+        if self.batches is None:
+            self.batches = _stream_rows(self.countries, self.feature_cols, self.rows)
+
+        batch = next(self.batches, None)
+        if batch is None:
+            return 0
+
+        start, end, X = batch
+        weight = None if self.weight is None else self.weight[start:end]
+        input_data(data=X, label=self.label[start:end], weight=weight)
+        return 1
+
+
+    def reset(self):
+        self.batches = None
+
+
+def _xgboost_matrices(model, X, y, sample_weight=None, eval_set=None, **kwargs):
+    dtrain = _feature_matrices.get(model, X, y, sample_weight)
+    evals = []
+
+    for idx, (X_eval, y_eval) in enumerate(eval_set or []):
+        # like the sklearn wrapper, reuse the training matrix if it is part of the evaluation set
+        if X_eval is X and y_eval is y and sample_weight is None:
+            evals.append((dtrain, f'validation_{idx}'))
+        else:
+            evals.append((_feature_matrices.get(model, X_eval, y_eval, ref=dtrain), f'validation_{idx}'))
+
+    return dtrain, evals
+
+
+def _native_xgboost_supported(model):
+    """
+    Whether _fit_xgboost can train the model with cached feature matrices instead of the fit method of the sklearn wrapper.
+
+    _fit_xgboost reimplements the parts of XGBModel.fit needed for models with built-in objectives and metrics on top of
+    private hooks of the wrapper. Other models, and xgboost versions without these hooks, are trained with fit instead.
+    """
+    missing_hooks = [hook for hook in NATIVE_XGBOOST_HOOKS if not hasattr(model, hook)]
+    if missing_hooks:
+        logger.warning(f'The sklearn wrapper of xgboost {xgboost.__version__} lacks {missing_hooks}. Training with its fit method instead of cached feature matrices.')
+        return False
+
+    eval_metrics = model.eval_metric if isinstance(model.eval_metric, (list, tuple)) else [model.eval_metric]
+    return not callable(model.objective) and not any(callable(metric) for metric in eval_metrics)
+
+
+def _fit_xgboost(model, dtrain, y, evals=[], early_stopping_rounds=None, verbose=False):
+    # equivalent to the fit method of the xgboost sklearn wrapper for the models of _native_xgboost_supported,
+    # but training with the given feature matrices
+    params = model.get_xgb_params()
+
+    if isinstance(model, xgboost.XGBClassifier):
+        model.classes_ = np.unique(np.asarray(y))
+        model.n_classes_ = len(model.classes_)
+
+        # same label validation as the wrapper
+        if not np.array_equal(model.classes_, np.arange(model.n_classes_)):
+            raise ValueError(f'Invalid classes inferred from unique values of `y`. Expected: {np.arange(model.n_classes_)}, got {model.classes_}')
+
+        if model.n_classes_ > 2:
+            if params.get('objective') != 'multi:softmax':
+                params['objective'] = 'multi:softprob'
+            params['num_class'] = model.n_classes_
+
+    if model.early_stopping_rounds is not None:
+        early_stopping_rounds = model.early_stopping_rounds
+
+    evals_result = {}
+    with xgboost.config_context(verbosity=model.verbosity):
+        booster = xgboost.train(
+            params,
+            dtrain,
+            model.get_num_boosting_rounds(),
+            evals=evals,
+            early_stopping_rounds=early_stopping_rounds,
+            evals_result=evals_result,
+            verbose_eval=verbose,
+            callbacks=model.callbacks,
+        )
+
+    model._Booster = booster
+    if model.get_booster() is not booster:
+        raise Exception(f'The sklearn wrapper of xgboost {xgboost.__version__} does not keep its booster in _Booster anymore. Please disable cache_feature_matrices.')
+
+    if isinstance(model, xgboost.XGBClassifier):
+        model.objective = params['objective']
+
+    if evals_result:
+        model.evals_result_ = evals_result
+
+    return model
+
+
 class Regressor(Predictor):
 
+    FOLD_METRICS = ['r2', 'mae', 'rmse', 'kurtosis', 'skew', 'error_cum_hist', 'mcc']
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -562,18 +1679,42 @@ class Regressor(Predictor):
         eval_df = pd.DataFrame(columns=['R2', 'MAE', 'RMSE', 'Kurtosis', 'Skew'])
 
         for col in eval_df.columns:
-            calc_metric = getattr(self, col.lower())
-            eval_df.at['total', col] = calc_metric()
+            eval_df.at['total', col] = getattr(self, col.lower())()
 
-            if self.cross_validation_split:
-                for fold, value in enumerate(calc_metric(across_folds=True)):
-                        eval_df.at[f'fold_{fold}', col] = value
+        if self.cross_validation_split:
+            fold_metrics = FoldMetrics(self)
+            for col in eval_df.columns:
+                for fold, value in enumerate(getattr(fold_metrics, col.lower())()):
+                    eval_df.at[f'fold_{fold}', col] = value
 
         return eval_df
 
 
     @Predictor.cv_aware
-    def spatial_autocorrelation_moran(self, attribute, type):
+    def spatial_autocorrelation_moran(self, attribute, type, weights_cache=None):
+        # weights of the test set are reused from the cache, e.g. across the experiments and seeds of a comparison
+        aux_df = self._spatial_autocorrelation_data(attribute, type)
+        weights = (weights_cache or SpatialWeightsCache()).get(aux_df, type)
+        moran = spatial_autocorrelation.moran(aux_df, weights, attribute)
+
+        logger.info(f'Moran I for spatial autocorrelation of {attribute}: {moran.I:.4f} ({type} weights with p value of {moran.p_norm:.4f})')
+        return moran
+
+
+    @Predictor.cv_aware
+    def local_spatial_autocorrelation(self, attribute='error', type='knn', weights_cache=None, permutations=spatial_autocorrelation.MORAN_PERMUTATIONS):
+        # Local Moran's I, Getis-Ord Gi* and cluster labels per test building, indexed like aux_vars_test to join them
+        aux_df, index = self._spatial_autocorrelation_data(attribute, type, return_index=True)
+        weights = (weights_cache or SpatialWeightsCache()).get(aux_df, type)
+        lisa = spatial_autocorrelation.local_autocorrelation(aux_df[attribute], weights, permutations, n_jobs=self.n_jobs)
+        lisa.index = index
+
+        clusters = lisa['cluster'].value_counts()
+        logger.info(f'Local spatial autocorrelation of {attribute} ({type} weights): {", ".join(f"{c} {n}" for c, n in clusters.items())}')
+        return lisa
+
+
+    def _spatial_autocorrelation_data(self, attribute, type, return_index=False):
         if attribute == 'error':
             y = self.individual_prediction_error()
         elif attribute == self.target_attribute:
@@ -581,19 +1722,13 @@ class Regressor(Predictor):
         else:
             raise Exception(f'Please specify either "error" or "{self.target_attribute}" as the attribute for calculation spatial autocorrelation.')
 
-        aux_df = pd.concat([y, self.aux_vars_test], axis=1, join="inner").reset_index()
-
-        if type == 'block':
-            moran = spatial_autocorrelation.moran_within_block(aux_df, attribute=attribute)
-        elif type == 'knn':
-            moran = spatial_autocorrelation.moran_knn(geometry.to_gdf(aux_df), attribute=attribute)
-        elif type == 'distance':
-            moran = spatial_autocorrelation.moran_distance(geometry.to_gdf(aux_df), attribute=attribute)
-        else:
+        if type not in spatial_autocorrelation.WEIGHT_TYPES:
             raise Exception('Please specify either "knn", "block" or "distance", as type for calculation spatial autocorrelation.')
 
-        logger.info(f'Moran I for spatial autocorrelation of {attribute}: {moran.I:.4f} ({type} weights with p value of {moran.p_norm:.4f})')
-        return moran
+        aux_df = pd.concat([y, self.aux_vars_test], axis=1, join="inner").dropna(subset=[attribute])
+        if return_index:
+            return aux_df.reset_index(), aux_df.index
+        return aux_df.reset_index()
 
 
     @Predictor.cv_aware
@@ -607,6 +1742,8 @@ class Regressor(Predictor):
 
 class Classifier(Predictor):
 
+    FOLD_METRICS = ['mcc']
+
     def __init__(self, labels, predict_probabilities=False, initialize_only=False, validate_labels=True, *args, **kwargs):
         super().__init__(*args, **kwargs, initialize_only=True)
 
@@ -628,10 +1765,31 @@ class Classifier(Predictor):
         if not self.predict_probabilities:
             return super()._predict()
 
-        class_probabilities = self.model.predict_proba(self.X_test)
-        class_drawn = np.apply_along_axis(self._sample_class_from_probabilities,
-                                          axis=1, arr=class_probabilities).ravel()
-        self.y_predict = pd.DataFrame({self.target_attribute: class_drawn, 'probabilities': list(class_probabilities)})
+        # the probabilities are kept as one float32 column per class, which pandas stores as a single 2-D block
+        class_probabilities = self.model.predict_proba(self.X_test).astype(np.float32)
+        self.y_predict = pd.DataFrame(class_probabilities, columns=self._probability_columns(), index=self.X_test.index)
+        self.y_predict.insert(0, self.target_attribute, self._sample_classes(class_probabilities))
+
+
+    def _probability_columns(self):
+        return [f'probability_{label}' for label in self.labels]
+
+
+    def predicted_probabilities(self):
+        return self.y_predict[self._probability_columns()].to_numpy(dtype=np.float32)
+
+
+    def _sample_classes(self, class_probabilities):
+        # inverse transform sampling for all buildings at once: each row's cdf is shifted by its row number,
+        # so that a single search in the flattened cdfs finds the sampled class of every row
+        n_rows, n_classes = class_probabilities.shape
+        cdf = np.cumsum(class_probabilities, axis=1, dtype=np.float64)
+        cdf /= cdf[:, -1:]
+
+        rows = np.arange(n_rows)
+        uniform = np.random.default_rng(dataset.GLOBAL_REPRODUCIBILITY_SEED).random(n_rows)
+        positions = np.searchsorted((cdf + rows[:, np.newaxis]).ravel(), uniform + rows, side='right')
+        return np.minimum(positions - rows * n_classes, n_classes - 1)
 
 
     def _validate_labels(self):
@@ -648,11 +1806,8 @@ class Classifier(Predictor):
             raise Exception(f'Length of labels provided ({self.labels}) does not match the labels in the dataset ({labels_dataset}).')
 
 
-    def _sample_class_from_probabilities(self, prob):
-        np.random.seed(dataset.GLOBAL_REPRODUCIBILITY_SEED)
-        classes = list(range(0, len(self.labels)))
-        sampled_class = np.random.choice(classes, 1, p=prob)
-        return sampled_class
+    def _shap_strata(self):
+        return self._shap_targets()
 
 
     @Predictor.cv_aware
@@ -749,11 +1904,11 @@ class Classifier(Predictor):
         self.calculate_SHAP_values()
 
         # average across classes for multiclass classification
-        axis = (0, 1) if np.array(self.shap_values).ndim == 3 else 0
+        axis = (0, 1) if self.shap_values.ndim == 3 else 0
 
-        avg_shap_value = np.abs(self.shap_values).mean(axis=axis)
+        avg_shap_value = np.abs(self.shap_values).mean(axis=axis, dtype=np.float64)
         normalized_shap_value = avg_shap_value / sum(avg_shap_value)
-        feature_names = self.X_train.columns
+        feature_names = self.X_test.columns
 
         feature_importance = pd.DataFrame(
             {'feature': feature_names, 'normalized_importance': normalized_shap_value})
@@ -764,11 +1919,11 @@ class Classifier(Predictor):
         self.calculate_SHAP_values()
 
         # binary classification
-        if np.array(self.shap_values).ndim != 3:
+        if self.shap_values.ndim != 3:
             shap.dependence_plot(
                 feature1,
                 self.shap_values,
-                self.X_train,
+                self.shap_features(),
                 interaction_index=feature2,
                 xmin=f"percentile({low_percentile})",
                 xmax=f"percentile({high_percentile})",
@@ -781,7 +1936,7 @@ class Classifier(Predictor):
             shap.dependence_plot(
                 feature1,
                 class_shap_values,
-                self.X_train,
+                self.shap_features(),
                 interaction_index=feature2,
                 xmin=f"percentile({low_percentile})",
                 xmax=f"percentile({high_percentile})",
@@ -806,8 +1961,17 @@ class PredictorComparison:
             keep_predictor_in_memory=False,
             include_baseline=True,
             n_seeds=1,
+            scheduler=None,
+            n_jobs=None,
+            slurm_array_job_id=None,
             **baseline_kwargs) -> None:
 
+        if scheduler not in SCHEDULERS:
+            raise Exception(f'Unknown scheduler {scheduler}. Please use one of {SCHEDULERS}.')
+
+        if scheduler == 'slurm' and exp_name is None:
+            raise Exception('Please specify an exp_name shared by all SLURM array tasks when using the slurm scheduler.')
+
         self.predictor_type = predictor_type
         self.comparison_config = comparison_config
         self.grid_comparison_config = grid_comparison_config
@@ -818,15 +1982,30 @@ class PredictorComparison:
         self.include_baseline = include_baseline
         self.baseline_kwargs = baseline_kwargs
         self.n_seeds = n_seeds
+        self.scheduler = scheduler
+        self.n_jobs = n_jobs
+        self.slurm_array_job_id = slurm_array_job_id or os.environ.get('SLURM_ARRAY_JOB_ID')
         self.predictors = collections.defaultdict(list)
         self.comparison_metrics = []
         self.exp_name = exp_name or utils.truncated_uuid4()
+        self.shared_data = {}
+        self.spatial_weights = SpatialWeightsCache()
 
         self._compare()
 
 
     def _compare(self):
-        features = dataset.FEATURES.copy()
+        self.features = dataset.FEATURES.copy()
+        self.experiments = dict(self._experiments())
+        self.config_hashes = {
+            name: utils.config_hash({'predictor_type': self.predictor_type, 'features': self.features, **kwargs})
+            for name, kwargs in self.experiments.items()
+        }
+
+        if self._slurm_array_task():
+            # array tasks only train their share of predictors, the driver process evaluates them
+            self._run_slurm_array_tasks()
+            return
 
         if self.include_baseline:
             self.predictors['baseline'] = self.predictor_type(**copy.deepcopy(self.baseline_kwargs))
@@ -834,32 +2013,325 @@ class PredictorComparison:
             if self.compare_feature_importance:
                 self.predictors['baseline'].calculate_SHAP_values()
 
+        if self.scheduler == 'local':
+            self._compare_in_process_pool()
+        elif self.scheduler == 'seeds':
+            self._compare_seeds_in_process_pool()
+        elif self.scheduler == 'slurm':
+            self._collect_slurm_array_results()
+        else:
+            self._compare_sequentially()
+
+
+    def _experiments(self):
         for grid_experiment_name, grid_experiment_kwargs in self.grid_comparison_config.items():
             for experiment_name, experiment_kwargs in self.comparison_config.items():
                 name = f'{experiment_name}_{grid_experiment_name}'
                 kwargs = {**copy.deepcopy(self.baseline_kwargs), **grid_experiment_kwargs, **experiment_kwargs}
-                self.time_start = time.time()
-                logger.info(f'Starting experiment {name}...')
+                yield name, kwargs
+
+
+    def _tasks(self):
+        return [(name, seed) for name in self.experiments for seed in range(self.n_seeds)]
+
+
+    def _train_predictor(self, name, seed):
+        kwargs = {'output_dir': self._runs_dir(), **self.experiments[name], **self._shared_experiment_data(name)}
+        logger.debug(f'Training predictor ({name}) (seed {seed}) with following args:\n{kwargs}')
+
+        # every task gets its own seed and a fresh copy of the features as preprocessing stages may modify them
+        dataset.GLOBAL_REPRODUCIBILITY_SEED = seed
+        dataset.FEATURES = self.features.copy()
+        predictor = self.predictor_type(**kwargs)
+
+        if self.compare_feature_importance:
+            predictor.calculate_SHAP_values()
+
+        if self.garbage_collect_after_training:
+            predictor._garbage_collect()
+
+        return predictor
+
+
+    def _compare_sequentially(self):
+        runs = self._completed_runs()
+        for name in self.experiments:
+            logger.info(f'Starting experiment {name}...')
+            results = {seed: self._load_run(name, seed, runs) or _run_comparison_task(name, seed, self) for seed in range(self.n_seeds)}
+            self._complete_experiment_from_results(name, results)
+
+
+    def _compare_in_process_pool(self):
+        tasks = []
+        results = collections.defaultdict(dict)
+        runs = self._completed_runs()
+
+        for name, seed in self._tasks():
+            if (result := self._load_run(name, seed, runs)) is not None:
+                results[name][seed] = result
+            else:
+                tasks.append((name, seed))
+
+        for name in [name for name, seed_results in results.items() if len(seed_results) == self.n_seeds]:
+            self._complete_experiment_from_results(name, results.pop(name))
+
+        n_workers = min(len(tasks), self.n_jobs or os.cpu_count())
+        logger.info(f'Scheduling {len(tasks)} experiment tasks on a local process pool of {n_workers} workers...')
+
+        # forked workers inherit the comparison config, only task identifiers and results are transferred
+        with utils.fork_pool(n_workers, comparison=self) as executor:
+            futures = {executor.submit(_run_pool_task, name, seed, n_workers): (name, seed) for name, seed in tasks}
+
+            for future in as_completed(futures):
+                name, seed = futures[future]
+                results[name][seed] = future.result()
+                logger.info(f'Finished experiment {name} (seed {seed}).')
 
-                for seed in range(self.n_seeds):
-                    logger.debug(f'Training predictor ({name}) (seed {seed}) with following args:\n{kwargs}')
-                    dataset.GLOBAL_REPRODUCIBILITY_SEED = seed
-                    dataset.FEATURES = features # reset features to original state if they have been modified by another experiment
-                    self.predictors[name].append(self.predictor_type(**kwargs))
+                if len(results[name]) == self.n_seeds:
+                    self._complete_experiment_from_results(name, results.pop(name))
 
-                    if self.compare_feature_importance:
-                        self.predictors[name][seed].calculate_SHAP_values()
 
-                    if self.garbage_collect_after_training:
-                        self.predictors[name][seed]._garbage_collect()
+    def _compare_seeds_in_process_pool(self):
+        # experiments run one after another, the seeds of an experiment in forked workers sharing its loaded datasets
+        try:
+            runs = self._completed_runs()
+            for name in self.experiments:
+                results = {seed: result for seed in range(self.n_seeds) if (result := self._load_run(name, seed, runs)) is not None}
+                seeds = [seed for seed in range(self.n_seeds) if seed not in results]
+
+                if seeds:
+                    self._load_shared_data(name)
+                    n_workers = min(len(seeds), self.n_jobs or os.cpu_count())
+                    logger.info(f'Starting experiment {name} with {len(seeds)} seeds in {n_workers} worker processes...')
+
+                    with utils.fork_pool(n_workers, comparison=self) as executor:
+                        futures = {executor.submit(_run_pool_task, name, seed, n_workers): seed for seed in seeds}
+
+                        for future in as_completed(futures):
+                            results[futures[future]] = future.result()
+                            logger.info(f'Finished experiment {name} (seed {futures[future]}).')
+
+                self._complete_experiment_from_results(name, results)
+        finally:
+            self.shared_data = {}
+
+
+    def _load_shared_data(self, name):
+        # datasets given as paths are only loaded once for all seeds and kept while subsequent experiments use them as well
+        paths = set(self._data_paths(name).values())
+        self.shared_data = {path: self.shared_data.get(path) for path in paths}
+
+        for path in paths:
+            if self.shared_data[path] is None:
+                logger.info(f'Loading {path} shared by all seeds...')
+                self.shared_data[path] = utils.load_df(path)
+
+
+    def _shared_experiment_data(self, name):
+        return {key: self.shared_data[path] for key, path in self._data_paths(name).items() if path in self.shared_data}
+
+
+    def _data_paths(self, name):
+        kwargs = self.experiments[name]
+
+        # external memory predictors stream the country datasets themselves
+        if kwargs.get('external_memory'):
+            return {}
+
+        return {key: kwargs[key] for key in ['df', 'test_set'] if isinstance(kwargs.get(key), str)}
+
+
+    def _slurm_array_task(self):
+        return self.scheduler == 'slurm' and 'SLURM_ARRAY_TASK_ID' in os.environ
+
+
+    def _checkpoint_runs(self):
+        # the driver of the slurm scheduler depends on the run results written by the array tasks
+        return self.save_results or self.scheduler == 'slurm'
+
+
+    def _runs_dir(self):
+        return f'{self.exp_name}-runs'
+
+
+    def _run_path(self, name, seed):
+        return os.path.join(self._runs_dir(), f'{name}-{seed}-{self.config_hashes[name]}')
+
+
+    def _completed_runs(self):
+        return self._ledger_runs('completed')
 
-                self.comparison_metrics.append(self._evaluate_experiment(name))
-                if self.save_results:
-                    self._save_intermediate_results(name)
 
-                if not self.keep_predictor_in_memory:
-                    del self.predictors[name]
-                    gc.collect()
+    def _failed_runs(self):
+        return self._ledger_runs('failed')
+
+
+    def _ledger_runs(self, status):
+        # the ledger lists a run once its record is completely written, a partially appended last line is ignored
+        path = os.path.join(self._runs_dir(), RUN_LEDGER_FILE)
+        if not self._checkpoint_runs() or not os.path.exists(path):
+            return {}
+
+        runs = {}
+        with open(path) as f:
+            for line in f:
+                try:
+                    run = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if run.get('status', 'completed') == status:
+                    runs[(run['name'], run['seed'], run['config_hash'])] = run
+        return runs
+
+
+    def _completed_run(self, name, seed, runs=None):
+        runs = self._completed_runs() if runs is None else runs
+        return runs.get((name, seed, self.config_hashes[name]))
+
+
+    def _load_run(self, name, seed, runs=None):
+        run = self._completed_run(name, seed, runs)
+
+        if run is None:
+            return None
+
+        path = os.path.join(self._runs_dir(), run['record'])
+        logger.info(f'Reusing result of experiment {name} (seed {seed}) completed previously: {path}')
+        return Predictor.load(path), run['e2e_time']
+
+
+    def _save_run(self, name, seed, result):
+        if not self._checkpoint_runs():
+            return
+
+        # only the predictions, evaluation results and run time are recorded, in the results only artifact format
+        predictor, e2e_time = result
+        path = self._run_path(name, seed)
+        os.makedirs(self._runs_dir(), exist_ok=True)
+        predictor._save_artifact(path, results_only=True)
+
+        self._append_to_ledger({
+            'name': name,
+            'seed': seed,
+            'config_hash': self.config_hashes[name],
+            'status': 'completed',
+            'record': os.path.basename(path),
+            'e2e_time': e2e_time,
+            'completed_at': time.time(),
+        })
+
+
+    def _append_to_ledger(self, run):
+        # a single append of a short line is atomic, so concurrent workers and array tasks can share the ledger
+        os.makedirs(self._runs_dir(), exist_ok=True)
+        fd = os.open(os.path.join(self._runs_dir(), RUN_LEDGER_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(run) + '\n').encode())
+        finally:
+            os.close(fd)
+
+
+    def _run_slurm_array_tasks(self):
+        array_task_idx = int(os.environ['SLURM_ARRAY_TASK_ID']) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+        array_task_count = int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1))
+        tasks = self._tasks()[array_task_idx::array_task_count]
+        logger.info(f'Running {len(tasks)} experiment tasks in SLURM array task {array_task_idx} of {array_task_count}...')
+
+        runs = self._completed_runs()
+        failed = []
+        for name, seed in tasks:
+            if self._completed_run(name, seed, runs) is None:
+                try:
+                    _run_comparison_task(name, seed, self)
+                except Exception as e:
+                    # the driver stops waiting for runs which failed, the remaining tasks are still run
+                    logger.exception(f'Experiment {name} (seed {seed}) failed.')
+                    self._append_to_ledger({
+                        'name': name,
+                        'seed': seed,
+                        'config_hash': self.config_hashes[name],
+                        'status': 'failed',
+                        'error': repr(e),
+                        'failed_at': time.time(),
+                    })
+                    failed.append((name, seed))
+
+        if failed:
+            raise Exception(f'Runs (experiment, seed) {failed} of SLURM array task {array_task_idx} failed.')
+
+
+    def _collect_slurm_array_results(self):
+        pending = set(self.experiments)
+        deadline = time.time() + SLURM_TIMEOUT_SECONDS
+        logger.info(f'Waiting for SLURM array tasks to write results to {self._runs_dir()}...')
+
+        while pending:
+            # checked before reading the ledger, so that an array which has ended has written all of its runs
+            array_active = self._slurm_array_active()
+            runs = self._completed_runs()
+
+            for name in sorted(pending):
+                if all(self._completed_run(name, seed, runs) for seed in range(self.n_seeds)):
+                    results = {seed: self._load_run(name, seed, runs) for seed in range(self.n_seeds)}
+                    self._complete_experiment_from_results(name, results)
+                    pending.remove(name)
+
+            if not pending:
+                break
+
+            missing = [(name, seed) for name in sorted(pending) for seed in range(self.n_seeds) if not self._completed_run(name, seed, runs)]
+            failed_runs = self._failed_runs()
+            failed = {(name, seed): run['error'] for name, seed in missing if (run := failed_runs.get((name, seed, self.config_hashes[name])))}
+
+            if failed:
+                raise Exception(f'Runs (experiment, seed) {list(failed)} of the SLURM array failed: {list(failed.values())}. Missing runs: {missing}.')
+
+            if not array_active:
+                raise Exception(f'SLURM array job {self.slurm_array_job_id} ended without writing the runs (experiment, seed) {missing}.')
+
+            if time.time() > deadline:
+                raise Exception(f'Timed out after {SLURM_TIMEOUT_SECONDS} s waiting for the runs (experiment, seed) {missing} of the SLURM array.')
+
+            time.sleep(SLURM_POLL_INTERVAL_SECONDS)
+
+
+    def _slurm_array_active(self):
+        # without the job id of the array, only failed runs and the timeout end the waiting
+        if self.slurm_array_job_id is None:
+            return True
+
+        try:
+            queue = subprocess.run(['squeue', '--noheader', '--array', '--jobs', str(self.slurm_array_job_id), '--format=%i'],
+                                   capture_output=True, text=True, timeout=60)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f'Could not query the state of SLURM array job {self.slurm_array_job_id}: {e}')
+            return True
+
+        # squeue rejects the ids of jobs which have left the queue
+        if queue.returncode != 0:
+            if 'Invalid job id' in queue.stderr:
+                return False
+            logger.warning(f'Could not query the state of SLURM array job {self.slurm_array_job_id}: {queue.stderr.strip()}')
+            return True
+
+        return bool(queue.stdout.strip())
+
+
+    def _complete_experiment_from_results(self, name, results):
+        self.predictors[name] = [results[seed][0] for seed in range(self.n_seeds)]
+        # report the average end-to-end time per seed as if the experiment ran sequentially
+        self.time_start = time.time() - sum(results[seed][1] for seed in range(self.n_seeds))
+        self._complete_experiment(name)
+
+
+    def _complete_experiment(self, name):
+        self.comparison_metrics.append(self._evaluate_experiment(name))
+        if self.save_results:
+            self._save_intermediate_results(name)
+
+        if not self.keep_predictor_in_memory:
+            del self.predictors[name]
+            gc.collect()
 
 
     def _evaluate_experiment(self, name):
@@ -867,12 +2339,10 @@ class PredictorComparison:
 
 
     def _save_intermediate_results(self, name):
+        # the results of the predictors themselves are recorded per run (see _save_run)
         path = os.path.join(f'{self.exp_name}-itermediate-comparison-results.csv')
         self.evaluate().to_csv(path, index=False)
 
-        for seed, predictor in enumerate(self.predictors[name]):
-            predictor.save(f'{self.exp_name}-model-{name}-{seed}.pkl')
-
 
     def _mean(self, predictors, func, *args, **kwargs):
         return np.mean([getattr(p, func)(*args, **kwargs) for p in predictors], axis=0)
@@ -886,11 +2356,11 @@ class PredictorComparison:
         raise NotImplementedError('To be implemented.')
 
 
-    def save(self, path, results_only=False):
+    def save(self, path, results_only=False, format='pickle'):
         file_name, ext = os.path.splitext(path)
         for name, predictors in self.predictors.items():
             for seed, predictor in enumerate(predictors):
-                predictor.save(f'{file_name}_{name}_{seed}{ext}', results_only)
+                predictor.save(f'{file_name}_{name}_{seed}{ext}', results_only, format)
 
 
     def evaluate_feature_importance(self, normalize_by_number_of_features=True):
@@ -12,7 +12,7 @@ import visualizations
 import dataset
 import preprocessing
 import energy_modeling
-from prediction import Predictor, Classifier, Regressor, PredictorComparison
+from prediction import Predictor, Classifier, Regressor, PredictorComparison, FoldMetrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -20,6 +20,8 @@ logger.setLevel(logging.INFO)
 
 class AgePredictor(Regressor):
 
+    FOLD_METRICS = Regressor.FOLD_METRICS + ['energy_error']
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs, target_attribute=dataset.AGE_ATTRIBUTE)
 
@@ -54,8 +56,9 @@ class AgePredictor(Regressor):
             eval_df.at['total', f'within_{bin}_years'] = hist.flat[idx]
 
         if self.cross_validation_split:
-            fold_histograms = self.error_cum_hist(bins, across_folds=True)
-            fold_energy_errors = self.energy_error(across_folds=True)
+            fold_metrics = FoldMetrics(self)
+            fold_histograms = fold_metrics.error_cum_hist(bins)
+            fold_energy_errors = fold_metrics.energy_error()
             logger.info(fold_energy_errors)
 
             for fold, hist in enumerate(fold_histograms):
@@ -149,7 +152,7 @@ class AgePredictor(Regressor):
 
     @staticmethod
     def load(path):
-        predictor = pickle.load(open(path, 'rb'))
+        predictor = Predictor.load(path)
 
         if isinstance(predictor, AgePredictor):
             return predictor
@@ -159,6 +162,8 @@ class AgePredictor(Regressor):
 
 class AgeClassifier(Classifier):
 
+    FOLD_METRICS = Classifier.FOLD_METRICS + ['energy_error']
+
     def __init__(self, bins=[], bin_config=None, resampling=None, *args, **kwargs):
 
         if not bins and bin_config is None or bins and bin_config:
@@ -190,7 +195,7 @@ class AgeClassifier(Classifier):
             eval_df.at['total', 'energy_mape'] = mape
 
         if self.cross_validation_split:
-            fold_energy_errors = self.energy_error(across_folds=True)
+            fold_energy_errors = FoldMetrics(self).energy_error()
             for fold, energy_error in enumerate(fold_energy_errors):
                 eval_df.at[f'fold_{fold}', 'energy_r2'] = energy_error[0]
                 eval_df.at[f'fold_{fold}', 'energy_mape'] = energy_error[1]
@@ -287,7 +292,7 @@ class AgeClassifier(Classifier):
 
     @staticmethod
     def load(path):
-        predictor = pickle.load(open(path, 'rb'))
+        predictor = Predictor.load(path)
 
         if isinstance(predictor, AgeClassifier):
             return predictor
@@ -341,12 +346,10 @@ class AgePredictorComparison(PredictorComparison):
             eval_metrics['energy_mape'] = mape
 
         if self.compare_spatial_autocorrelation:
-            eval_metrics['residuals_moranI_KNN'] = predictors[0].spatial_autocorrelation_moran('error', 'knn').I
-            eval_metrics['residuals_moranI_block'] = predictors[0].spatial_autocorrelation_moran('error', 'block').I
-            eval_metrics['residuals_moranI_distance'] = predictors[0].spatial_autocorrelation_moran('error', 'distance').I
-            eval_metrics['prediction_moranI_KNN'] = predictors[0].spatial_autocorrelation_moran(predictors[0].target_attribute, 'knn').I
-            eval_metrics['prediction_moranI_block'] = predictors[0].spatial_autocorrelation_moran(predictors[0].target_attribute, 'block').I
-            eval_metrics['prediction_moranI_distance'] = predictors[0].spatial_autocorrelation_moran(predictors[0].target_attribute, 'distance').I
+            # the weights of the test set are built once and shared with all experiments and seeds evaluated on it
+            for prefix, attribute in [('residuals', 'error'), ('prediction', predictors[0].target_attribute)]:
+                for type, label in [('knn', 'KNN'), ('block', 'block'), ('distance', 'distance')]:
+                    eval_metrics[f'{prefix}_moranI_{label}'] = predictors[0].spatial_autocorrelation_moran(attribute, type, self.spatial_weights).I
 
         if self.compare_classification_error:
             for bin_size in [5, 10, 20]:
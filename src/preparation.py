@@ -23,7 +23,9 @@ def prepare(df, sbb_gdf):
 
 
 def add_block_column(df):
-    df['block'] = utils.seq_to_unique_id(df.groupby(['city', 'TouchesIndexes']).ngroup())
+    # TouchesIndexes may be parsed into lists, which are not hashable
+    touches_indexes = df['TouchesIndexes'].map(lambda l: tuple(l) if isinstance(l, list) else l)
+    df['block'] = utils.seq_to_unique_id(df.groupby([df['city'], touches_indexes]).ngroup())
     return df
 
 
@@ -111,7 +113,7 @@ def add_residential_type_column(df):
     else:
         res = df[dataset.TYPE_ATTRIBUTE] == dataset.RESIDENTIAL_TYPE
 
-    df['n_neighbors'] = df['TouchesIndexes'].fillna('[1]').apply(lambda l: len(ast.literal_eval(l)))
+    df['n_neighbors'] = df['TouchesIndexes'].fillna('[1]').apply(lambda l: len(l if isinstance(l, list) else ast.literal_eval(l)))
     floors = df['floors'].fillna(np.floor(df['height'] / MIN_HEIGHT_PER_FLOOR))
 
     mask_mfh = (df['FootprintArea'] > 300) & (floors <= 5)
@@ -184,13 +184,17 @@ def _group_cross_validation(df, attribute, balanced_attribute=None, spatial_buff
         group_kfold = model_selection.GroupKFold(n_splits=n_splits)
         iterator = group_kfold.split(df, groups=df[attribute].values)
 
+    if spatial_buffer_size:
+        # build the spatial index once and reuse it for all folds
+        spatial_index = geometry.SpatialIndex(geometry.building_centroids(df))
+
     for train_idx, test_idx in iterator:
         train_df = df.iloc[train_idx]
         test_df = df.iloc[test_idx]
 
         if spatial_buffer_size:
-            buffer_ids = geometry.spatial_buffer_around_block(df, block_type=attribute, buffer_size_meters=spatial_buffer_size, block_ids=test_df[attribute].unique())
-            train_df = train_df[train_df['id'].isin(buffer_ids)]
+            buffer_mask = geometry.spatial_buffer_around_block(df, block_type=attribute, buffer_size_meters=spatial_buffer_size, block_ids=test_df[attribute].unique(), index=spatial_index)
+            train_df = train_df[buffer_mask[train_idx]]
 
         yield train_df, test_df
 
@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import xgboost
+
+import inference
+import artifacts
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MAX_BATCH_SIZE = 1024
+MAX_BATCH_DELAY_SECONDS = 0.002
+LATENCY_WINDOW = 10_000
+MAX_BODY_SIZE_BYTES = 16 * 1024 * 1024
+
+MODEL_FILE = 'model.ubj'
+SCHEMA_FILE = 'schema.json'
+FEATURE_STORE_IDS_FILE = 'ids.npy'
+FEATURE_STORE_FEATURES_FILE = 'features.npy'
+
+
+def export_model(predictor, path):
+    # saves only what is required for serving: the booster and the feature schema
+    os.makedirs(path, exist_ok=True)
+    booster = predictor.model.get_booster()
+    booster.save_model(os.path.join(path, MODEL_FILE))
+
+    schema = {
+        'features': booster.feature_names,
+        'labels': getattr(predictor, 'labels', None),
+        'target_attribute': predictor.target_attribute,
+    }
+    with open(os.path.join(path, SCHEMA_FILE), 'w') as f:
+        json.dump(schema, f, indent=4)
+
+
+def load_model(path):
+    # either exported for serving or a predictor artifact
+    if artifacts.is_artifact(path):
+        booster, manifest = artifacts.load_booster(path)
+        attributes = manifest['attributes']
+        return booster, {'features': booster.feature_names, 'labels': attributes.get('labels'), 'target_attribute': attributes.get('target_attribute')}
+
+    booster = xgboost.Booster()
+    booster.load_model(os.path.join(path, MODEL_FILE))
+
+    with open(os.path.join(path, SCHEMA_FILE)) as f:
+        schema = json.load(f)
+
+    return booster, schema
+
+
+def build_feature_store(data, path, features, batch_size=inference.INFERENCE_BATCH_SIZE):
+    """
+    Writes the features of all buildings of a country dataset to memory-mappable arrays to look them up by building id.
+
+    The ids are stored sorted, so that buildings can be found by binary search without loading the store into memory.
+    """
+    os.makedirs(path, exist_ok=True)
+    ids = np.concatenate([batch['id'].astype(str).values.astype(str) for batch in inference.dataset_batches(data, ['id'], batch_size)])
+    order = np.argsort(ids, kind='stable')
+    positions = np.empty_like(order)
+    positions[order] = np.arange(len(order))
+
+    np.save(os.path.join(path, FEATURE_STORE_IDS_FILE), ids[order])
+    del ids
+
+    store = np.lib.format.open_memmap(
+        os.path.join(path, FEATURE_STORE_FEATURES_FILE), mode='w+', dtype=np.float32, shape=(len(order), len(features)))
+
+    offset = 0
+    for batch in inference.dataset_batches(data, features, batch_size):
+        store[positions[offset:offset + len(batch)]] = batch.reindex(columns=features).to_numpy(dtype=np.float32, na_value=np.nan)
+        offset += len(batch)
+
+    store.flush()
+    with open(os.path.join(path, SCHEMA_FILE), 'w') as f:
+        json.dump({'features': list(features)}, f, indent=4)
+
+    logger.info(f'Saved the features of {len(order)} buildings to the feature store {path}.')
+
+
+class FeatureStore:
+
+    def __init__(self, path):
+        self.ids = np.load(os.path.join(path, FEATURE_STORE_IDS_FILE), mmap_mode='r')
+        self.features = np.load(os.path.join(path, FEATURE_STORE_FEATURES_FILE), mmap_mode='r')
+
+        with open(os.path.join(path, SCHEMA_FILE)) as f:
+            self.feature_names = json.load(f)['features']
+
+
+    def lookup(self, ids):
+        ids = np.asarray(ids, dtype=str)
+        if len(self.ids) == 0:
+            return self.features[:0], np.zeros(len(ids), dtype=bool)
+
+        positions = np.searchsorted(self.ids, ids).clip(max=len(self.ids) - 1)
+        found = self.ids[positions] == ids
+        return self.features[positions[found]], found
+
+
+class AgeService:
+    """
+    Online age prediction for buildings given by id or by feature vector.
+
+    Concurrent requests are collected into micro-batches of up to max_batch_size buildings, waiting at most
+    max_batch_delay seconds for further requests, and predicted together in a background thread.
+    """
+
+    def __init__(self, model_path, feature_store_path=None, max_batch_size=MAX_BATCH_SIZE, max_batch_delay=MAX_BATCH_DELAY_SECONDS, max_body_size=MAX_BODY_SIZE_BYTES):
+        self.booster, self.schema = load_model(model_path)
+        self.features = self.schema['features']
+        self.labels = self.schema['labels']
+        self.iteration_range = inference.iteration_range(self.booster)
+        self.feature_store = FeatureStore(feature_store_path) if feature_store_path else None
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.max_body_size = max_body_size
+
+        if self.feature_store and self.feature_store.feature_names != self.features:
+            raise Exception(f'The features of the feature store {feature_store_path} do not match the features of the model {model_path}.')
+
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = collections.deque(maxlen=LATENCY_WINDOW)
+        self.n_requests = 0
+        self.queue = None
+        self.batcher = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+
+    async def predict(self, ids=None, features=None):
+        time_start = time.perf_counter()
+
+        if ids is not None:
+            if self.feature_store is None:
+                raise Exception('Predicting buildings by id requires a feature store.')
+            X, found = self.feature_store.lookup(ids)
+        else:
+            X, found = self._feature_matrix(features), None
+
+        predictions = iter(await self._enqueue(X))
+        if found is None:
+            results = [self._result(prediction) for prediction in predictions]
+        else:
+            results = [{'id': id, **self._result(next(predictions))} if known else {'id': id, 'error': 'Unknown building id.'}
+                       for id, known in zip(ids, found)]
+
+        self.latencies.append(time.perf_counter() - time_start)
+        self.n_requests += 1
+        return results
+
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'requests': self.n_requests,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+        }
+
+
+    def _feature_matrix(self, features):
+        # feature vectors are either given as mappings of feature names to values or as lists in the order of the schema
+        if features and isinstance(features[0], dict):
+            features = [[vector.get(name, np.nan) for name in self.features] for vector in features]
+
+        X = np.array(features, dtype=np.float32).reshape(-1, len(self.features))
+        return X
+
+
+    def _result(self, prediction):
+        if self.labels is None:
+            return {'age': float(prediction)}
+
+        return {'age': self.labels[int(prediction.argmax())], 'probabilities': prediction.tolist()}
+
+
+    async def _enqueue(self, X):
+        if self.batcher is None:
+            self.queue = asyncio.Queue()
+            self.batcher = asyncio.create_task(self._batch_predictions())
+
+        if len(X) == 0:
+            return []
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((X, future))
+        return await future
+
+
+    async def _batch_predictions(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            requests = [await self.queue.get()]
+            n_buildings = len(requests[0][0])
+            deadline = loop.time() + self.max_batch_delay
+
+            while n_buildings < self.max_batch_size and (timeout := deadline - loop.time()) > 0:
+                try:
+                    requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                n_buildings += len(requests[-1][0])
+
+            X = np.concatenate([X for X, _ in requests])
+            try:
+                predictions = await loop.run_in_executor(self.executor, self._predict, X)
+            except Exception as e:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            # futures of callers which were cancelled in the meantime are done already
+            self.batch_sizes.append(len(X))
+            offset = 0
+            for X, future in requests:
+                if not future.done():
+                    future.set_result(predictions[offset:offset + len(X)])
+                offset += len(X)
+
+
+    def _predict(self, X):
+        prediction = self.booster.inplace_predict(X, iteration_range=self.iteration_range)
+        return prediction if self.labels is None else inference.class_probabilities(prediction)
+
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while request_line := await reader.readline():
+                header_lines = []
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    header_lines.append(line)
+
+                try:
+                    method, target, headers, content_length = self._parse_request(request_line, header_lines)
+                except (ValueError, UnicodeDecodeError):
+                    # the end of a malformed request is unknown, so the connection is closed after responding
+                    await self._respond(writer, '400 Bad Request', {'error': 'Malformed request line or headers.'})
+                    break
+
+                if content_length > self.max_body_size:
+                    # the body is not read, so the connection is closed after responding
+                    await self._respond(writer, '413 Payload Too Large', {'error': f'Request bodies are limited to {self.max_body_size} bytes.'})
+                    break
+
+                body = await reader.readexactly(content_length)
+                status, response = await self._route(method, target, body)
+                await self._respond(writer, status, response)
+
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+    def _parse_request(self, request_line, header_lines):
+        method, target, _ = request_line.decode().split(' ', 2)
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        content_length = int(headers.get('content-length', 0))
+        if content_length < 0:
+            raise ValueError(f'Negative content length {content_length}.')
+        return method, target, headers, content_length
+
+
+    async def _respond(self, writer, status, response):
+        payload = json.dumps(response).encode()
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+        await writer.drain()
+
+
+    async def _route(self, method, target, body):
+        if method == 'GET' and target == '/metrics':
+            return '200 OK', self.metrics()
+
+        if method == 'POST' and target == '/predict':
+            try:
+                request = json.loads(body or b'{}')
+                return '200 OK', await self.predict(ids=request.get('ids'), features=request.get('features'))
+            except Exception as e:
+                return '400 Bad Request', {'error': str(e)}
+
+        return '404 Not Found', {'error': f'Unknown endpoint {method} {target}. Use POST /predict or GET /metrics.'}
+
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f'Serving age predictions on http://{host}:{port}/predict...')
+        async with server:
+            await server.serve_forever()
+
+
+def serve(model_path, feature_store_path=None, host='127.0.0.1', port=8000, **kwargs):
+    service = AgeService(model_path, feature_store_path, **kwargs)
+    asyncio.run(service.serve(host, port))
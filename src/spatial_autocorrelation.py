@@ -1,6 +1,9 @@
+import os
 import logging
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import libpysal as lps
 import splot
 from esda.moran import Moran
@@ -8,15 +11,30 @@ from esda.moran import Moran
 import dataset
 import preparation
 import utils
+import spatial_weights
 
 logger = logging.getLogger(__name__)
 
+CORRELOGRAM_DISTANCES = [2 ** i for i in range(2, 11)]
+
+WEIGHT_TYPES = ['knn', 'block', 'distance']
+
+MORAN_PERMUTATIONS = 999
+MORAN_PERMUTATION_BLOCK_SIZE = 50
+MORAN_ATTRIBUTE_CHUNK_SIZE = 32
+
+LISA_SIGNIFICANCE = 0.05
+LISA_CHUNK_ELEMENTS = 10_000_000
+LISA_CLUSTERS = ['HH', 'LH', 'LL', 'HL', 'ns']
+HOTSPOTS = ['hot', 'cold', 'ns']
+
+
 
 def moran_within_block(df, attribute=dataset.AGE_ATTRIBUTE):
     df = df.dropna(subset=[attribute])
 
-    if not 'block_bld_ids' in df.columns:
-        df = preparation.add_block_building_ids_column(df)
+    if not 'block' in df.columns and not 'block_bld_ids' in df.columns:
+        df = preparation.add_block_column(df)
 
     weights = _within_block_weights(df)
     return Moran(df[attribute], weights)
@@ -25,7 +43,7 @@ def moran_within_block(df, attribute=dataset.AGE_ATTRIBUTE):
 def moran_within_sbb(df, attribute=dataset.AGE_ATTRIBUTE):
     df = df.dropna(subset=[attribute])
 
-    if not 'sbb_bld_ids' in df.columns:
+    if not 'sbb' in df.columns and not 'sbb_bld_ids' in df.columns:
         df = preparation.add_sbb_building_ids_column(df)
 
     weights = _within_sbb_weights(df)
@@ -85,30 +103,196 @@ def moran_knn(gdf, k=4, attribute=dataset.AGE_ATTRIBUTE):
     return Moran(gdf[attribute], weights)
 
 
+def weights(df, type, k=4, distance_threshold=15):
+    # weights as used by moran_knn, moran_within_block and moran_distance, knn and distance weights require a GeoDataFrame
+    if type == 'knn':
+        return _knn_weights(df, k)
+
+    if type == 'distance':
+        return _distance_weights(df, distance_threshold)
+
+    if type == 'block':
+        if not 'block' in df.columns and not 'block_bld_ids' in df.columns:
+            df = preparation.add_block_column(df)
+        return _within_block_weights(df)
+
+    raise Exception(f'Unknown weight type {type}. Please use one of {WEIGHT_TYPES}.')
+
+
+def moran(df, weights, attribute=dataset.AGE_ATTRIBUTE):
+    return Moran(df[attribute], weights)
+
+
 def moran_I(df, weights, attribute=dataset.AGE_ATTRIBUTE):
-    return Moran(df[attribute], weights).I
+    return moran(df, weights, attribute).I
 
 
-def features_moran_I(df, weight_func, features=dataset.FEATURES):
+def features_moran_I(df, weight_func, features=dataset.FEATURES, permutations=MORAN_PERMUTATIONS, n_jobs=None):
     weights = weight_func(df)
-    m_features = []
-    for feat in set(df.columns).intersection(features):
-        m = Moran(df[feat], weights)
-        m_features.append({'feature': feat, 'moran_I': m.I, 'moran_p': m.p_sim})
-
-    return pd.DataFrame(m_features).sort_values(by='moran_I', ascending=False)
+    features = list(set(df.columns).intersection(features))
+    m_features = moran_permutation_test(df, features, weights, permutations, n_jobs)
+    return m_features.rename(columns={'attribute': 'feature'}).sort_values(by='moran_I', ascending=False)
+
+
+def moran_permutation_test(df, attributes, weights, permutations=MORAN_PERMUTATIONS, n_jobs=None, seed=None):
+    """
+    Moran's I of many attributes with pseudo p-values like esda.Moran.p_sim, based on a single sparse weights matrix.
+
+    All attributes are permuted together, i.e. one permutation of the buildings is applied to the columns of the
+    attribute matrix and the spatial lags of all attributes are a single sparse product. Blocks of permutations are
+    distributed across forked worker processes and seeded independently of the number of workers for reproducibility.
+    """
+    weights = spatial_weights.row_standardized(weights)
+    Z = df[attributes].to_numpy(dtype=float)
+    Z = Z - Z.mean(axis=0)
+    moran_I = _moran_I(weights, Z)
+
+    seed = dataset.GLOBAL_REPRODUCIBILITY_SEED if seed is None else seed
+    block_sizes = [min(MORAN_PERMUTATION_BLOCK_SIZE, permutations - start) for start in range(0, permutations, MORAN_PERMUTATION_BLOCK_SIZE)]
+    block_seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+    n_workers = min(len(block_sizes), n_jobs or os.cpu_count())
+
+    with utils.fork_pool(n_workers, permutation_inputs=(weights, Z, moran_I)) as executor:
+        larger = sum(executor.map(_count_larger_permutations, block_sizes, block_seeds))
+
+    larger = np.minimum(larger, permutations - larger)
+    moran_p = (larger + 1.0) / (permutations + 1.0) if permutations else np.full(len(attributes), np.nan)
+    return pd.DataFrame({'attribute': attributes, 'moran_I': moran_I, 'moran_p': moran_p})
+
+
+def _count_larger_permutations(block_size, block_seed):
+    weights, Z, moran_I = utils.worker_state('permutation_inputs')
+    rng = np.random.default_rng(block_seed)
+
+    # the attributes are permuted in chunks of columns to bound the memory of the permuted copies for many attributes
+    larger = np.zeros(Z.shape[1], dtype=int)
+    for _ in range(block_size):
+        permutation = rng.permutation(len(Z))
+        for start in range(0, Z.shape[1], MORAN_ATTRIBUTE_CHUNK_SIZE):
+            columns = slice(start, start + MORAN_ATTRIBUTE_CHUNK_SIZE)
+            larger[columns] += _moran_I(weights, Z[permutation, columns]) >= moran_I[columns]
+    return larger
+
+
+def _moran_I(weights, Z):
+    # Moran's I of the centered columns of Z for row-standardized weights
+    s0 = weights.sum()
+    return len(Z) / s0 * (Z * (weights @ Z)).sum(axis=0) / (Z * Z).sum(axis=0)
+
+
+def local_autocorrelation(values, weights, permutations=MORAN_PERMUTATIONS, significance=LISA_SIGNIFICANCE, n_jobs=None, seed=None):
+    """
+    Local Moran's I and Getis-Ord Gi* z-scores of all buildings with pseudo p-values of conditional permutations like esda.Moran_Local.
+
+    Both statistics of a building are monotonic in its spatial lag, so that the folded conditional permutation test of
+    the lag yields the p-values of both. The random neighbor sets are drawn once and shared by all buildings, which are
+    tested in chunks distributed across forked worker processes. Significant buildings are labelled by the quadrant of
+    the Moran scatterplot (HH, LH, LL, HL) and as hot or cold spots, all others as not significant (ns).
+    """
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    binary_weights = spatial_weights.to_sparse(weights)
+    weights = spatial_weights.row_standardized(binary_weights)
+
+    z = (x - x.mean()) / x.std()
+    lag = weights @ z
+    local_I = (n - 1) * z * lag / (z * z).sum()
+    getis_ord_z = _getis_ord_z(binary_weights, x)
+
+    # the random neighbor sets are as large as the maximum cardinality, the neighbors of a building use their first positions
+    cardinalities = np.diff(weights.indptr)
+    max_cardinality = min(cardinalities.max(initial=0), n - 1)
+
+    seed = dataset.GLOBAL_REPRODUCIBILITY_SEED if seed is None else seed
+    rng = np.random.default_rng(seed)
+    neighbor_draws = np.array([rng.choice(n - 1, max_cardinality, replace=False) for _ in range(permutations)], dtype=int).reshape(permutations, max_cardinality)
+
+    # chunks of consecutive buildings bounded by the number of simulated neighbors and lags, i.e. weights and buildings
+    chunk_cost = max(1, LISA_CHUNK_ELEMENTS // max(1, permutations))
+    cost = weights.indptr[:-1] + np.arange(n)
+    bounds = np.unique(np.searchsorted(cost, np.arange(0, cost[-1] + 1 if n else 0, chunk_cost)))
+    chunks = list(zip(bounds, np.append(bounds[1:], n)))
+    n_workers = min(len(chunks), n_jobs or os.cpu_count())
+
+    with utils.fork_pool(n_workers, lisa_inputs=(z, lag, weights, neighbor_draws)) as executor:
+        larger = np.concatenate(list(executor.map(_count_larger_local_lags, chunks)) or [np.zeros(0, dtype=int)])
+
+    larger = np.minimum(larger, permutations - larger)
+    p = (larger + 1.0) / (permutations + 1.0)
+    p[cardinalities == 0] = np.nan
+
+    significant = p <= significance
+    quadrants = np.select([(z > 0) & (lag > 0), (z <= 0) & (lag > 0), (z <= 0) & (lag <= 0)], LISA_CLUSTERS[:3], LISA_CLUSTERS[3])
+    hotspots = np.where(getis_ord_z > 0, HOTSPOTS[0], HOTSPOTS[1])
+
+    return pd.DataFrame({
+        'local_moran_I': local_I.astype(np.float32),
+        'getis_ord_z': getis_ord_z.astype(np.float32),
+        'p': p.astype(np.float32),
+        'cluster': pd.Categorical(np.where(significant, quadrants, 'ns'), categories=LISA_CLUSTERS),
+        'hotspot': pd.Categorical(np.where(significant, hotspots, 'ns'), categories=HOTSPOTS),
+    })
+
+
+def _count_larger_local_lags(chunk):
+    z, lag, weights, neighbor_draws = utils.worker_state('lisa_inputs')
+    start, end = chunk
+
+    # the weights of the chunk in CSR order, each drawn neighbor is weighted by the weight of the same rank of a building
+    entries = np.arange(weights.indptr[start], weights.indptr[end])
+    buildings = np.repeat(np.arange(start, end), np.diff(weights.indptr[start:end + 1]))
+    ranks = entries - weights.indptr[buildings]
+
+    # positions at and after a building are shifted by one to never draw the building itself
+    draws = neighbor_draws[:, ranks]
+    draws += draws >= buildings
+    summation = sp.csr_matrix((np.ones(len(entries)), (buildings - start, np.arange(len(entries)))), shape=(end - start, len(entries)))
+    simulated_lags = summation @ (z[draws] * weights.data[entries]).T
+    return (simulated_lags >= lag[start:end, np.newaxis]).sum(axis=1)
+
+
+def _getis_ord_z(weights, x):
+    # Gi* including the building itself, standardized analytically (Getis and Ord 1995)
+    n = len(x)
+    weights = weights + sp.identity(n, format='csr')
+    w_sum = np.asarray(weights.sum(axis=1)).ravel()
+    s1 = np.asarray(weights.multiply(weights).sum(axis=1)).ravel()
+    s = np.sqrt((x * x).mean() - x.mean() ** 2)
+    return (weights @ x - x.mean() * w_sum) / (s * np.sqrt((n * s1 - w_sum ** 2) / (n - 1)))
+
+
+def correlogram(df, attributes, distances=None):
+    """
+    Moran's I of the attributes for the distance bands between consecutive distances (row-standardized binary weights).
+
+    The building pairs within the largest distance are queried once and sorted by their distance, so that every band
+    is a slice of them. The coefficients of all bands are then computed at once per attribute from the pairs.
+    """
+    distances = sorted(distances or CORRELOGRAM_DISTANCES)
+    n = len(df)
+    row, col, pair_distances = spatial_weights.distance_pairs(spatial_weights.spatial_index(df), distances[-1])
+
+    bounds = np.searchsorted(pair_distances, distances, side='right')
+    band = np.repeat(np.arange(len(distances)), np.diff(bounds, prepend=0))
+
+    # each pair contributes z_i * z_j to the spatial lag of both buildings, weighted by their number of neighbors in the band
+    degree = np.bincount(np.concatenate([band * n + row, band * n + col]), minlength=len(distances) * n).reshape(len(distances), n)
+    inverse_degree = np.divide(1, degree, out=np.zeros(degree.shape), where=degree > 0)
+    pair_weights = inverse_degree[band, row] + inverse_degree[band, col]
+    s0 = (degree > 0).sum(axis=1)
+
+    coefficients = {}
+    for attr in attributes:
+        z = df[attr].to_numpy(dtype=float)
+        z = z - z.mean()
+        numerator = np.bincount(band, weights=pair_weights * z[row] * z[col], minlength=len(distances))
+        coefficients[attr] = np.divide(n * numerator, s0 * (z * z).sum(), out=np.full(len(distances), np.nan), where=s0 > 0)
+
+    return pd.DataFrame(coefficients, index=distances)
 
 
 def plot_correlogram_over_distance(df, attributes, distances=None):
-    distances = distances or [2 ** i for i in range(2, 11)]
-    coefficients = []
-    neighbors = {}
-    for dis in distances:
-        weights = _distance_band_weights(df, distance_threshold=dis, neighbors_to_exclude=neighbors)
-        neighbors = weights.neighbors
-        coefficients.append({attr: Moran(df[attr], weights).I for attr in attributes})
-
-    df = pd.DataFrame(coefficients, index=distances)
+    df = correlogram(df, attributes, distances)
     ax = df.plot(kind='line', title='Spatial autocorrelation over distance')
     ax.set_ylabel("Moran's I")
     ax.set_xlabel('distance [m]')
@@ -130,77 +314,55 @@ def plot_few_spatial_weights(weights, gdf, every_n=100):
 
 
 def _within_block_weights(df):
-    neighbors = df[['id', 'block_bld_ids']].set_index('id').to_dict()['block_bld_ids']
-    _remove_neighbors_missing_in_dataset(neighbors)
-    neighbors_exc_self = {k: v[1:] for k, v in neighbors.items()}
-    return lps.weights.W(neighbors_exc_self, id_order=df['id'].values, silence_warnings=True)
+    codes = _block_codes(df, 'block', 'block_bld_ids')
+    return spatial_weights.to_graph(spatial_weights.same_group(codes))
 
 
 def _within_sbb_weights(df):
-    neighbors = df[['id', 'sbb_bld_ids']].set_index('id').to_dict()['sbb_bld_ids']
-    neighbors_exc_self = {k: v[1:] for k, v in neighbors.items()}
-    return lps.weights.W(neighbors_exc_self, id_order=df['id'].values, silence_warnings=True)
+    codes = _block_codes(df, 'sbb', 'sbb_bld_ids')
+    return spatial_weights.to_graph(spatial_weights.same_group(codes))
 
 
 def _between_blocks_weights(df):
-    neighbors = _neighboring_blocks_buildings(df, 'block', 50)
-    return lps.weights.W(neighbors, id_order=df['id'].values, silence_warnings=True)
+    weights = _neighboring_blocks_buildings(df, 'block', 50)
+    return spatial_weights.to_graph(weights)
 
 
 def _between_sbbs_weights(df):
-    neighbors = _neighboring_blocks_buildings(df, 'sbb', 100)
-    return lps.weights.W(neighbors, id_order=df['id'].values, silence_warnings=True)
+    weights = _neighboring_blocks_buildings(df, 'sbb', 100)
+    return spatial_weights.to_graph(weights)
 
 
 def _distance_weights(gdf, distance_threshold):
-    return lps.weights.DistanceBand.from_dataframe(gdf, threshold=distance_threshold, silence_warnings=True)
-
-
-def _distance_band_weights(gdf, distance_threshold, neighbors_to_exclude):
-    dis = lps.weights.DistanceBand.from_dataframe(gdf, threshold=distance_threshold, ids=gdf['id'].values, silence_warnings=True)
-    neighbors = {}
-    for building_id, neighbor_ids in dis.neighbors.items():
-        neighbors[building_id] = [n for n in neighbor_ids if n not in neighbors_to_exclude.get(building_id, [])]
-    return lps.weights.W(neighbors, id_order=gdf['id'].values, silence_warnings=True)
+    weights = spatial_weights.distance_band(spatial_weights.spatial_index(gdf), distance_threshold)
+    return spatial_weights.to_graph(weights)
 
 
 def _distance_weights_exc_block(gdf, block_type, distance_threshold):
     if not block_type in gdf.columns:
         raise Exception(f'block_type {block_type} not found in columns. Consider executing add_block_column() or add_street_block_column() to prepare the dataset.')
 
-    dis = lps.weights.DistanceBand.from_dataframe(gdf, threshold=distance_threshold, ids=gdf['id'].values, silence_warnings=True)
-    neighbors_exc_block = utils.exclude_neighbors_from_own_block(dis.neighbors, gdf, block_type)
-
-    return lps.weights.W(neighbors_exc_block, id_order=gdf['id'].values, silence_warnings=True)
+    weights = spatial_weights.distance_band(spatial_weights.spatial_index(gdf), distance_threshold)
+    weights = spatial_weights.exclude_same_group(weights, spatial_weights.group_codes(gdf[block_type]))
+    return spatial_weights.to_graph(weights)
 
 
 def _knn_weights(gdf, k):
-    return lps.weights.distance.KNN.from_dataframe(gdf, k=k, silence_warnings=True)
+    weights = spatial_weights.knn(spatial_weights.spatial_index(gdf), k)
+    return spatial_weights.to_graph(weights)
 
 
-def _remove_neighbors_missing_in_dataset(neighbors_dict):
-    for neighbors in neighbors_dict.values():
-        for n in neighbors.copy():
-            if not n in neighbors_dict.keys():
-                neighbors.remove(n)
+def _block_codes(df, block_type, block_ids_column):
+    if block_type in df.columns:
+        return spatial_weights.group_codes(df[block_type])
+
+    # the building ids of a block identify the block, ids of buildings missing in the dataset do not matter
+    return spatial_weights.group_codes(df[block_ids_column].map(lambda ids: tuple(sorted(ids))))
 
 
 def _neighboring_blocks_buildings(df, block_type, distance_threshold):
     if not block_type in df.columns:
         raise Exception(f'block_type {block_type} not found in columns. Consider executing add_block_column() or add_street_block_column() to prepare the dataset.')
 
-    dis = lps.weights.DistanceBand.from_dataframe(df, threshold=distance_threshold, ids=df['id'].values, silence_warnings=True)
-    id_to_block = df[['id', block_type]].set_index('id').to_dict()[block_type]
-
-    neighbor_blocks = {}
-    for building_id, neighbor_ids in dis.neighbors.items():
-        own_block = id_to_block[building_id]
-        neighbor_blocks[building_id] = [id_to_block[id] for id in neighbor_ids if id_to_block[id] != own_block]
-
-    block_to_ids = df.groupby(block_type)['id'].apply(list).to_dict()
-
-    neighbor_buildings = {}
-    for building_id, blocks in neighbor_blocks.items():
-        neighbor_buildings[building_id] = utils.flatten([block_to_ids[block] for block in blocks])
-
-    return neighbor_buildings
+    weights = spatial_weights.distance_band(spatial_weights.spatial_index(df), distance_threshold)
+    return spatial_weights.neighboring_groups(weights, spatial_weights.group_codes(df[block_type]))
@@ -0,0 +1,111 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from libpysal.graph import Graph
+
+import geometry
+
+logger = logging.getLogger(__name__)
+
+"""
+Spatial weights of buildings as binary SciPy CSR matrices, which are built from the neighbor graphs of a
+geometry.SpatialIndex over the building centroids and from group codes, e.g. of blocks, instead of dictionaries of
+neighbor lists.
+
+Neighbors of the own group are excluded by masking the nonzero entries of a matrix and the buildings of neighboring
+groups are found by a sparse product with the group membership matrix. The resulting matrices are wrapped in a
+libpysal Graph, which esda.Moran accepts and which keeps the weights sparse.
+"""
+
+
+def spatial_index(gdf):
+    return geometry.SpatialIndex(gdf.geometry.centroid)
+
+
+def group_codes(values):
+    # buildings without a group get the code -1 and have no group neighbors
+    return pd.factorize(np.asarray(values))[0]
+
+
+def knn(index, k):
+    return binary(index.knn_graph(k))
+
+
+def distance_band(index, threshold):
+    return binary(_within_distance(index, threshold))
+
+
+def distance_pairs(index, max_distance):
+    # each pair of buildings within the distance once, sorted by their distance
+    pairs = _within_distance(index, max_distance).tocoo()
+    once = pairs.row < pairs.col
+    row, col, distances = pairs.row[once], pairs.col[once], pairs.data[once]
+    order = np.argsort(distances, kind='stable')
+    return row[order], col[order], distances[order]
+
+
+def _within_distance(index, distance):
+    # like libpysal's DistanceBand, buildings at exactly the distance are neighbors, but coincident buildings are not
+    graph = index.radius_graph(distance, inclusive=True)
+    graph.eliminate_zeros()
+    return graph
+
+
+def binary(graph):
+    # neighbor graphs store distances, which may be zero for coincident buildings
+    graph = graph.tocsr(copy=True)
+    graph.data[:] = 1
+    return graph
+
+
+def membership(codes):
+    # buildings x groups indicator matrix
+    grouped = np.flatnonzero(codes >= 0)
+    return sp.csr_matrix((np.ones(len(grouped)), (grouped, codes[grouped])), shape=(len(codes), codes.max(initial=-1) + 1))
+
+
+def same_group(codes):
+    groups = membership(codes)
+    weights = (groups @ groups.T).tocsr()
+    weights.setdiag(0)
+    weights.eliminate_zeros()
+    return weights
+
+
+def exclude_same_group(weights, codes):
+    weights = weights.tocoo()
+    other_group = (codes[weights.row] != codes[weights.col]) | (codes[weights.row] < 0)
+    return sp.csr_matrix((weights.data[other_group], (weights.row[other_group], weights.col[other_group])), shape=weights.shape)
+
+
+def neighboring_groups(weights, codes):
+    # all buildings of the groups, which contain a neighbor of a building other than its own group
+    groups = membership(codes)
+    neighbor_groups = exclude_same_group(weights, codes) @ groups
+    neighbor_groups.data[:] = 1
+    buildings = (neighbor_groups @ groups.T).tocsr()
+    buildings.data[:] = 1
+    return buildings
+
+
+def to_sparse(weights):
+    # sparse matrix of libpysal weights (W or Graph) or of a matrix
+    return sp.csr_matrix(getattr(weights, 'sparse', weights), dtype=float)
+
+
+def row_standardized(weights):
+    # rows sum to one except for isolated buildings
+    weights = to_sparse(weights)
+    row_sums = np.asarray(weights.sum(axis=1)).ravel()
+    return sp.diags(np.divide(1, row_sums, out=np.zeros(len(row_sums)), where=row_sums != 0)) @ weights
+
+
+def to_graph(weights, ids=None):
+    # without ids, buildings are identified by their position, which is considerably faster for large datasets
+    return Graph.from_sparse(weights.tocsr(), ids=None if ids is None else np.asarray(ids))
+
+
+def symmetric(row, col, n):
+    return sp.csr_matrix((np.ones(2 * len(row)), (np.concatenate([row, col]), np.concatenate([col, row]))), shape=(n, n))
@@ -1,12 +1,23 @@
 import os
 import ast
+import json
+import fcntl
+import contextlib
+import multiprocessing
+import hashlib
+import functools
 import math
+import shutil
+import types
 import random
 import logging
 import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 import matplotlib.pyplot as plt
 
 import dataset
@@ -24,6 +35,9 @@ To be consistent, left closed/inclusive intervals are used as well when categori
 Methods, which determine bin edges/breaks, also assume subsequent left closed/inclusive binning.
 """
 
+# state of the parent process shared with forked worker processes (see fork_pool)
+_worker_state = {}
+
 
 def age_bins(y, bin_size=1):
     # lower bound inclusive
@@ -162,37 +176,213 @@ def truncated_uuid4():
     return str(uuid.uuid4())[:8]
 
 
+def config_hash(config):
+    return hashlib.sha1(config_repr(config).encode()).hexdigest()[:12]
+
+
+def config_repr(value):
+    # stable representation of experiment configurations, which usually contain functions, models and dataframes
+    if isinstance(value, dict):
+        items = sorted(value.items(), key=lambda item: str(item[0]))
+        return '{' + ', '.join(f'{k!r}: {config_repr(v)}' for k, v in items) + '}'
+
+    if isinstance(value, (list, tuple, set)):
+        items = sorted(map(config_repr, value)) if isinstance(value, set) else map(config_repr, value)
+        return '[' + ', '.join(items) + ']'
+
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return f'{type(value).__name__}({data_fingerprint(value)})'
+
+    if isinstance(value, functools.partial):
+        return f'partial({config_repr(value.func)}, {config_repr(value.args)}, {config_repr(value.keywords)})'
+
+    if callable(value) and hasattr(value, '__qualname__'):
+        name = f'{value.__module__}.{value.__qualname__}'
+        if hasattr(value, '__code__') and ('<lambda>' in value.__qualname__ or '<locals>' in value.__qualname__):
+            # lambdas and nested functions are not identified by their name, but by their code and captured values
+            closure = [cell.cell_contents for cell in value.__closure__ or []]
+            return f'{name}({_code_repr(value.__code__)}, {config_repr(value.__defaults__)}, {config_repr(closure)})'
+        return name
+
+    if isinstance(value, types.CodeType):
+        return _code_repr(value)
+
+    if hasattr(value, 'get_params'):
+        return f'{type(value).__name__}({config_repr(value.get_params())})'
+
+    return repr(value)
+
+
+def _code_repr(code):
+    return f'code({code.co_code.hex()}, {config_repr(code.co_consts)}, {code.co_names!r})'
+
+
+def data_fingerprint(*values):
+    # order sensitive hash of the content of frames and arrays, e.g. to identify feature matrices
+    sha = hashlib.sha1()
+    for value in values:
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            columns = list(value.columns) if isinstance(value, pd.DataFrame) else [value.name]
+            sha.update(repr((type(value).__name__, value.shape, columns, list(map(str, np.atleast_1d(value.dtypes))))).encode())
+            sha.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+        elif isinstance(value, np.ndarray):
+            sha.update(repr((value.shape, str(value.dtype))).encode())
+            sha.update(np.ascontiguousarray(value).tobytes())
+        else:
+            sha.update(repr(value).encode())
+    return sha.hexdigest()
+
+
+@contextlib.contextmanager
+def fork_pool(n_workers, **state):
+    """
+    Executor of n_workers forked processes, which inherit the given state copy-on-write instead of receiving it
+    pickled with every task. Tasks read it with worker_state(name). With a single worker, tasks run in the calling process.
+    """
+    with shared_worker_state(**state):
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                yield executor
+        else:
+            yield _SerialExecutor()
+
+
+@contextlib.contextmanager
+def shared_worker_state(**state):
+    # state of the worker processes forked while it is shared, e.g. by several pools
+    _worker_state.update(state)
+    try:
+        yield
+    finally:
+        for name in state:
+            _worker_state.pop(name, None)
+
+
+def worker_state(name):
+    return _worker_state[name]
+
+
+def worker_threads(n_workers):
+    # threads of each worker process so that workers running in parallel do not oversubscribe the cpu cores
+    return max(1, (os.cpu_count() or 1) // n_workers)
+
+
+def write_atomically(path, write):
+    """
+    Writes a file or directory by calling write with a temporary path next to the given one, which then replaces it,
+    so that readers, e.g. concurrent experiments, never see a partially written output.
+    """
+    tmp_path = f'{path}.tmp-{truncated_uuid4()}'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    try:
+        write(tmp_path)
+        if os.path.isdir(tmp_path):
+            _remove(path)
+        os.replace(tmp_path, path)
+    finally:
+        _remove(tmp_path)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    # exclusive lock across processes, e.g. of a slurm array, which is released when the block is left
+    with open(path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class _SerialExecutor:
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
 def seq_to_unique_id(series):
     seq_to_unique_mapping = {seq_id: truncated_uuid4() for seq_id in series.unique()}
     return series.map(seq_to_unique_mapping)
 
 
-def load_data(country, geo=False, eval_columns=[id], crs=3035, **kwargs):
-    def parse_int_list(l):
-        return [int(i) for i in ast.literal_eval(l)]
+def _parse_int_list(l):
+    return [int(i) for i in ast.literal_eval(l)]
 
-    country_files = {
-        'france': 'df-FRA.pkl',
-        'spain': 'df-ESP.pkl',
-        'netherlands': 'df-NLD.pkl',
-    }
 
-    converters = {
-        'id': str,
-        'block_bld_ids': ast.literal_eval,
-        'sbb_bld_ids': ast.literal_eval,
-        'TouchesIndexes': parse_int_list,
-        }
+COUNTRY_FILES = {
+    'france': 'df-FRA.pkl',
+    'spain': 'df-ESP.pkl',
+    'netherlands': 'df-NLD.pkl',
+}
+
+CONVERTERS = {
+    'id': str,
+    'block_bld_ids': ast.literal_eval,
+    'sbb_bld_ids': ast.literal_eval,
+    'TouchesIndexes': _parse_int_list,
+}
+
+LIST_COLUMNS = ['block_bld_ids', 'sbb_bld_ids', 'TouchesIndexes']
+
+CACHE_MAX_ROWS_PER_FILE = 1_000_000
+CACHE_MAX_ROWS_PER_GROUP = 50_000
+CACHE_COMPLETE_FILE = '_SUCCESS'
+CACHE_ROW_COLUMN = '__cache_row__'
+CACHE_INDEX_COLUMN = '__cache_index__'
+CACHE_COLUMNS = [CACHE_ROW_COLUMN, CACHE_INDEX_COLUMN]
 
-    logger.debug('Loading pickle...')
-    path = os.path.realpath(os.path.join(dataset.DATA_DIR, country_files[country]))
-    df = pd.read_pickle(path, **kwargs)
 
-    logger.debug('Parsing data...')
-    for col, func in converters.items():
-        if col in eval_columns:
-            df[col] = df[col].apply(func)
-            logger.debug(f'Finished converting {col}.')
+def load_data(country, geo=False, eval_columns=[id], crs=3035, columns=None, cities=None, cache=False, **kwargs):
+    """
+    Loads the dataset of a country, optionally only some columns and cities.
+
+    With cache, the pickle is converted once into a parquet dataset next to it (see build_data_cache), from which
+    columns and cities are read without loading the whole pickle. The rows, their order and the index are the same as
+    without cache, but list columns are always returned parsed and the geometry as shapely geometries.
+    """
+    path = os.path.realpath(os.path.join(dataset.DATA_DIR, COUNTRY_FILES[country]))
+
+    if geo and columns:
+        columns = list(dict.fromkeys(['id', *columns]))
+
+    if cache:
+        cache_path = _updated_data_cache_path(country, **kwargs)
+
+        logger.debug('Loading parquet cache...')
+        df = _read_data_cache(cache_path, columns, cities)
+        if 'id' in eval_columns and 'id' in df.columns:
+            df['id'] = df['id'].astype(str)
+    else:
+        logger.debug('Loading pickle...')
+        df = pd.read_pickle(path, **kwargs)
+
+        if cities:
+            df = df[df['city'].isin(cities)]
+
+        if columns:
+            df = df[df.columns.intersection(columns)]
+
+        logger.debug('Parsing data...')
+        for col, func in CONVERTERS.items():
+            if col in eval_columns and col in df.columns:
+                df[col] = df[col].apply(func)
+                logger.debug(f'Finished converting {col}.')
 
     if geo:
         logger.debug('Adding geometry column...')
@@ -201,6 +391,124 @@ def load_data(country, geo=False, eval_columns=[id], crs=3035, **kwargs):
     return df
 
 
+def data_cache_path(country):
+    file_name, _ = os.path.splitext(COUNTRY_FILES[country])
+    return os.path.realpath(os.path.join(dataset.DATA_DIR, f'{file_name}.parquet'))
+
+
+def _data_cache_valid(country):
+    # only completely written caches which are not older than the pickle are used
+    path = os.path.realpath(os.path.join(dataset.DATA_DIR, COUNTRY_FILES[country]))
+    complete_file = os.path.join(data_cache_path(country), CACHE_COMPLETE_FILE)
+
+    if not os.path.exists(complete_file):
+        return False
+
+    return not os.path.exists(path) or os.path.getmtime(path) <= os.path.getmtime(complete_file)
+
+
+def _updated_data_cache_path(country, **kwargs):
+    cache_path = data_cache_path(country)
+
+    if not _data_cache_valid(country):
+        # processes loading the data at the same time wait for the first one to build the cache
+        with file_lock(f'{cache_path}.lock'):
+            if not _data_cache_valid(country):
+                build_data_cache(country, **kwargs)
+
+    return cache_path
+
+
+def build_data_cache(country, **kwargs):
+    path = os.path.realpath(os.path.join(dataset.DATA_DIR, COUNTRY_FILES[country]))
+    cache_path = data_cache_path(country)
+
+    logger.info(f'Converting {path} to parquet cache {cache_path}...')
+    df = pd.read_pickle(path, **kwargs)
+
+    for col in set(LIST_COLUMNS).intersection(df.columns):
+        df[col] = df[col].apply(lambda v: CONVERTERS[col](v) if isinstance(v, str) else v)
+
+    if 'geometry' in df.columns:
+        df['geometry'] = geometry.to_wkb(df['geometry'])
+
+    # the row numbers and index of the pickle restore its row order and index when reading the cache
+    index_name = df.index.name
+    df[CACHE_ROW_COLUMN] = np.arange(len(df))
+    df[CACHE_INDEX_COLUMN] = df.index.values
+
+    # sorting by city yields row groups with narrow city statistics, which allows to skip most of them when filtering cities
+    if 'city' in df.columns:
+        df = df.sort_values(by='city', kind='stable')
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b'index_name': json.dumps(index_name).encode()})
+    write_atomically(cache_path, functools.partial(_write_data_cache, table))
+
+
+def _write_data_cache(table, path):
+    ds.write_dataset(
+        table,
+        path,
+        format='parquet',
+        max_rows_per_file=CACHE_MAX_ROWS_PER_FILE,
+        max_rows_per_group=CACHE_MAX_ROWS_PER_GROUP,
+    )
+    # written last, so that partially written caches are never used
+    open(os.path.join(path, CACHE_COMPLETE_FILE), 'w').close()
+
+
+def _read_data_cache(path, columns=None, cities=None):
+    data = ds.dataset(path, format='parquet')
+    columns = [c for c in data.schema.names if c in columns or c in CACHE_COLUMNS] if columns else data.schema.names
+    filter = ds.field('city').isin(cities) if cities else None
+    table = data.to_table(columns=columns, filter=filter)
+    return _restore_row_order(_cache_table_to_pandas(table), data.schema)
+
+
+def _restore_row_order(df, schema):
+    df = df.sort_values(by=CACHE_ROW_COLUMN, kind='stable').drop(columns=CACHE_ROW_COLUMN)
+    df = df.set_index(CACHE_INDEX_COLUMN)
+    df.index.name = json.loads(schema.metadata.get(b'index_name', b'null'))
+    return df
+
+
+def data_cache_columns(country):
+    names = ds.dataset(_updated_data_cache_path(country), format='parquet').schema.names
+    return [c for c in names if c not in CACHE_COLUMNS]
+
+
+def data_cache_batches(country, columns=None, exclude_columns=[], batch_size=CACHE_MAX_ROWS_PER_GROUP):
+    # batches in the order of the cache, i.e. sorted by city, the row numbers of the pickle are in the CACHE_ROW_COLUMN
+    return parquet_batches(_updated_data_cache_path(country), columns, [*exclude_columns, CACHE_INDEX_COLUMN], batch_size)
+
+
+def parquet_batches(path, columns=None, exclude_columns=[], batch_size=CACHE_MAX_ROWS_PER_GROUP):
+    # batches of a parquet file or directory in a deterministic row order, e.g. to stream datasets which do not fit into memory
+    data = ds.dataset(path, format='parquet')
+    columns = [c for c in (columns or data.schema.names) if c in data.schema.names and c not in exclude_columns]
+
+    for fragment in data.get_fragments():
+        for batch in fragment.to_batches(columns=columns, batch_size=batch_size, use_threads=False):
+            df = _cache_table_to_pandas(pa.Table.from_batches([batch]))
+            if 'id' in df.columns:
+                df['id'] = df['id'].astype(str)
+            yield df
+
+
+def _cache_table_to_pandas(table):
+    list_columns = [c for c in table.column_names if pa.types.is_list(table.schema.field(c).type)]
+    df = table.drop_columns(list_columns).to_pandas()
+
+    for col in list_columns:
+        df[col] = table.column(col).to_pylist()
+
+    if 'geometry' in df.columns:
+        df['geometry'] = geometry.from_wkb(df['geometry'])
+
+    return df[table.column_names]
+
+
 def load_df(df_path):
     if '.csv' in df_path:
         return pd.read_csv(df_path)
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+import dataset
+
+dataset.METADATA_DIR = os.path.join(ROOT_DIR, 'metadata')
+
+
+def pytest_configure(config):
+    for category in ['FutureWarning', 'DeprecationWarning', 'PendingDeprecationWarning', 'UserWarning']:
+        config.addinivalue_line('filterwarnings', f'ignore::{category}')
+
+
+def make_buildings(n=1000, n_cities=5, seed=0):
+    # synthetic buildings with a few features, an age depending on them and point geometries in EPSG:3035
+    rng = np.random.default_rng(seed)
+    features = dataset.BUILDING_FEATURES[:8]
+    df = pd.DataFrame(rng.random((n, len(features))), columns=features)
+    df[dataset.AGE_ATTRIBUTE] = 1900 + 100 * df[features[0]] + 20 * df[features[1]] + rng.normal(0, 5, n)
+    df['PropertyKey_ID'] = np.arange(n) * 7
+    df['id'] = [f'b{i}' for i in range(n)]
+    df['city'] = rng.choice([f'city{i}' for i in range(n_cities)], n)
+    df['country'] = 'France'
+    df['residential_type'] = rng.choice(['SFH', 'MFH', 'TH', 'AB'], n)
+    x = rng.uniform(3.7e6, 3.7005e6, n)
+    y = rng.uniform(2.8e6, 2.8005e6, n)
+    df['geometry'] = [f'POINT ({a} {b})' for a, b in zip(x, y)]
+    return df
+
+
+@pytest.fixture
+def buildings():
+    return make_buildings
+
+
+@pytest.fixture(autouse=True)
+def isolated_cwd(tmp_path, monkeypatch):
+    # experiments and tuning write their outputs to the working directory
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
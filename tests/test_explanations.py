@@ -0,0 +1,55 @@
+import numpy as np
+import xgboost
+
+import preprocessing
+import explanations
+from prediction_age import AgePredictor
+
+
+def _cv_predictor(buildings):
+    return AgePredictor(
+        model=xgboost.XGBRegressor(n_estimators=20),
+        df=buildings(1200, 4),
+        cross_validation_split=preprocessing.city_cross_validation,
+    )
+
+
+def test_stratified_sample_keeps_strata_proportions():
+    strata = np.repeat(['a', 'b', 'c'], [500, 300, 200])
+    sample = explanations.stratified_sample(strata, 100, seed=0)
+
+    assert len(sample) == len(np.unique(sample)) == 100
+    _, counts = np.unique(strata[sample], return_counts=True)
+    assert list(counts) == [50, 30, 20]
+
+
+def test_native_shap_values_equal_shap_package(buildings):
+    predictor = _cv_predictor(buildings)
+    X = predictor.X_test.iloc[:200]
+
+    values = explanations.shap_values(predictor.model, X, chunk_size=64)
+    native_values = explanations.shap_values(predictor.model, X, native=True, chunk_size=64)
+
+    assert values.shape == native_values.shape == X.shape
+    assert np.allclose(values, native_values, atol=1e-3)
+
+
+def test_sampled_shap_values_under_cross_validation(buildings):
+    predictor = _cv_predictor(buildings)
+    assert len(predictor.y_test) > len(predictor.X_test)
+
+    values = predictor.calculate_SHAP_values(sample_size=100)
+
+    assert values.shape == (100, predictor.X_test.shape[1])
+    assert predictor.shap_features().index.isin(predictor.X_test.index).all()
+    assert np.allclose(values, explanations.shap_values(predictor.model, predictor.shap_features()), atol=1e-6)
+
+
+def test_shap_values_in_worker_processes_equal_serial_values(buildings):
+    predictor = _cv_predictor(buildings)
+    X = predictor.X_test.iloc[:300]
+
+    for native in [False, True]:
+        serial = explanations.shap_values(predictor.model, X, native=native, n_jobs=1, chunk_size=64)
+        parallel = explanations.shap_values(predictor.model, X, native=native, n_jobs=2, chunk_size=64)
+        assert np.array_equal(serial, parallel)
@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+from haversine import haversine
+from scipy.spatial.distance import cdist
+
+import dataset
+import geometry
+
+
+def _points(n=300, geographic=False, seed=0):
+    rng = np.random.default_rng(seed)
+    if geographic:
+        x, y, crs = rng.uniform(13.3, 13.5, n), rng.uniform(52.4, 52.6, n), 4326
+    else:
+        x, y, crs = rng.uniform(0, 1000, n), rng.uniform(0, 1000, n), 3035
+
+    # duplicate points share the location of another point
+    x[1], y[1] = x[0], y[0]
+    x[5], y[5] = x[4], y[4]
+    return gpd.GeoSeries(gpd.points_from_xy(x, y), crs=crs)
+
+
+def _brute_force_distances(points):
+    coords = np.column_stack([points.x, points.y])
+    if points.crs.to_epsg() == 4326:
+        # haversine expects (lat, lon)
+        return cdist(coords[:, ::-1], coords[:, ::-1], haversine)
+    return cdist(coords, coords)
+
+
+@pytest.mark.parametrize('geographic', [False, True])
+def test_knn_graph_equals_brute_force(geographic):
+    points = _points(geographic=geographic)
+    distances = _brute_force_distances(points)
+    np.fill_diagonal(distances, np.inf)
+    k = 5
+
+    graph = geometry.SpatialIndex(points).knn_graph(k)
+
+    assert (np.diff(graph.indptr) == k).all()
+    # no point is its own neighbor, duplicate points are neighbors of each other at distance 0
+    assert not graph.diagonal().any()
+    assert 1 in graph[0].indices and 0 in graph[1].indices
+    for i in range(len(points)):
+        neighbors = graph.indices[graph.indptr[i]:graph.indptr[i + 1]]
+        assert np.allclose(np.sort(graph[i].data), np.sort(distances[i])[:k], rtol=1e-6)
+        assert np.allclose(distances[i, neighbors], graph[i, neighbors].toarray().ravel(), rtol=1e-6)
+
+
+@pytest.mark.parametrize('geographic', [False, True])
+@pytest.mark.parametrize('inclusive', [False, True])
+def test_radius_graph_equals_brute_force(geographic, inclusive):
+    points = _points(geographic=geographic)
+    distances = _brute_force_distances(points)
+    radius = 1.5 if geographic else 80
+
+    graph = geometry.SpatialIndex(points).radius_graph(radius, inclusive=inclusive)
+
+    expected = (distances <= radius) if inclusive else (distances < radius)
+    np.fill_diagonal(expected, False)
+    pattern = _pattern(graph)
+    assert np.array_equal(pattern, expected)
+    assert pattern[0, 1] and pattern[1, 0]
+    assert np.allclose(graph.toarray()[pattern], distances[pattern], rtol=1e-6)
+
+
+def _pattern(graph):
+    # explicitly stored entries, which include the neighbors at distance 0
+    pattern = np.zeros(graph.shape, dtype=bool)
+    rows = np.repeat(np.arange(graph.shape[0]), np.diff(graph.indptr))
+    pattern[rows, graph.indices] = True
+    return pattern
+
+
+def test_neighbor_dicts_use_identifiers():
+    points = _points(50)
+    df = gpd.GeoDataFrame({'id': [f'b{i}' for i in range(50)]}, geometry=points)
+    distances = _brute_force_distances(points)
+    np.fill_diagonal(distances, np.inf)
+
+    knn = geometry.knn(df, 3)
+    within = geometry.nearest_neighbors(df, 150)
+
+    for i, id in enumerate(df['id']):
+        assert sorted(knn[id]) == sorted(f'b{j}' for j in np.argsort(distances[i], kind='stable')[:3])
+        assert sorted(within[id]) == sorted(f'b{j}' for j in np.flatnonzero(distances[i] < 150))
+
+
+@pytest.mark.parametrize('geographic', [False, True])
+def test_spatial_buffer_around_block_equals_brute_force(geographic):
+    points = _points(400, geographic=geographic)
+    rng = np.random.default_rng(1)
+    blocks = rng.choice([f'block{i}' for i in range(20)], len(points))
+    if geographic:
+        # datasets without geometry fall back to the lat lon coordinates
+        df = pd.DataFrame({'block': blocks, 'lon': points.x, 'lat': points.y})
+    else:
+        df = gpd.GeoDataFrame({'block': blocks}, geometry=points)
+
+    distances = _brute_force_distances(points)
+    buffer_size = 50
+    radius = buffer_size / 1000 if geographic else buffer_size
+
+    for block_ids in [None, ['block3', 'block7', 'unknown']]:
+        selected = np.isin(blocks, block_ids) if block_ids else np.ones(len(blocks), dtype=bool)
+        expected = selected | (distances[selected] < radius).any(axis=0)
+
+        mask = geometry.spatial_buffer_around_block(df, 'block', buffer_size, block_ids)
+        assert np.array_equal(mask, expected)
+
+
+def test_spatial_buffer_around_block_rejects_index_of_other_dataset():
+    df = gpd.GeoDataFrame({'block': ['a'] * 10}, geometry=_points(10))
+    index = geometry.SpatialIndex(_points(20))
+
+    with pytest.raises(Exception):
+        geometry.spatial_buffer_around_block(df, 'block', 50, index=index)
+
+
+def test_merge_intersecting_geometries_equals_dense_intersects():
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(0, 30_000, (300, 2))
+    polygons = gpd.GeoSeries(gpd.points_from_xy(*centers.T), crs=3035).buffer(rng.uniform(100, 1500, len(centers)))
+    gdf = gpd.GeoDataFrame({'name': [f'p{i}' for i in range(len(centers))]}, geometry=polygons)
+
+    # connected components of the dense intersection matrix like before the sparse adjacency
+    overlap = gdf.geometry.apply(lambda x: gdf.intersects(x)).values.astype(int)
+    _, groups = geometry.csgraph.connected_components(overlap)
+    expected = gdf.assign(group=groups).dissolve(by='group', aggfunc='first')
+
+    # tiles smaller than the polygons split intersecting polygons across tiles
+    merged = geometry._merge_intersecting_geometries(gdf.copy(), tile_size=2000)
+
+    assert len(merged) == len(expected) < len(gdf)
+    assert set(merged['name']) == set(expected['name'])
+    merged_areas = merged.set_index('name').area.sort_index()
+    expected_areas = expected.set_index('name').area.sort_index()
+    assert np.allclose(merged_areas, expected_areas)
+
+
+@pytest.fixture
+def city_geometry_files(isolated_cwd, monkeypatch):
+    monkeypatch.setattr(dataset, 'DATA_DIR', str(isolated_cwd))
+
+    # cities whose names contain each other
+    files = {}
+    for city in ['Paris', 'Paris-Nord', 'Nord']:
+        city_dir = isolated_cwd / 'france' / 'region' / city
+        city_dir.mkdir(parents=True)
+        files[city] = city_dir / f'{city}_geom.csv'
+        _write_city_geometry(files[city], city, 3)
+    return files
+
+
+def _write_city_geometry(path, city, n):
+    # distinct points, since duplicate geometries are dropped
+    x = 650_000 + 1000 * len(city)
+    points = [f'POINT ({x + 10 * i} {6_860_000 + 10 * i})' for i in range(n)]
+    pd.DataFrame({'id': [f'{city}-{i}' for i in range(n)], 'geometry': points}).to_csv(path, index=False)
+
+
+def test_building_geometry_of_cities_matches_directory_names(city_geometry_files):
+    gdf = geometry.load_building_geometry(countries=['france'], cities=['Paris', 'Nord'], n_jobs=1)
+
+    assert sorted(gdf['id']) == ['Nord-0', 'Nord-1', 'Nord-2', 'Paris-0', 'Paris-1', 'Paris-2']
+    assert set(gdf['city']) == {'Paris', 'Nord'}
+    assert gdf.crs.to_epsg() == 3035
+
+
+def test_city_geometry_cache_is_updated_with_csv(city_geometry_files, monkeypatch):
+    geometry.load_building_geometry(countries=['france'], n_jobs=1)
+
+    parsed = []
+    parse_city_geometry = geometry._parse_city_geometry
+    monkeypatch.setattr(geometry, '_parse_city_geometry', lambda file, crs: parsed.append(file) or parse_city_geometry(file, crs))
+
+    _write_city_geometry(city_geometry_files['Paris'], 'Paris', 5)
+    os.utime(city_geometry_files['Paris'], (os.path.getmtime(city_geometry_files['Paris']) + 10,) * 2)
+    gdf = geometry.load_building_geometry(countries=['france'], n_jobs=1)
+
+    assert parsed == [str(city_geometry_files['Paris'])]
+    assert (gdf['city'] == 'Paris').sum() == 5
+    assert not any('.tmp' in name for name in os.listdir(city_geometry_files['Paris'].parent))
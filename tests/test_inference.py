@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import xgboost
+
+import dataset
+import inference
+
+
+@pytest.fixture
+def country(buildings, isolated_cwd):
+    df = buildings(500)
+    df.loc[df.index % 3 == 0, dataset.AGE_ATTRIBUTE] = np.nan
+    path = isolated_cwd / 'country.parquet'
+    df.drop(columns=['geometry']).to_parquet(path)
+    return df, str(path)
+
+
+def _features(df):
+    return df[dataset.BUILDING_FEATURES[:8]]
+
+
+def _regressor_path(df, path='model.json'):
+    labelled = df.dropna(subset=[dataset.AGE_ATTRIBUTE])
+    model = xgboost.XGBRegressor(n_estimators=10).fit(_features(labelled), labelled[dataset.AGE_ATTRIBUTE])
+    model.save_model(path)
+    return path, model
+
+
+def test_predict_country_predicts_unlabelled_buildings_in_batches(country):
+    df, data = country
+    model_path, model = _regressor_path(df)
+
+    n_buildings = inference.predict_country(model_path, data, 'predictions.parquet', n_jobs=2, batch_size=64)
+    predictions = pd.read_parquet('predictions.parquet').set_index('id')
+    unlabelled = df[df[dataset.AGE_ATTRIBUTE].isna()].set_index('id')
+
+    assert n_buildings == len(predictions) == len(unlabelled)
+    assert np.allclose(predictions.loc[unlabelled.index, 'age'], model.predict(_features(unlabelled)), rtol=1e-6)
+
+
+def test_predict_country_writes_empty_file_without_unlabelled_buildings(country, isolated_cwd):
+    df, _ = country
+    labelled = df.dropna(subset=[dataset.AGE_ATTRIBUTE]).drop(columns=['geometry'])
+    labelled.to_parquet(isolated_cwd / 'labelled.parquet')
+    model_path, _ = _regressor_path(df)
+
+    n_buildings = inference.predict_country(model_path, str(isolated_cwd / 'labelled.parquet'), 'predictions.parquet')
+    table = pq.read_table('predictions.parquet')
+
+    assert n_buildings == table.num_rows == 0
+    assert table.schema.equals(inference.output_schema())
+
+
+def test_predict_country_of_classifier_writes_labels_and_probabilities(country):
+    df, data = country
+    labels = ['old', 'new']
+    labelled = df.dropna(subset=[dataset.AGE_ATTRIBUTE])
+    model = xgboost.XGBClassifier(n_estimators=10).fit(_features(labelled), (labelled[dataset.AGE_ATTRIBUTE] > 1950).astype(int))
+    model.save_model('classifier.json')
+
+    inference.predict_country('classifier.json', data, 'predictions.parquet', labels=labels, unlabelled_only=False)
+    table = pq.read_table('predictions.parquet')
+    probabilities = np.stack(table['probabilities'].to_numpy(zero_copy_only=False))
+
+    assert table.schema.equals(inference.output_schema(labels))
+    assert np.allclose(probabilities, model.predict_proba(_features(df)), atol=1e-6)
+    assert list(table['age'].to_pylist()) == list(np.asarray(labels)[model.predict(_features(df))])
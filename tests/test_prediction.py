@@ -0,0 +1,414 @@
+import inspect
+import itertools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost
+from sklearn import metrics
+
+import dataset
+import geometry
+import prediction
+import preprocessing
+import spatial_autocorrelation
+import spatial_weights
+import utils
+from prediction_age import AgePredictor, AgePredictorComparison
+
+
+def _comparison(buildings, **kwargs):
+    return AgePredictorComparison(
+        model=xgboost.XGBRegressor(n_estimators=20),
+        test_training_split=preprocessing.split_80_20,
+        exp_name='exp',
+        include_baseline=False,
+        **{'df': buildings(800, 4), 'n_seeds': 2, **kwargs},
+    )
+
+
+def _ledger(exp_name='exp'):
+    with open(os.path.join(f'{exp_name}-runs', 'ledger.jsonl')) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_comparison_reuses_recorded_runs(buildings, monkeypatch):
+    config = {'a': {}, 'b': {'preprocessing_stages': [lambda df: df[df['age_right'] > 1910]]}}
+    comparison = _comparison(buildings, comparison_config=config)
+    assert len(_ledger()) == 4
+
+    monkeypatch.setattr(AgePredictorComparison, '_train_predictor', lambda *args: pytest.fail('recorded run was trained again'))
+    reused = _comparison(buildings, comparison_config=config)
+
+    pd.testing.assert_frame_equal(comparison.evaluate(), reused.evaluate())
+
+
+def test_comparison_does_not_reuse_runs_of_other_lambdas(buildings):
+    _comparison(buildings, comparison_config={'a': {'preprocessing_stages': [lambda df: df[df['age_right'] > 1910]]}})
+    _comparison(buildings, comparison_config={'a': {'preprocessing_stages': [lambda df: df[df['age_right'] > 1950]]}})
+
+    assert len({run['config_hash'] for run in _ledger()}) == 2
+    assert len(_ledger()) == 4
+
+
+def test_run_records_only_contain_results(buildings):
+    _comparison(buildings, comparison_config={'a': {}}, n_seeds=1)
+    run = _ledger()[0]
+    files = os.listdir(os.path.join('exp-runs', run['record']))
+
+    assert run['e2e_time'] > 0
+    assert not any(f.startswith('model') for f in files)
+    assert pd.read_parquet(os.path.join('exp-runs', run['record'], 'X_test.parquet')).empty
+
+
+def test_save_pickles_predictor_unless_artifact_format_is_requested(buildings):
+    predictor = AgePredictor(model=xgboost.XGBRegressor(n_estimators=20), df=buildings(500), test_training_split=preprocessing.split_80_20)
+
+    predictor.save('predictor')
+    assert os.path.isfile('predictor')
+    assert prediction.Predictor.load('predictor').model is not None
+
+    predictor.save('artifact', format='artifact')
+    loaded = prediction.Predictor.load('artifact')
+    assert os.path.isdir('artifact') and not os.path.exists('artifact.tmp')
+    assert np.allclose(loaded.model.predict(predictor.X_test), predictor.y_predict.values.ravel())
+    pd.testing.assert_frame_equal(loaded.y_test, predictor.y_test)
+
+
+def _tuning_results(*candidates):
+    return pd.DataFrame({
+        'params': [params for params, _ in candidates],
+        'mean_test_score': [score for _, score in candidates],
+        'std_test_score': 0.0,
+        'mean_fit_time': 1.0,
+        'split0_test_score': [score for _, score in candidates],
+    })
+
+
+def test_tuning_store_distinguishes_preprocessing_lambdas(tmp_path):
+    a = prediction.HyperparameterTuningStore(tmp_path, {'preprocessing_stages': [lambda df: df[df['age'] > 1900]]}, 'sample')
+    b = prediction.HyperparameterTuningStore(tmp_path, {'preprocessing_stages': [lambda df: df[df['age'] > 1950]]}, 'sample')
+    a.add(_tuning_results(({'max_depth': 3}, 0.5)))
+
+    assert a.path != b.path
+    assert b.evaluations() == []
+
+
+def test_tuning_store_warm_starts_from_most_recently_evaluated_samples(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(prediction.time, 'time', lambda: next(clock))
+    monkeypatch.setattr(prediction, 'HYPERPARAMETER_WARM_START_SIZE', 2)
+
+    for sample, depth in [('a', 1), ('b', 2), ('c', 3), ('a', 4)]:
+        prediction.HyperparameterTuningStore(tmp_path, {}, sample).add(_tuning_results(({'max_depth': depth}, depth)))
+
+    store = prediction.HyperparameterTuningStore(tmp_path, {}, 'd')
+    assert store.warm_start([{'max_depth': 5}]) == [{'max_depth': 4}, {'max_depth': 3}, {'max_depth': 5}]
+    assert store.warm_start([{'max_depth': 4}]) == [{'max_depth': 4}, {'max_depth': 3}]
+
+
+@pytest.mark.parametrize('type', ['knn', 'distance', 'block'])
+def test_spatial_weights_cache_is_shared_across_seeds(buildings, monkeypatch, type):
+    df = buildings(300).assign(block=lambda df: df['city'], error=lambda df: df[dataset.AGE_ATTRIBUTE])
+    built = []
+    build_weights = spatial_autocorrelation.weights
+    monkeypatch.setattr(spatial_autocorrelation, 'weights', lambda *args: built.append(args) or build_weights(*args))
+    cache = prediction.SpatialWeightsCache()
+
+    for seed in range(3):
+        test_df = df.sample(frac=1, random_state=seed).reset_index(drop=True)
+        weights = cache.get(test_df, type)
+        expected = build_weights(geometry.to_gdf(test_df) if type != 'block' else test_df, type)
+
+        assert spatial_weights.to_sparse(weights).nnz > 0
+        assert (spatial_weights.to_sparse(weights) != spatial_weights.to_sparse(expected)).nnz == 0
+        assert spatial_autocorrelation.moran_I(test_df, weights, 'error') == pytest.approx(spatial_autocorrelation.moran_I(test_df, expected, 'error'))
+
+    assert len(built) == 1
+
+
+def _cv_predictor(buildings, **kwargs):
+    return AgePredictor(
+        model=xgboost.XGBRegressor(n_estimators=20),
+        df=buildings(1000, 5),
+        **{'cross_validation_split': preprocessing.city_cross_validation, **kwargs},
+    )
+
+
+class _FoldResultsTarget:
+
+    def _set_aux_vars_test_folds(self, folds):
+        self.aux_vars_test = pd.concat(folds)
+
+
+def test_fold_results_equal_concatenated_folds():
+    rng = np.random.default_rng(0)
+    keys = rng.permutation(100) * 3
+    folds = np.array_split(rng.permutation(keys)[:90], 3)
+    frames = [
+        (pd.DataFrame({'age': rng.random(len(ids)), 'label': rng.integers(0, 5, len(ids))}, index=ids),
+         pd.DataFrame({'age': rng.random(len(ids))}, index=ids),
+         pd.DataFrame({'city': rng.choice(['a', 'b'], len(ids))}, index=ids))
+        for ids in folds
+    ]
+    results = prediction.FoldResults(keys)
+    for fold_idx, (y_test, y_predict, aux_vars_test) in enumerate(frames):
+        results.add(fold_idx, y_test, y_predict, aux_vars_test.copy())
+    target = _FoldResultsTarget()
+    results.assign(target)
+
+    pd.testing.assert_frame_equal(target.y_test, pd.concat([f[0] for f in frames]))
+    pd.testing.assert_frame_equal(target.y_predict, pd.concat([f[1] for f in frames]))
+    assert (target.aux_vars_test['cv_fold_idx'].values == np.repeat(range(3), [len(ids) for ids in folds])).all()
+
+    with pytest.raises(Exception):
+        results.add(3, *[f.copy() for f in frames[0]])
+
+
+def test_fold_metrics_equal_metrics_of_each_fold(buildings):
+    predictor = _cv_predictor(buildings)
+    metrics = {
+        'r2': [], 'mae': [], 'rmse': [], 'skew': [], 'kurtosis': [],
+        'error_cum_hist': [list(range(0, 60, 5))], 'mcc': [[1900, 1930, 1960, 1990, 2020]],
+    }
+
+    vectorized = {name: getattr(predictor, name)(*args, across_folds=True) for name, args in metrics.items()}
+    predictor.FOLD_METRICS = []
+    per_fold = {name: getattr(predictor, name)(*args, across_folds=True) for name, args in metrics.items()}
+
+    for name in metrics:
+        assert len(vectorized[name]) == len(per_fold[name]) == 5
+        assert np.allclose(np.stack(vectorized[name]), np.stack(per_fold[name]), equal_nan=True), name
+
+
+def test_process_fold_executor_equals_sequential_cv(buildings, monkeypatch):
+    sequential = _cv_predictor(buildings)
+
+    n_splits = []
+    split = preprocessing.city_cross_validation
+    parallel = _cv_predictor(buildings, fold_executor='process', n_jobs=2, cross_validation_split=lambda df: n_splits.append(1) or split(df))
+
+    assert len(n_splits) == 1
+    assert parallel.model.get_params()['n_jobs'] is None
+    pd.testing.assert_frame_equal(parallel.y_predict, sequential.y_predict, check_exact=False)
+    pd.testing.assert_frame_equal(parallel.y_test, sequential.y_test)
+    assert parallel.r2() == pytest.approx(sequential.r2())
+
+
+@pytest.mark.parametrize('scheduler', ['local', 'seeds'])
+def test_process_pool_schedulers_equal_sequential_comparison(buildings, scheduler):
+    config = {'a': {}, 'b': {'preprocessing_stages': [lambda df: df[df['age_right'] > 1910]]}}
+    sequential = _comparison(buildings, comparison_config=config, save_results=False, keep_predictor_in_memory=True)
+    pool = _comparison(buildings, comparison_config=config, save_results=False, keep_predictor_in_memory=True, scheduler=scheduler, n_jobs=2)
+
+    pd.testing.assert_frame_equal(pool.evaluate(), sequential.evaluate())
+    for predictor in pool.predictors['a_']:
+        assert 'model' not in predictor.__dict__ and predictor.X_test.empty
+
+
+def _tuned_predictor(buildings, **kwargs):
+    return AgePredictor(
+        model=xgboost.XGBRegressor(n_estimators=27),
+        df=buildings(600, 4),
+        test_training_split=preprocessing.split_80_20,
+        hyperparameter_tuning_space={'max_depth': [2, 3, 4], 'learning_rate': [0.1, 0.3, 0.5]},
+        hyperparameter_n_iter=9,
+        **{'hyperparameter_search': 'halving', **kwargs},
+    )
+
+
+def test_halving_search_in_worker_processes_equals_serial_search(buildings, isolated_cwd):
+    serial = _tuned_predictor(buildings, n_jobs=1, output_dir='serial')
+    parallel = _tuned_predictor(buildings, n_jobs=2, output_dir='parallel')
+
+    assert serial.hyperparameters == parallel.hyperparameters
+    assert np.allclose(serial.hyperparameter_tuning_results['mean_test_score'], parallel.hyperparameter_tuning_results['mean_test_score'])
+    assert parallel.hyperparameter_tuning_results['n_resources'].min() < 1
+
+
+def test_tuning_outputs_are_written_to_output_dir(buildings, isolated_cwd):
+    _tuned_predictor(buildings, output_dir='outputs')
+
+    assert not any(name.endswith('.csv') for name in os.listdir(isolated_cwd))
+    assert sorted(name.split('-2')[0] for name in os.listdir(isolated_cwd / 'outputs')) == ['hyperparameter-tuning-progress', 'hyperparameter-tuning-results']
+
+
+def test_cached_feature_matrices_equal_sklearn_training(buildings, monkeypatch):
+    prediction._feature_matrices.clear()
+    # training and evaluation matrices of all five folds
+    monkeypatch.setattr(prediction._feature_matrices, 'max_size', 10)
+    uncached = _cv_predictor(buildings)
+    cached = _cv_predictor(buildings, cache_feature_matrices=True)
+
+    pd.testing.assert_frame_equal(cached.y_predict, uncached.y_predict, check_exact=False)
+    assert len(prediction._feature_matrices.matrices) > 0
+
+    # a second predictor on the same data builds no new matrices
+    monkeypatch.setattr(xgboost.XGBRegressor, '_create_dmatrix', lambda *args, **kwargs: pytest.fail('feature matrix was built again'))
+    reused = _cv_predictor(buildings, cache_feature_matrices=True)
+    pd.testing.assert_frame_equal(reused.y_predict, cached.y_predict)
+
+
+def test_cached_feature_matrices_equal_sklearn_tuning(buildings):
+    prediction._feature_matrices.clear()
+    uncached = _tuned_predictor(buildings, hyperparameter_search=None, output_dir='uncached')
+    cached = _tuned_predictor(buildings, hyperparameter_search=None, output_dir='cached', cache_feature_matrices=True)
+
+    assert cached.hyperparameters == uncached.hyperparameters
+    assert np.allclose(cached.hyperparameter_tuning_results['mean_test_score'], uncached.hyperparameter_tuning_results['mean_test_score'])
+    pd.testing.assert_frame_equal(cached.y_predict, uncached.y_predict, check_exact=False)
+
+
+@pytest.mark.parametrize('model_class', [xgboost.XGBRegressor, xgboost.XGBClassifier])
+def test_native_xgboost_training_hooks_of_installed_wrapper(model_class):
+    # fails once an xgboost upgrade changes the private parts of the sklearn wrapper used by _fit_xgboost
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.random((200, 4)))
+    y = (X[0] > 0.5).astype(int)
+    model = model_class(n_estimators=5)
+
+    assert all(hasattr(model, hook) for hook in prediction.NATIVE_XGBOOST_HOOKS)
+    parameters = inspect.signature(model._create_dmatrix).parameters
+    keywords = any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values())
+    assert 'ref' in parameters and (keywords or {'data', 'label', 'weight', 'missing', 'enable_categorical', 'feature_types'} <= set(parameters))
+    assert prediction._native_xgboost_supported(model)
+
+    prediction._fit_xgboost(model, prediction.FeatureMatrixCache().get(model, X, y), y)
+    expected = model_class(n_estimators=5).fit(X, y)
+    assert np.allclose(model.predict(X), expected.predict(X))
+    assert model.get_booster().num_boosted_rounds() == 5
+
+
+def _squared_error(y_true, y_pred):
+    return y_pred - y_true, np.ones_like(y_pred)
+
+
+@pytest.mark.parametrize('model_kwargs', [{'objective': _squared_error}, {'eval_metric': metrics.mean_absolute_error}])
+def test_custom_objective_and_metrics_are_trained_with_fit(buildings, monkeypatch, model_kwargs):
+    expected = AgePredictor(model=xgboost.XGBRegressor(n_estimators=20, **model_kwargs), df=buildings(500), test_training_split=preprocessing.split_80_20)
+
+    monkeypatch.setattr(prediction, '_fit_xgboost', lambda *args, **kwargs: pytest.fail('custom objective or metric trained natively'))
+    predictor = AgePredictor(model=xgboost.XGBRegressor(n_estimators=20, **model_kwargs), df=buildings(500), test_training_split=preprocessing.split_80_20, cache_feature_matrices=True)
+
+    pd.testing.assert_frame_equal(predictor.y_predict, expected.y_predict)
+
+
+def test_wrapper_without_private_hooks_is_trained_with_fit(buildings, monkeypatch):
+    expected = AgePredictor(model=xgboost.XGBRegressor(n_estimators=20), df=buildings(500), test_training_split=preprocessing.split_80_20)
+
+    # a hook which an upgraded wrapper no longer has
+    monkeypatch.setattr(prediction, 'NATIVE_XGBOOST_HOOKS', [*prediction.NATIVE_XGBOOST_HOOKS, '_removed_hook'])
+    monkeypatch.setattr(prediction, '_fit_xgboost', lambda *args, **kwargs: pytest.fail('trained natively without the hooks'))
+    predictor = AgePredictor(model=xgboost.XGBRegressor(n_estimators=20), df=buildings(500), test_training_split=preprocessing.split_80_20, cache_feature_matrices=True)
+
+    pd.testing.assert_frame_equal(predictor.y_predict, expected.y_predict)
+
+
+def test_native_xgboost_training_validates_classes():
+    X = pd.DataFrame(np.random.default_rng(0).random((20, 2)))
+    y = np.repeat([1, 2], 10)
+    model = xgboost.XGBClassifier(n_estimators=2)
+
+    with pytest.raises(ValueError, match='Invalid classes'):
+        prediction._fit_xgboost(model, prediction.FeatureMatrixCache().get(model, X, y), y)
+
+
+def test_external_memory_training_equals_in_memory_training(buildings, isolated_cwd, monkeypatch):
+    df = buildings(1000).drop(columns=['geometry'])
+    monkeypatch.setattr(dataset, 'DATA_DIR', str(isolated_cwd))
+    monkeypatch.setattr(prediction, 'EXTERNAL_MEMORY_BATCH_SIZE', 128)
+    monkeypatch.setattr(utils, 'CACHE_MAX_ROWS_PER_GROUP', 300)
+    df.to_pickle(isolated_cwd / utils.COUNTRY_FILES['france'])
+
+    kwargs = {'test_training_split': preprocessing.split_80_20, 'model': xgboost.XGBRegressor(n_estimators=20, tree_method='hist')}
+    in_memory = AgePredictor(df=df, **kwargs)
+    kwargs['model'] = xgboost.XGBRegressor(n_estimators=20, tree_method='hist')
+    external = AgePredictor(df='france', external_memory=True, **kwargs)
+
+    pd.testing.assert_frame_equal(external.X_test, in_memory.X_test, check_dtype=False)
+    pd.testing.assert_frame_equal(external.y_predict, in_memory.y_predict, check_exact=False)
+
+
+def test_sampled_classes_follow_the_class_probabilities():
+    classifier = prediction.Classifier.__new__(prediction.Classifier)
+    rng = np.random.default_rng(0)
+    probabilities = rng.dirichlet(np.ones(4), size=1000).astype(np.float32)
+    probabilities[:, 2] = 0
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+    classes = classifier._sample_classes(probabilities)
+
+    # the row-wise inverse transform of the same uniform draws
+    uniform = np.random.default_rng(dataset.GLOBAL_REPRODUCIBILITY_SEED).random(len(probabilities))
+    cdf = np.cumsum(probabilities, axis=1, dtype=np.float64)
+    expected = [min(np.searchsorted(row / row[-1], u, side='right'), 3) for row, u in zip(cdf, uniform)]
+    assert list(classes) == expected
+    assert not (classes == 2).any()
+
+    repeated = classifier._sample_classes(np.tile(np.float32([0.1, 0.2, 0.3, 0.4]), (20_000, 1)))
+    assert np.allclose(np.bincount(repeated) / len(repeated), [0.1, 0.2, 0.3, 0.4], atol=0.01)
+
+
+def test_seeds_scheduler_loads_shared_datasets_once(buildings, isolated_cwd, monkeypatch):
+    buildings(800, 4).to_csv('buildings.csv', index=False)
+    config = {'a': {}, 'b': {'preprocessing_stages': [lambda df: df[df['age_right'] > 1910]]}}
+    kwargs = {'df': 'buildings.csv', 'comparison_config': config, 'save_results': False}
+    sequential = _comparison(buildings, **kwargs)
+
+    # loads of the forked workers are recorded in a file
+    load_df = utils.load_df
+    def recorded_load_df(path):
+        with open(isolated_cwd / 'loads.txt', 'a') as f:
+            f.write(f'{path}\n')
+        return load_df(path)
+
+    monkeypatch.setattr(utils, 'load_df', recorded_load_df)
+    seeds = _comparison(buildings, scheduler='seeds', n_jobs=2, **kwargs)
+
+    assert (isolated_cwd / 'loads.txt').read_text().splitlines() == ['buildings.csv']
+    pd.testing.assert_frame_equal(seeds.evaluate(), sequential.evaluate())
+
+
+def test_slurm_driver_raises_for_failed_array_tasks(buildings, monkeypatch):
+    run_comparison_task = prediction._run_comparison_task
+    def failing_comparison_task(name, seed, comparison):
+        if seed == 1:
+            raise ValueError('out of memory')
+        return run_comparison_task(name, seed, comparison)
+
+    monkeypatch.setattr(prediction, 'SLURM_POLL_INTERVAL_SECONDS', 0)
+    monkeypatch.setattr(prediction, '_run_comparison_task', failing_comparison_task)
+    monkeypatch.delenv('SLURM_ARRAY_JOB_ID', raising=False)
+    monkeypatch.setenv('SLURM_ARRAY_TASK_ID', '0')
+    with pytest.raises(Exception, match=r"\('a_', 1\)"):
+        _comparison(buildings, comparison_config={'a': {}}, scheduler='slurm')
+
+    assert [(run['seed'], run['status']) for run in _ledger()] == [(0, 'completed'), (1, 'failed')]
+    assert 'out of memory' in _ledger()[1]['error']
+
+    monkeypatch.delenv('SLURM_ARRAY_TASK_ID')
+    with pytest.raises(Exception, match=r"\[\('a_', 1\)\].*out of memory"):
+        _comparison(buildings, comparison_config={'a': {}}, scheduler='slurm')
+
+
+def test_slurm_driver_stops_waiting_for_ended_array(buildings, monkeypatch):
+    monkeypatch.setattr(prediction, 'SLURM_POLL_INTERVAL_SECONDS', 0)
+    queries = []
+    def squeue(args, **kwargs):
+        queries.append(args)
+        return prediction.subprocess.CompletedProcess(args, 0, stdout='' if len(queries) > 2 else '123_0\n', stderr='')
+    monkeypatch.setattr(prediction.subprocess, 'run', squeue)
+
+    with pytest.raises(Exception, match=r"ended without writing the runs .*\('a_', 0\), \('a_', 1\)"):
+        _comparison(buildings, comparison_config={'a': {}}, scheduler='slurm', slurm_array_job_id='123')
+    assert len(queries) == 3 and '123' in queries[0]
+
+
+def test_slurm_driver_times_out(buildings, monkeypatch):
+    monkeypatch.setattr(prediction, 'SLURM_TIMEOUT_SECONDS', 0)
+    monkeypatch.delenv('SLURM_ARRAY_JOB_ID', raising=False)
+
+    with pytest.raises(Exception, match='Timed out'):
+        _comparison(buildings, comparison_config={'a': {}}, scheduler='slurm')
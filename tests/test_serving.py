@@ -0,0 +1,111 @@
+import asyncio
+import os
+import json
+import types
+
+import numpy as np
+import pytest
+import xgboost
+
+import dataset
+import serving
+
+
+@pytest.fixture
+def service(buildings, isolated_cwd):
+    df = buildings(300)
+    features = dataset.BUILDING_FEATURES[:8]
+    model = xgboost.XGBRegressor(n_estimators=10).fit(df[features], df[dataset.AGE_ATTRIBUTE])
+    serving.export_model(types.SimpleNamespace(model=model, target_attribute=dataset.AGE_ATTRIBUTE), 'model')
+
+    df.drop(columns=['geometry']).to_parquet('buildings.parquet')
+    serving.build_feature_store('buildings.parquet', 'store', features, batch_size=64)
+
+    service = serving.AgeService('model', 'store')
+    service.expected = dict(zip(df['id'], model.predict(df[features])))
+    service.X = df[features].to_numpy(dtype=np.float32)
+    return service
+
+
+def test_concurrent_requests_are_micro_batched(service):
+    async def requests():
+        return await asyncio.gather(*[service.predict(features=service.X[i:i + 10].tolist()) for i in range(0, 100, 10)])
+
+    results = asyncio.run(requests())
+    ages = [result['age'] for request_results in results for result in request_results]
+
+    assert np.allclose(ages, list(service.expected.values())[:100], rtol=1e-6)
+    assert service.metrics()['mean_batch_size'] > 10
+
+
+def test_predict_by_id_reports_unknown_ids(service):
+    results = asyncio.run(service.predict(ids=['b3', 'unknown', 'b7']))
+
+    assert results[0]['age'] == pytest.approx(service.expected['b3'], rel=1e-6)
+    assert results[1] == {'id': 'unknown', 'error': 'Unknown building id.'}
+    assert results[2]['age'] == pytest.approx(service.expected['b7'], rel=1e-6)
+
+
+def test_cancelled_requests_do_not_stop_the_batcher(service):
+    async def requests():
+        cancelled = asyncio.create_task(service.predict(features=service.X[:5].tolist()))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        first = await service.predict(features=service.X[5:10].tolist())
+        await asyncio.sleep(0.01)
+        return first, await service.predict(features=service.X[10:15].tolist()), service.batcher.done()
+
+    first, second, batcher_done = asyncio.run(requests())
+
+    assert not batcher_done
+    assert np.allclose([r['age'] for r in first + second], list(service.expected.values())[5:15], rtol=1e-6)
+
+
+async def _http(service, request):
+    server = await asyncio.start_server(service._handle_connection, '127.0.0.1', 0)
+    async with server:
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        writer.write(request)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return response.decode()
+
+
+@pytest.mark.parametrize('request_line, headers', [
+    (b'GARBAGE\r\n', b''),
+    (b'POST /predict HTTP/1.1\r\n', b'Content-Length: abc\r\n'),
+    (b'POST /predict HTTP/1.1\r\n', b'Content-Length: -1\r\n'),
+])
+def test_malformed_requests_are_rejected(service, request_line, headers):
+    response = asyncio.run(_http(service, request_line + headers + b'\r\n'))
+    assert response.startswith('HTTP/1.1 400 Bad Request')
+
+
+def test_http_predict(service):
+    body = json.dumps({'ids': ['b1']}).encode()
+    response = asyncio.run(_http(service, b'POST /predict HTTP/1.1\r\nConnection: close\r\nContent-Length: %d\r\n\r\n' % len(body) + body))
+
+    assert response.startswith('HTTP/1.1 200 OK')
+    assert json.loads(response.split('\r\n\r\n', 1)[1])[0]['age'] == pytest.approx(service.expected['b1'], rel=1e-6)
+
+
+def test_request_bodies_above_the_limit_are_rejected(service):
+    service.max_body_size = 100
+    body = json.dumps({'ids': ['b1'] * 50}).encode()
+    response = asyncio.run(_http(service, b'POST /predict HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % len(body) + body))
+
+    assert response.startswith('HTTP/1.1 413 Payload Too Large')
+
+
+def test_empty_feature_store_reports_unknown_ids(isolated_cwd):
+    os.makedirs('store')
+    np.save(os.path.join('store', serving.FEATURE_STORE_IDS_FILE), np.array([], dtype=str))
+    np.save(os.path.join('store', serving.FEATURE_STORE_FEATURES_FILE), np.zeros((0, 2), dtype=np.float32))
+    with open(os.path.join('store', serving.SCHEMA_FILE), 'w') as f:
+        json.dump({'features': ['a', 'b']}, f)
+
+    features, found = serving.FeatureStore('store').lookup(['b1', 'b2'])
+
+    assert features.shape == (0, 2)
+    assert list(found) == [False, False]
@@ -0,0 +1,141 @@
+import numpy as np
+import libpysal as lps
+import pytest
+import shapely
+
+import dataset
+import geometry
+import spatial_autocorrelation
+import spatial_weights
+
+
+@pytest.fixture
+def gdf(buildings):
+    gdf = geometry.to_gdf(buildings(400))
+    # coincident buildings and pairs at exactly the distance threshold
+    gdf.loc[1, 'geometry'] = gdf.loc[0, 'geometry']
+    gdf.loc[3, 'geometry'] = shapely.Point(gdf.loc[2, 'geometry'].x + 15, gdf.loc[2, 'geometry'].y)
+    gdf['sbb'] = gdf['city']
+    return gdf
+
+
+def _dense(weights):
+    return spatial_weights.to_sparse(weights).toarray()
+
+
+def test_knn_weights_equal_libpysal(gdf):
+    expected = lps.weights.KNN.from_dataframe(gdf, k=4, use_index=False)
+    weights = spatial_autocorrelation.weights(gdf, 'knn')
+
+    assert (_dense(weights).sum(axis=1) == 4).all()
+    assert spatial_autocorrelation.moran_I(gdf, weights) == pytest.approx(spatial_autocorrelation.moran_I(gdf, expected))
+
+
+def test_distance_weights_equal_libpysal(gdf):
+    expected = lps.weights.DistanceBand.from_dataframe(gdf, threshold=15, binary=True, silence_warnings=True, use_index=False)
+    weights = spatial_autocorrelation.weights(gdf, 'distance')
+
+    assert _dense(weights).sum() > 0
+    assert np.array_equal(_dense(weights), expected.full()[0])
+
+
+def test_distance_pairs_are_sorted_pairs_within_distance(gdf):
+    row, col, distances = spatial_weights.distance_pairs(spatial_weights.spatial_index(gdf), 50)
+    points = np.column_stack([gdf.geometry.x, gdf.geometry.y])
+    all_distances = np.linalg.norm(points[:, None] - points[None], axis=2)
+
+    assert (row < col).all()
+    assert (np.diff(distances) >= 0).all()
+    assert np.allclose(distances, all_distances[row, col])
+    assert len(row) == np.triu((all_distances <= 50) & (all_distances > 0), k=1).sum()
+
+
+def test_moran_within_sbb_adds_missing_building_ids(gdf):
+    df = gdf.drop(columns=['geometry'])
+    with_ids = df.assign(sbb_bld_ids=df['sbb'].map(df.groupby('sbb')['id'].apply(list)))
+
+    assert spatial_autocorrelation.moran_within_sbb(df).I == pytest.approx(spatial_autocorrelation.moran_within_sbb(with_ids.drop(columns=['sbb'])).I)
+
+    with pytest.raises(Exception, match='sbb'):
+        spatial_autocorrelation.moran_within_sbb(df.drop(columns=['sbb']))
+
+
+def _local_autocorrelation_reference(values, weights, permutations, seed):
+    # conditional permutations with neighbor weights padded to the maximum cardinality
+    weights = spatial_weights.row_standardized(weights).tocsr()
+    n = len(values)
+    z = (values - values.mean()) / values.std()
+    lag = weights @ z
+    cardinalities = np.diff(weights.indptr)
+    max_cardinality = min(cardinalities.max(), n - 1)
+    rng = np.random.default_rng(seed)
+    draws = np.array([rng.choice(n - 1, max_cardinality, replace=False) for _ in range(permutations)])
+
+    larger = np.zeros(n, dtype=int)
+    for i in range(n):
+        row_weights = weights.data[weights.indptr[i]:weights.indptr[i + 1]]
+        neighbors = draws[:, :len(row_weights)]
+        neighbors = neighbors + (neighbors >= i)
+        larger[i] = ((z[neighbors] * row_weights).sum(axis=1) >= lag[i]).sum()
+    larger = np.minimum(larger, permutations - larger)
+    return np.where(cardinalities > 0, (larger + 1) / (permutations + 1), np.nan)
+
+
+@pytest.mark.parametrize('type', ['knn', 'block'])
+def test_local_autocorrelation_equals_padded_permutations(gdf, monkeypatch, type):
+    gdf = gdf.assign(block=gdf['city'].where(gdf.index % 7 > 0))
+    weights = spatial_autocorrelation.weights(gdf, type)
+    values = gdf[dataset.AGE_ATTRIBUTE].to_numpy()
+    expected = _local_autocorrelation_reference(values, spatial_weights.to_sparse(weights), 99, seed=0)
+
+    # chunks of very different sizes, down to single buildings, and worker processes yield the same p-values
+    for chunk_elements, n_jobs in [(10_000_000, 1), (5000, 2), (1, 1)]:
+        monkeypatch.setattr(spatial_autocorrelation, 'LISA_CHUNK_ELEMENTS', chunk_elements)
+        lisa = spatial_autocorrelation.local_autocorrelation(values, weights, permutations=99, n_jobs=n_jobs, seed=0)
+        assert np.allclose(lisa['p'], expected, equal_nan=True)
+
+
+def test_local_moran_I_equals_esda(gdf):
+    from esda.moran import Moran_Local
+
+    weights = spatial_autocorrelation.weights(gdf, 'knn')
+    values = gdf[dataset.AGE_ATTRIBUTE].to_numpy()
+    lisa = spatial_autocorrelation.local_autocorrelation(values, weights, permutations=99, seed=0)
+    esda_lisa = Moran_Local(values, weights, transformation='r', permutations=0)
+
+    assert np.allclose(lisa['local_moran_I'], esda_lisa.Is, rtol=1e-5)
+
+
+def test_moran_permutation_test_equals_esda(gdf):
+    from esda.moran import Moran
+
+    attributes = [dataset.AGE_ATTRIBUTE, *dataset.BUILDING_FEATURES[:3]]
+    weights = spatial_autocorrelation.weights(gdf, 'knn')
+    serial = spatial_autocorrelation.moran_permutation_test(gdf, attributes, weights, permutations=999, n_jobs=1, seed=0)
+    parallel = spatial_autocorrelation.moran_permutation_test(gdf, attributes, weights, permutations=999, n_jobs=2, seed=0)
+
+    # the seeds of the permutation blocks do not depend on the number of workers
+    assert serial.equals(parallel)
+    np.random.seed(0)
+    for attribute, moran_I, moran_p in serial.itertuples(index=False):
+        expected = Moran(gdf[attribute], weights, permutations=999)
+        assert moran_I == pytest.approx(expected.I)
+        assert moran_p == pytest.approx(expected.p_sim, abs=0.1)
+
+
+def test_correlogram_equals_esda_on_annulus_weights(gdf):
+    from esda.moran import Moran
+
+    distances = [10, 20, 40, 80, 160]
+    attributes = [dataset.AGE_ATTRIBUTE, dataset.BUILDING_FEATURES[0]]
+    correlogram = spatial_autocorrelation.correlogram(gdf, attributes, distances)
+
+    within = [
+        lps.weights.DistanceBand.from_dataframe(gdf, threshold=d, binary=True, silence_warnings=True, use_index=False).sparse
+        for d in distances
+    ]
+    for distance, inner, outer in zip(distances, [None, *within], within):
+        annulus = outer if inner is None else outer - inner
+        weights = lps.weights.WSP(annulus.tocsr()).to_W(silence_warnings=True)
+        for attribute in attributes:
+            assert correlogram.loc[distance, attribute] == pytest.approx(Moran(gdf[attribute], weights, permutations=0).I)
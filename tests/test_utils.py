@@ -0,0 +1,108 @@
+import os
+import functools
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dataset
+import utils
+
+
+def _split(frac):
+    def split(df):
+        return df.sample(frac=frac)
+    return split
+
+
+def test_config_hash_distinguishes_lambdas():
+    a = {'preprocessing_stages': [lambda df: df[df['age'] > 1900]]}
+    b = {'preprocessing_stages': [lambda df: df[df['age'] > 1950]]}
+    c = {'preprocessing_stages': [lambda df: df[df['age'] > 1900]]}
+
+    assert utils.config_hash(a) != utils.config_hash(b)
+    assert utils.config_hash(a) == utils.config_hash(c)
+
+
+def test_config_hash_distinguishes_closures():
+    assert utils.config_hash({'split': _split(0.8)}) != utils.config_hash({'split': _split(0.5)})
+    assert utils.config_hash({'split': _split(0.8)}) == utils.config_hash({'split': _split(0.8)})
+
+
+def test_config_hash_of_functions_and_partials():
+    assert utils.config_hash({'f': utils.age_bins}) == utils.config_hash({'f': utils.age_bins})
+    assert utils.config_hash({'f': functools.partial(utils.age_bins, bin_size=5)}) != utils.config_hash({'f': functools.partial(utils.age_bins, bin_size=10)})
+
+
+def test_config_hash_covers_all_dataframe_columns():
+    df = pd.DataFrame({'x': np.arange(3), 'country': ['France', 'Spain', 'France']})
+    other = df.assign(country=['France', 'Spain', 'Netherlands'])
+
+    assert utils.config_hash({'df': df}) != utils.config_hash({'df': other})
+    assert utils.config_hash({'df': df}) == utils.config_hash({'df': df.copy()})
+
+
+@pytest.fixture
+def country_pickle(buildings, isolated_cwd, monkeypatch):
+    monkeypatch.setattr(dataset, 'DATA_DIR', str(isolated_cwd))
+    monkeypatch.setattr(utils, 'CACHE_MAX_ROWS_PER_GROUP', 100)
+
+    # shuffled index with a name, cities not in sorted order and list columns stored as strings
+    df = buildings(500).drop(columns=['geometry'])
+    df.index = pd.Index(np.random.default_rng(0).permutation(len(df)) * 3, name='row')
+    df['block_bld_ids'] = [str([f'b{i}', f'b{i + 1}']) for i in range(len(df))]
+    df['TouchesIndexes'] = [str([i, i + 2]) for i in range(len(df))]
+    path = isolated_cwd / utils.COUNTRY_FILES['france']
+    df.to_pickle(path)
+    return path
+
+
+def _load(cache, **kwargs):
+    return utils.load_data('france', eval_columns=['id', 'block_bld_ids', 'TouchesIndexes'], cache=cache, **kwargs)
+
+
+@pytest.mark.parametrize('columns, cities', [
+    (None, None),
+    (['TouchesIndexes', 'age_right', 'city', 'id'], None),
+    (None, ['city3', 'city0']),
+    (['age_right', 'block_bld_ids'], ['city1']),
+])
+def test_data_cache_equals_pickle(country_pickle, columns, cities):
+    cached = _load(True, columns=columns, cities=cities)
+
+    pd.testing.assert_frame_equal(cached, _load(False, columns=columns, cities=cities))
+    assert os.path.exists(os.path.join(utils.data_cache_path('france'), utils.CACHE_COMPLETE_FILE))
+
+
+def test_data_cache_is_opt_in(country_pickle):
+    utils.load_data('france')
+    assert not os.path.exists(utils.data_cache_path('france'))
+
+
+def test_incomplete_or_outdated_data_cache_is_rebuilt(country_pickle):
+    expected = _load(False)
+
+    # cache of an interrupted build without the completion marker
+    _load(True)
+    os.remove(os.path.join(utils.data_cache_path('france'), utils.CACHE_COMPLETE_FILE))
+    pd.read_pickle(country_pickle).iloc[:10].to_parquet(os.path.join(utils.data_cache_path('france'), 'part-0.parquet'))
+    pd.testing.assert_frame_equal(_load(True), expected)
+
+    # pickle changed after the cache was built
+    changed = pd.read_pickle(country_pickle).iloc[:200]
+    changed.to_pickle(country_pickle)
+    os.utime(country_pickle, (os.path.getmtime(country_pickle) + 10,) * 2)
+    pd.testing.assert_frame_equal(_load(True), _load(False))
+
+
+def _load_length(_):
+    return len(_load(True))
+
+
+def test_concurrent_data_cache_builds(country_pickle):
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        lengths = pool.map(_load_length, range(4))
+
+    assert lengths == [500] * 4
+    assert [name for name in os.listdir(os.path.dirname(country_pickle)) if '.tmp' in name] == []